@@ -2,18 +2,31 @@
 Template Component main class.
 
 '''
+import contextlib
 import datetime
+import functools
 import logging
 import os
 import sys
+import time
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 from kbc.env_handler import KBCEnvHandler
 from kbc.result import ResultWriter, KBCTableDef
 
-from result import OrderWriter, ProductsWriter, CustomersWriter
-from shopify_cli import ShopifyClient
+from events import EventsSelection
+from incremental import IdCursor, Watermark, WindowCheckpoint, as_aware, load_id_cursor, load_watermark, \
+    load_window_checkpoint, store_id_cursor, store_watermark, store_window_checkpoint
+from inventory import InventoryCollector, load_inventory_cache, store_inventory_cache
+from metrics import METRICS_FILE_NAME
+from parquet_output import is_available as is_parquet_available
+from pipeline import Pipeline
+from profiling import PhaseProfiler
+from result import OrderWriter, ProductsWriter, CustomersWriter, SynchronizedResultWriter, TableWriter, OutputOptions, \
+    FlattenedPage
+from shopify_cli import RESULTS_PER_PAGE, ShopifyClient, TaskPool
+from transport import PooledTransport, UrllibTransport
 
 # configuration variables
 KEY_API_TOKEN = '#api_token'
@@ -23,6 +36,21 @@ KEY_TO_DATE = 'date_to'
 KEY_INCREMENTAL_OUTPUT = 'incremental_output'
 KEY_FETCH_PARAMETER = 'fetch_parameter'
 KEY_LOADING_OPTIONS = 'loading_options'
+KEY_MAX_WORKERS = 'max_workers'
+KEY_BULK_ENDPOINTS = 'bulk_endpoints'
+KEY_SINCE_LAST_RUN = 'incremental_since_last_run'
+KEY_PARALLEL_ENDPOINTS = 'parallel_endpoints'
+KEY_RAW_JSON = 'raw_json'
+KEY_HTTP_TRANSPORT = 'http_transport'
+KEY_ONE_PASS_HEADERS = 'one_pass_headers'
+KEY_SLICE_SIZE_MB = 'slice_size_mb'
+KEY_COMPRESS_SLICES = 'compress_slices'
+KEY_OUTPUT_FORMAT = 'output_format'
+KEY_INVENTORY_CACHE = 'inventory_cache'
+KEY_INVENTORY_FULL_REFRESH_DAYS = 'inventory_full_refresh_days'
+KEY_PAYMENTS_FULL_REFRESH_DAYS = 'payments_full_refresh_days'
+KEY_WRITE_METRICS = 'write_metrics'
+KEY_CHECKPOINT_WINDOWS = 'checkpoint_windows'
 
 KEY_ENDPOINTS = 'endpoints'
 KEY_ORDERS = 'orders'
@@ -33,11 +61,22 @@ KEY_PRODUCTS_DRAFTS = 'products_drafts'
 KEY_CUSTOMERS = 'customers'
 KEY_EVENTS = 'events'
 KEY_INVENTORY = 'inventory'
+KEY_TRANSACTIONS = 'transactions'
 
 KEY_SHOP = 'shop'
 
 # #### Keep for debug
 KEY_DEBUG = 'debug'
+# CPU and memory profiles of the download phases written to the output files
+KEY_PROFILING = 'profiling'
+
+# background fetches (order transactions, metafields) use at least this many workers,
+# so they never block the paging of the parent objects
+MIN_BACKGROUND_WORKERS = 2
+
+TRANSPORTS = {'urllib': UrllibTransport, 'pooled': PooledTransport}
+
+OUTPUT_FORMATS = ['csv', 'parquet']
 
 # list of mandatory parameters => if some is missing, component will fail with readable message on initialization.
 MANDATORY_PARS = [KEY_API_TOKEN, KEY_SHOP, KEY_LOADING_OPTIONS, KEY_ENDPOINTS]
@@ -79,26 +118,85 @@ class Component(KBCEnvHandler):
 
         self.validate_api_token(self.cfg_params[KEY_API_TOKEN])
 
+        max_workers = int(self.cfg_params[KEY_LOADING_OPTIONS].get(KEY_MAX_WORKERS) or 1)
+        raw_json = bool(self.cfg_params[KEY_LOADING_OPTIONS].get(KEY_RAW_JSON))
+        transport = self.cfg_params[KEY_LOADING_OPTIONS].get(KEY_HTTP_TRANSPORT) or 'urllib'
+        if transport not in TRANSPORTS:
+            raise UserException(f"Unsupported HTTP transport '{transport}', use one of {list(TRANSPORTS)}")
         try:
             self.client = ShopifyClient(self.cfg_params[KEY_SHOP], self.cfg_params[KEY_API_TOKEN],
-                                        self.cfg_params.get('api_version', '2022-10'))
+                                        self.cfg_params.get('api_version', '2022-10'),
+                                        max_workers=max_workers, raw_json=raw_json,
+                                        transport=TRANSPORTS[transport]())
         except Exception as e:
             raise UserException(f"Error while creating Shopify client: {e}") from e
 
-        self.extraction_time = datetime.datetime.now().isoformat()
+        loading_options = self.cfg_params[KEY_LOADING_OPTIONS]
+        output_format = loading_options.get(KEY_OUTPUT_FORMAT) or 'csv'
+        if output_format not in OUTPUT_FORMATS:
+            raise UserException(f"Unsupported output format '{output_format}', use one of {OUTPUT_FORMATS}")
+        if output_format == 'parquet' and not is_parquet_available():
+            raise UserException("The Parquet output requires the pyarrow package")
+        # passed to every table writer of the run
+        self._output_options = OutputOptions(
+            one_pass_headers=bool(loading_options.get(KEY_ONE_PASS_HEADERS)),
+            slice_size=int(float(loading_options.get(KEY_SLICE_SIZE_MB) or 0) * 1024 * 1024),
+            compress_slices=bool(loading_options.get(KEY_COMPRESS_SLICES)),
+            output_format=output_format, files_path=self.files_out_path)
+        self._profiler = PhaseProfiler(self.files_out_path) if self.cfg_params.get(KEY_PROFILING) else None
 
-        # shared customers writer
+        self.extraction_time = datetime.datetime.now().isoformat()
+        # endpoint -> max updated_at / created_at seen, stored in the state file
+        self._watermarks = {}
+        # endpoint -> max id seen, for the endpoints without date filters
+        self._cursors: Dict[str, IdCursor] = {}
+        # endpoint -> completed date windows, stored in the state file when the download is interrupted
+        self._checkpoints: Dict[str, WindowCheckpoint] = {}
+
+        # the tables of a run since the last one contain only the changes, so they are safe to load only incrementally
+        self._since_last_run = False
+        if loading_options.get(KEY_SINCE_LAST_RUN):
+            if loading_options.get(KEY_INCREMENTAL_OUTPUT):
+                self._since_last_run = True
+            else:
+                logging.warning('Loading since the last run requires incremental output, the whole period and all '
+                                'payments transactions will be downloaded')
+
+        # the tables of an interrupted run are partial, so they are safe to load only incrementally
+        self._checkpoint_windows = False
+        if loading_options.get(KEY_CHECKPOINT_WINDOWS):
+            if loading_options.get(KEY_INCREMENTAL_OUTPUT):
+                self._checkpoint_windows = True
+            else:
+                logging.warning('The date window checkpoints require incremental output, a failed download will '
+                                'fail the run')
+
+        # skipped inventory is not in the output, so the cache is safe only when the output is loaded incrementally
+        self._inventory_cache = None
+        if loading_options.get(KEY_INVENTORY_CACHE):
+            if loading_options.get(KEY_INCREMENTAL_OUTPUT):
+                refresh_days = float(loading_options.get(KEY_INVENTORY_FULL_REFRESH_DAYS) or 7)
+                self._inventory_cache = load_inventory_cache(self.get_state_file(),
+                                                             datetime.timedelta(days=refresh_days))
+            else:
+                logging.warning('The inventory cache requires incremental output, all inventory will be downloaded')
+
+        # shared customers and metafields writers, safe for concurrently downloaded endpoints
         self._customer_writer = CustomersWriter(self.tables_out_path,
                                                 'customer',
                                                 extraction_time=self.extraction_time,
-                                                file_headers=self.get_state_file())
-        self._metafields_writer = ResultWriter(self.tables_out_path,
-                                               KBCTableDef(name='metafields',
-                                                           pk=['id'],
-                                                           columns=self.get_state_file().get(
-                                                               'metafields.csv', []),
-                                                           destination=''),
-                                               flatten_objects=True, child_separator='__', fix_headers=True)
+                                                file_headers=self.get_state_file(),
+                                                output_options=self._output_options,
+                                                metrics=self.client.metrics)
+        self._metafields_writer = SynchronizedResultWriter(self.tables_out_path,
+                                                           KBCTableDef(name='metafields',
+                                                                       pk=['id'],
+                                                                       columns=self.get_state_file().get(
+                                                                           'metafields.csv', []),
+                                                                       destination=''),
+                                                           child_separator='__', fix_headers=True,
+                                                           output_options=self._output_options,
+                                                           metrics=self.client.metrics)
 
     def run(self):
         '''
@@ -112,45 +210,177 @@ class Component(KBCEnvHandler):
         until = params[KEY_LOADING_OPTIONS].get(KEY_TO_DATE) or 'now'
 
         start_date, end_date = self.get_date_period_converted(since, until)
-        results = []
         endpoints = params[KEY_ENDPOINTS]
+        # endpoint -> download returning the results
+        downloads = {}
 
         if endpoints.get(KEY_ORDERS):
-            logging.info(f'Getting orders since {start_date} to {end_date}')
-            results.extend(self.download_orders(fetch_parameter, start_date, end_date, last_state))
+            orders_start, orders_end = self._get_period(KEY_ORDERS, fetch_parameter, start_date, end_date)
+            logging.info(f'Getting orders since {orders_start} to {orders_end}')
+            downloads[KEY_ORDERS] = functools.partial(self.download_orders, fetch_parameter, orders_start,
+                                                      orders_end, last_state)
 
         if endpoints.get(KEY_PRODUCTS):
-            logging.info(f'Getting products since {start_date} to {end_date}')
-            results.extend(self.download_products(fetch_parameter, start_date, end_date, last_state))
+            products_start, products_end = self._get_period(KEY_PRODUCTS, fetch_parameter, start_date, end_date)
+            logging.info(f'Getting products since {products_start} to {products_end}')
+            downloads[KEY_PRODUCTS] = functools.partial(self.download_products, fetch_parameter, products_start,
+                                                        products_end, last_state)
 
         if endpoints.get(KEY_PAYMENTS_TRANSACTIONS):
             logging.info('Getting payments transactions')
-            results.extend(self.download_payments_transactions())
+            downloads[KEY_PAYMENTS_TRANSACTIONS] = self.download_payments_transactions
 
         if endpoints.get(KEY_CUSTOMERS):
-            # special case, results collected at the end
-            logging.info(f'Getting customers since {start_date} to {end_date}')
-            self.download_customers(fetch_parameter, start_date, end_date)
+            customers_start, customers_end = self._get_period(KEY_CUSTOMERS, fetch_parameter, start_date, end_date)
+            logging.info(f'Getting customers since {customers_start} to {customers_end}')
+            downloads[KEY_CUSTOMERS] = functools.partial(self.download_customers, fetch_parameter, customers_start,
+                                                         customers_end)
 
         if endpoints.get(KEY_EVENTS) and len(endpoints[KEY_EVENTS]) > 0:
-            logging.info(f'Getting events since {start_date} to {end_date}')
-            results.extend(self.download_events(endpoints[KEY_EVENTS][0], fetch_parameter, start_date, end_date))
+            # events are always filtered by created_at
+            events_start, events_end = self._get_period(KEY_EVENTS, 'created_at', start_date, end_date)
+            logging.info(f'Getting events since {events_start} to {events_end}')
+            downloads[KEY_EVENTS] = functools.partial(self.download_events, EventsSelection(endpoints[KEY_EVENTS]),
+                                                      fetch_parameter, events_start, events_end)
 
-        # collect customers
-        self._customer_writer.close()
-        results.extend(self._customer_writer.collect_results())
+        results = self._run_downloads(downloads)
 
-        # collect metafields
-        self._metafields_writer.close()
-        results.extend(self._metafields_writer.collect_results())
+        with self._profile('shared_tables'):
+            # collect customers
+            self._customer_writer.close()
+            results.extend(self._customer_writer.collect_results())
+
+            # collect metafields
+            self._metafields_writer.close()
+            results.extend(self._metafields_writer.collect_results())
 
         # update column names in statefile
         for r in results:
             file_name = os.path.basename(r.full_path)
             last_state[file_name] = r.table_def.columns
+        for endpoint, watermark in self._watermarks.items():
+            # records of the window that failed may be later than the checkpoint, the last watermark is kept
+            if not self._checkpoints[endpoint].interrupted:
+                store_watermark(last_state, endpoint, watermark)
+        for endpoint, checkpoint in self._checkpoints.items():
+            store_window_checkpoint(last_state, endpoint, checkpoint)
+            if checkpoint.interrupted:
+                logging.warning(f'The {endpoint} download was interrupted by an error, only the records until '
+                                f'{checkpoint.completed_until} were downloaded. The next run continues from there. '
+                                f'Error: {checkpoint.error}')
+        for endpoint, cursor in self._cursors.items():
+            store_id_cursor(last_state, endpoint, cursor)
+        if self._inventory_cache:
+            store_inventory_cache(last_state, self._inventory_cache)
         self.write_state_file(last_state)
         incremental = params[KEY_LOADING_OPTIONS].get(KEY_INCREMENTAL_OUTPUT, False)
-        self.create_manifests(results, incremental=incremental)
+        # sliced tables are folders of headless slices, the columns are listed in the manifest
+        sliced = [r for r in results if os.path.isdir(r.full_path)]
+        self.create_manifests([r for r in results if r not in sliced], incremental=incremental)
+        if sliced:
+            self.create_manifests(sliced, headless=True, incremental=incremental)
+
+        rate_limiter = self.client.rate_limiter
+        logging.info(f'Waited {rate_limiter.total_wait_time:.1f}s for the API call limit '
+                     f'({rate_limiter.wait_count} pauses)')
+        self.client.close()
+
+        self.client.metrics.log_summary()
+        if params[KEY_LOADING_OPTIONS].get(KEY_WRITE_METRICS):
+            metrics_path = os.path.join(self.files_out_path, METRICS_FILE_NAME)
+            self.client.metrics.write(metrics_path)
+            logging.info(f'Run metrics written to {METRICS_FILE_NAME}')
+
+    def _get_period(self, endpoint: str, field: str, start_date: datetime.datetime,
+                    end_date: datetime.datetime) -> Tuple[datetime.datetime, datetime.datetime]:
+        """
+        Returns the period to download, when loading since the last run it starts from the endpoint watermark
+        stored in the state. The watermark keeps the offset of the shop, so the end date is made timezone aware too.
+        The download interrupted in the last run continues from its last completed date window.
+        """
+        watermark = load_watermark(self.get_state_file(), endpoint, field)
+        self._watermarks[endpoint] = watermark
+        # loaded also when not enabled, so the checkpoint of an earlier run is removed from the state
+        checkpoint = load_window_checkpoint(self.get_state_file(), endpoint, field)
+        self._checkpoints[endpoint] = checkpoint
+
+        resume_date = watermark.get_resume_date()
+        if self._since_last_run and resume_date is not None:
+            logging.info(f'Resuming {endpoint} from the last {field} seen: {watermark.value}')
+            start_date, end_date = resume_date, end_date.astimezone()
+
+        checkpoint_date = checkpoint.get_resume_date(start_date, end_date) if self._checkpoint_windows else None
+        if checkpoint_date is None:
+            return start_date, end_date
+
+        logging.info(f'Continuing the interrupted {endpoint} download from its last completed window: '
+                     f'{checkpoint_date}')
+        return checkpoint_date, as_aware(end_date)
+
+    def _get_checkpoint(self, endpoint: str) -> Optional[WindowCheckpoint]:
+        return self._checkpoints.get(endpoint) if self._checkpoint_windows else None
+
+    def _get_since_id(self, endpoint: str, full_refresh_days_key: str) -> Optional[int]:
+        """
+        Returns the id to continue from, when loading since the last run it is the max id stored in the state.
+        None means a full download, also when the full refresh interval of the endpoint elapsed.
+        """
+        cursor = load_id_cursor(self.get_state_file(), endpoint)
+        self._cursors[endpoint] = cursor
+
+        refresh_days = float(self.cfg_params[KEY_LOADING_OPTIONS].get(full_refresh_days_key) or 0)
+        refresh_interval = datetime.timedelta(days=refresh_days) if refresh_days else None
+        if not self._since_last_run or cursor.is_refresh_due(refresh_interval):
+            cursor.mark_refreshed()
+            return None
+
+        logging.info(f'Resuming {endpoint} from the last id seen: {cursor.value}')
+        return cursor.value
+
+    def _track_watermark(self, endpoint: str, obj: dict):
+        watermark: Watermark = self._watermarks.get(endpoint)
+        if watermark:
+            watermark.track(obj)
+
+    def _run_downloads(self, downloads: Dict[str, Callable[[], list]]) -> list:
+        """
+        Run the endpoint downloads one after another or concurrently, all of them share the client rate limiter.
+        Each download is a profiled phase, the concurrent downloads are profiled together.
+        """
+        results = []
+        if not self.cfg_params[KEY_LOADING_OPTIONS].get(KEY_PARALLEL_ENDPOINTS) or len(downloads) < 2:
+            for endpoint, download in downloads.items():
+                with self._profile(endpoint):
+                    results.extend(download())
+            return results
+
+        logging.info(f'Downloading endpoints {", ".join(downloads)} concurrently')
+        with self._profile('downloads'), self.client.task_pool(max_workers=len(downloads)) as pool:
+            for download in downloads.values():
+                pool.submit(download)
+            for endpoint_results in pool.drain():
+                results.extend(endpoint_results)
+        return results
+
+    def _profile(self, phase: str):
+        return self._profiler.profile(phase) if self._profiler else contextlib.nullcontext()
+
+    def _pipeline(self, name: str, transformations: List[Tuple[str, Callable]] = None,
+                  batch_size: int = None) -> Pipeline:
+        # the fetch stage runs in a separate thread which needs its own Shopify session
+        return Pipeline(name, transformations=transformations, thread_initializer=self.client.activate_session,
+                        metrics=self.client.metrics, batch_size=batch_size)
+
+    def _record_table_metrics(self, table: str, rows: int, started: float):
+        # tables written by the generic ResultWriter, the TableWriters record their rows themselves
+        if rows:
+            self.client.metrics.record_table(table, rows, time.monotonic() - started)
+
+    def _background_pool(self) -> TaskPool:
+        return self.client.task_pool(max_workers=max(MIN_BACKGROUND_WORKERS, self.client.max_workers))
+
+    def _get_bulk_endpoints(self) -> List[str]:
+        return self.cfg_params[KEY_LOADING_OPTIONS].get(KEY_BULK_ENDPOINTS) or []
 
     def get_product_status(self):
         status = ['active']
@@ -165,7 +395,8 @@ class Component(KBCEnvHandler):
     def download_orders(self, fetch_field, start_date, end_date, file_headers):
         with OrderWriter(self.tables_out_path, 'order', extraction_time=self.extraction_time,
                          customers_writer=self._customer_writer,
-                         file_headers=file_headers) as writer_orders, \
+                         file_headers=file_headers, output_options=self._output_options,
+                         metrics=self.client.metrics) as writer_orders, \
                 ResultWriter(self.tables_out_path,
                              KBCTableDef(name='transactions',
                                          pk=['order_id', 'id'],
@@ -173,16 +404,45 @@ class Component(KBCEnvHandler):
                                          destination=''), fix_headers=True,
                              flatten_objects=False, child_separator='__') as writer_order_transactions:
             orders_processed = 0
-            for o in self.client.get_orders(fetch_field, start_date, end_date):
-                writer_orders.write(o)
-                orders_processed += 1
-
-                if self.cfg_params[KEY_ENDPOINTS].get('transactions'):
-                    self.download_order_transactions(writer_order_transactions, o['id'])
-
-                if orders_processed % 1000 == 0:
-                    logging.info(f"Downloading records: {orders_processed} - {orders_processed + 1000}")
-
+            transactions_written = 0
+            started = time.monotonic()
+            if KEY_ORDERS in self._get_bulk_endpoints():
+                logging.info('Getting orders using the GraphQL Bulk Operation')
+                orders = self.client.get_orders_bulk(fetch_field, start_date, end_date)
+            else:
+                orders = self.client.get_orders(fetch_field, start_date, end_date,
+                                                checkpoint=self._get_checkpoint(KEY_ORDERS))
+
+            # transactions are fetched in the background while the orders are paged
+            with self._background_pool() as transactions_pool:
+                def write_transactions(transactions):
+                    nonlocal transactions_written
+                    writer_order_transactions.write_all(transactions)
+                    transactions_written += len(transactions)
+
+                def write_orders(page: FlattenedPage):
+                    nonlocal orders_processed
+                    page.write()
+                    for o in page.records:
+                        self._track_watermark(KEY_ORDERS, o)
+                        orders_processed += 1
+
+                        if self.cfg_params[KEY_ENDPOINTS].get(KEY_TRANSACTIONS):
+                            transactions_pool.submit(self.get_order_transactions, o['id'])
+                            for transactions in transactions_pool.completed():
+                                write_transactions(transactions)
+
+                        if orders_processed % 1000 == 0:
+                            logging.info(f"Downloading records: {orders_processed} - {orders_processed + 1000}")
+
+                # the pages of orders are flattened in a separate stage, the writer stage only writes the rows
+                self._pipeline(KEY_ORDERS, transformations=[('flatten', writer_orders.flatten_page)],
+                               batch_size=RESULTS_PER_PAGE).run(orders, write_orders)
+
+                for transactions in transactions_pool.drain():
+                    write_transactions(transactions)
+
+        self._record_table_metrics('transactions', transactions_written, started)
         results = writer_orders.collect_results()
         results.extend(writer_order_transactions.collect_results())
 
@@ -198,7 +458,13 @@ class Component(KBCEnvHandler):
                           flatten_objects=False,
                           child_separator='__') as writer_payments_transactions:
             payment_transactions_processed = 0
-            for o in self.client.get_payments_transactions():
+            started = time.monotonic()
+            since_id = self._get_since_id(KEY_PAYMENTS_TRANSACTIONS, KEY_PAYMENTS_FULL_REFRESH_DAYS)
+            cursor = self._cursors[KEY_PAYMENTS_TRANSACTIONS]
+
+            def write_transaction(o):
+                nonlocal payment_transactions_processed
+                cursor.track(o)
                 writer_payments_transactions.write(o)
                 payment_transactions_processed += 1
 
@@ -206,40 +472,75 @@ class Component(KBCEnvHandler):
                     logging.info(f"Downloading records: {payment_transactions_processed} "
                                  f"- {payment_transactions_processed + 1000}")
 
+            self._pipeline(KEY_PAYMENTS_TRANSACTIONS).run(self.client.get_payments_transactions(since_id=since_id),
+                                                          write_transaction)
+
+        self._record_table_metrics('payments_transactions', payment_transactions_processed, started)
         return writer_payments_transactions.collect_results()
 
     def download_products(self, fetch_field, start_date, end_date, file_headers):
-        inventory_writer = ResultWriter(self.tables_out_path,
-                                        KBCTableDef(name='inventory_items', pk=['id'],
-                                                    columns=[],
-                                                    destination=''),
-                                        flatten_objects=True, child_separator='__')
-        inventory_level_writer = ResultWriter(self.tables_out_path,
-                                              KBCTableDef(name='inventory_levels',
-                                                          pk=['inventory_item_id', 'location_id'],
-                                                          columns=[],
-                                                          destination=''),
-                                              fix_headers=True,
-                                              flatten_objects=True, child_separator='__')
+        inventory_writer = TableWriter(self.tables_out_path,
+                                       KBCTableDef(name='inventory_items', pk=['id'],
+                                                   columns=[],
+                                                   destination=''),
+                                       child_separator='__', output_options=self._output_options,
+                                       metrics=self.client.metrics)
+        inventory_level_writer = TableWriter(self.tables_out_path,
+                                             KBCTableDef(name='inventory_levels',
+                                                         pk=['inventory_item_id', 'location_id'],
+                                                         columns=[],
+                                                         destination=''),
+                                             fix_headers=True,
+                                             child_separator='__', output_options=self._output_options,
+                                             metrics=self.client.metrics)
         if self.cfg_params[KEY_ENDPOINTS].get(KEY_INVENTORY):
             logging.info('Getting inventory levels and locations for products')
 
         with ProductsWriter(self.tables_out_path, 'product',
                             extraction_time=self.extraction_time,
-                            file_headers=file_headers) as writer:
-            for o in self.client.get_products(fetch_field, start_date, end_date, self.get_product_status()):
+                            file_headers=file_headers, output_options=self._output_options,
+                            metrics=self.client.metrics) as writer, \
+                self._background_pool() as metafields_pool, \
+                self._background_pool() as inventory_pool:
+            inventory = InventoryCollector(self.client, inventory_pool, inventory_writer, inventory_level_writer,
+                                           cache=self._inventory_cache)
+            if KEY_PRODUCTS in self._get_bulk_endpoints():
+                logging.info('Getting products using the GraphQL Bulk Operation')
+                products = self.client.get_products_bulk(fetch_field, start_date, end_date,
+                                                         self.get_product_status())
+            else:
+                products = self.client.get_products(fetch_field, start_date, end_date, self.get_product_status(),
+                                                    checkpoint=self._get_checkpoint(KEY_PRODUCTS))
+
+            def write_products(page: FlattenedPage):
+                o = page.records
                 variants = [p['variants'] for p in o]
-                inventory_ids = [str(v['inventory_item_id']) for sublist in variants for v in sublist]
-                writer.write_all(o)
+                for p in o:
+                    self._track_watermark(KEY_PRODUCTS, p)
+                page.write()
                 if o and self.cfg_params[KEY_ENDPOINTS].get(KEY_INVENTORY):
-                    self.download_product_inventory(inventory_writer, inventory_ids)
-                    self.download_product_inventory_levels(inventory_level_writer, inventory_ids)
+                    inventory.add([v for sublist in variants for v in sublist])
 
                 if self.cfg_params[KEY_ENDPOINTS].get('product_metafields'):
-                    self.download_metafields('products', [p['id'] for p in o])
+                    self.download_metafields(metafields_pool, 'products', [p['id'] for p in o])
 
                 if self.cfg_params[KEY_ENDPOINTS].get('variant_metafields'):
-                    self.download_metafields('variants', [v['id'] for sublist in variants for v in sublist])
+                    self.download_metafields(metafields_pool, 'variants',
+                                             [v['id'] for sublist in variants for v in sublist])
+
+            # the products are returned in chunks already
+            self._pipeline(KEY_PRODUCTS, transformations=[('flatten', writer.flatten_page)]).run(products,
+                                                                                                 write_products)
+
+            inventory.finish()
+            if self.cfg_params[KEY_ENDPOINTS].get(KEY_INVENTORY):
+                logging.info(f'Inventory downloaded in {inventory.items.requests} inventory items '
+                             f'and {inventory.levels.requests} inventory levels requests')
+                if self._inventory_cache:
+                    logging.info(f'Skipped inventory of {self._inventory_cache.skipped} unchanged variants')
+
+            for metafields in metafields_pool.drain():
+                self._metafields_writer.write_all(metafields)
 
         inventory_writer.close()
         inventory_level_writer.close()
@@ -252,40 +553,47 @@ class Component(KBCEnvHandler):
         return results
 
     def download_locations(self):
-        with ResultWriter(self.tables_out_path,
-                          KBCTableDef(name='locations', pk=['id'],
-                                      columns=[],
-                                      destination=''),
-                          flatten_objects=True, child_separator='__') as writer:
+        with TableWriter(self.tables_out_path,
+                         KBCTableDef(name='locations', pk=['id'],
+                                     columns=[],
+                                     destination=''),
+                         child_separator='__', output_options=self._output_options,
+                         metrics=self.client.metrics) as writer:
             for item in self.client.get_locations():
                 writer.write(item)
 
         return writer.collect_results()
 
-    def download_metafields(self, object_type: str, owner_ids: List[str]):
+    def download_metafields(self, pool: TaskPool, object_type: str, owner_ids: List[str]):
+        """
+        Submit the metafield fetches of the owners to the pool and write the already completed ones.
+        Remaining results need to be drained from the pool by the caller.
+        """
         for oid in owner_ids:
-            for metafield in self.client.get_metafields(object_type, oid):
-                self._metafields_writer.write(metafield)
+            pool.submit(self.get_metafields, object_type, oid)
+            for metafields in pool.completed():
+                self._metafields_writer.write_all(metafields)
 
-    def download_product_inventory(self, writer, inventory_ids):
-        for chunk in self._split_array_to_chunks(inventory_ids, 49):
-            for item in self.client.get_inventory_items(chunk):
-                writer.write(item)
-
-    def download_product_inventory_levels(self, writer, inventory_ids):
-        for chunk in self._split_array_to_chunks(inventory_ids, 49):
-            for item in self.client.get_inventory_item_levels(chunk):
-                writer.write(item)
+    def get_metafields(self, object_type: str, owner_id: str) -> List[dict]:
+        return list(self.client.get_metafields(object_type, owner_id))
 
     def download_customers(self, fetch_field, start_date, end_date):
-        for o in self.client.get_customers(fetch_field, start_date, end_date):
+        """
+        Special case, the customers are written by the shared writer and the results are collected at the end.
+        """
+        def write_customer(o):
+            self._track_watermark(KEY_CUSTOMERS, o)
             self._customer_writer.write(o)
 
-    def download_order_transactions(self, writer, order_id):
-        for transaction in self.client.get_order_transactions(order_id):
-            writer.write(transaction)
+        self._pipeline(KEY_CUSTOMERS).run(self.client.get_customers(fetch_field, start_date, end_date,
+                                                                    checkpoint=self._get_checkpoint(KEY_CUSTOMERS)),
+                                          write_customer)
+        return []
 
-    def download_events(self, param, fetch_field, start_date, end_date):
+    def get_order_transactions(self, order_id) -> List[dict]:
+        return list(self.client.get_order_transactions(order_id))
+
+    def download_events(self, selection: EventsSelection, fetch_field, start_date, end_date):
         headers = [
             "id",
             "subject_id",
@@ -299,56 +607,32 @@ class Component(KBCEnvHandler):
             "description",
             "path"
         ]
-        with ResultWriter(self.tables_out_path,
-                          KBCTableDef(name='events', pk=['id'],
-                                      columns=headers,
-                                      destination=''),
-                          fix_headers=True, flatten_objects=True, child_separator='__') as writer:
-
-            # iterate over types
-
-            types = self.parse_comma_separated_values(param['types'])
-            filters = param['filters']
-            if not types:
-                types = [None]
-            for t in types:
-                for o in self.client.get_events(fetch_field, start_date, end_date, filter_resource=filters,
-                                                event_type=t):
-                    writer.write(o)
+        with TableWriter(self.tables_out_path,
+                         KBCTableDef(name='events', pk=['id'],
+                                     columns=headers,
+                                     destination=''),
+                         fix_headers=True, child_separator='__', output_options=self._output_options,
+                         metrics=self.client.metrics) as writer:
+
+            def route_events(page):
+                # events of other verbs or resources returned by the shared scan
+                return [o for o in page if selection.matches(o)] or None
+
+            def write_events(page: FlattenedPage):
+                for o in page.records:
+                    self._track_watermark(KEY_EVENTS, o)
+                page.write()
+
+            # single scan for all selected resources and verbs
+            self._pipeline(KEY_EVENTS, transformations=[('route', route_events), ('flatten', writer.flatten_page)],
+                           batch_size=RESULTS_PER_PAGE).run(
+                self.client.get_events(fetch_field, start_date, end_date, filter_resource=selection.filters,
+                                       event_type=selection.verb, checkpoint=self._get_checkpoint(KEY_EVENTS)),
+                write_events)
 
         results = writer.collect_results()
         return results
 
-    @staticmethod
-    def _split_array_to_chunks(items: list, chunk_size: int):
-        """
-        Helper method to split items into chunks of specified size
-        Args:
-            items:
-            chunk_size:
-
-        Returns:
-
-        """
-        buffered = 0
-        buffer = []
-        for p in items:
-            buffered += 1
-            buffer.append(p)
-            if buffered >= chunk_size:
-                results = buffer.copy()
-                buffer = []
-                yield results
-        if buffer:
-            yield buffer
-
-    @staticmethod
-    def parse_comma_separated_values(param) -> List[str]:
-        cols = []
-        if param:
-            cols = [p.strip() for p in param.split(",")]
-        return cols
-
     @staticmethod
     def validate_api_token(token):
         try:
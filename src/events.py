@@ -0,0 +1,51 @@
+"""
+Selection of the downloaded events.
+"""
+from typing import List, Optional, Set, Tuple
+
+
+def _parse_verbs(types: str) -> Set[str]:
+    return {t.strip() for t in (types or '').split(',') if t.strip()}
+
+
+class EventsSelection:
+    """
+    Events selected by the configured blocks, each block selects its resource types (``filters``) and verbs
+    (``types``), empty means all. All blocks are downloaded in a single scan of the event history: the scan is
+    filtered by the API as far as all blocks allow (the API accepts a list of resource types but a single verb) and
+    the events are matched to the blocks on the client.
+    """
+
+    def __init__(self, blocks: List[dict]):
+        self.blocks: List[Tuple[Set[str], Set[str]]] = [(set(block.get('filters') or []),
+                                                         _parse_verbs(block.get('types')))
+                                                        for block in blocks]
+
+    @property
+    def filters(self) -> Optional[List[str]]:
+        """
+        Resource types requested from the API, None if any block selects all of them.
+        """
+        if not self.blocks or any(not filters for filters, _ in self.blocks):
+            return None
+        return sorted(set().union(*(filters for filters, _ in self.blocks)))
+
+    @property
+    def verb(self) -> Optional[str]:
+        """
+        Verb requested from the API, only when all blocks select the same single verb.
+        """
+        verbs = {frozenset(verbs) for _, verbs in self.blocks}
+        if len(verbs) == 1:
+            only = next(iter(verbs))
+            if len(only) == 1:
+                return next(iter(only))
+        return None
+
+    def matches(self, event: dict) -> bool:
+        subject_type = event.get('subject_type')
+        verb = event.get('verb')
+        for filters, verbs in self.blocks:
+            if (not filters or subject_type in filters) and (not verbs or verb in verbs):
+                return True
+        return False
@@ -0,0 +1,203 @@
+"""
+Incremental sync helpers, the values are persisted in the state file between runs.
+"""
+import datetime
+from typing import Optional
+
+KEY_WATERMARKS = 'watermarks'
+KEY_CURSORS = 'cursors'
+KEY_CHECKPOINTS = 'checkpoints'
+
+# the next run starts this much before the watermark, so records updated while the last run was paging aren't missed
+WATERMARK_OVERLAP = datetime.timedelta(minutes=10)
+
+
+def parse_datetime(value: str) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    # bulk operation results use the Z suffix which fromisoformat doesn't accept before python 3.11
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def as_aware(value: datetime.datetime) -> datetime.datetime:
+    """
+    Returns timezone aware datetime, naive datetime (e.g. of the configured period) is in the local time.
+    """
+    return value if value.tzinfo else value.astimezone()
+
+
+class Watermark:
+    """
+    Tracks the max value of a datetime field (e.g. ``updated_at``) of the records that were actually downloaded.
+    Values are compared as instants, the original value including the shop offset is kept.
+    """
+
+    def __init__(self, field: str, value: str = None):
+        self.field = field
+        self.value = value
+        self._max = parse_datetime(value)
+
+    def track(self, record: dict):
+        value = record.get(self.field)
+        parsed = parse_datetime(value)
+        if parsed and parsed.tzinfo and (self._max is None or parsed > self._max):
+            self._max = parsed
+            self.value = value
+
+    def get_resume_date(self, overlap: datetime.timedelta = WATERMARK_OVERLAP) -> Optional[datetime.datetime]:
+        """
+        Returns: Timezone aware datetime the next run starts from, None if no records were seen yet.
+        """
+        if self._max is None:
+            return None
+        return self._max - overlap
+
+
+def load_watermark(state: dict, endpoint: str, field: str) -> Watermark:
+    """
+    Returns the watermark stored in the state, watermark of a different field is ignored.
+    """
+    stored = state.get(KEY_WATERMARKS, {}).get(endpoint, {})
+    if stored.get('field') != field:
+        return Watermark(field)
+    return Watermark(field, stored.get('value'))
+
+
+def store_watermark(state: dict, endpoint: str, watermark: Watermark):
+    if watermark.value:
+        state.setdefault(KEY_WATERMARKS, {})[endpoint] = {'field': watermark.field, 'value': watermark.value}
+
+
+class IdCursor:
+    """
+    Tracks the max id of the downloaded records, the next run downloads only the records with a higher id
+    (``since_id``). ``refreshed_at`` is the time of the last download without the cursor.
+    """
+
+    def __init__(self, value: int = None, refreshed_at: str = None):
+        self.value = value
+        self.refreshed_at = refreshed_at
+
+    def track(self, record: dict):
+        value = record.get('id')
+        if isinstance(value, int) and (self.value is None or value > self.value):
+            self.value = value
+
+    def is_refresh_due(self, full_refresh_interval: Optional[datetime.timedelta]) -> bool:
+        """
+        Returns True if all records should be downloaded, because there is no cursor yet or the full refresh
+        interval elapsed since the last full download.
+        """
+        if self.value is None:
+            return True
+        if not full_refresh_interval:
+            return False
+        refreshed_at = parse_datetime(self.refreshed_at)
+        if refreshed_at is None:
+            return True
+        return datetime.datetime.now(datetime.timezone.utc) - refreshed_at >= full_refresh_interval
+
+    def mark_refreshed(self):
+        self.refreshed_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def load_id_cursor(state: dict, endpoint: str) -> IdCursor:
+    stored = state.get(KEY_CURSORS, {}).get(endpoint, {})
+    return IdCursor(stored.get('since_id'), stored.get('refreshed_at'))
+
+
+def store_id_cursor(state: dict, endpoint: str, cursor: IdCursor):
+    if cursor.value is not None:
+        state.setdefault(KEY_CURSORS, {})[endpoint] = {'since_id': cursor.value, 'refreshed_at': cursor.refreshed_at}
+
+
+class WindowCheckpoint:
+    """
+    Tracks the date windows of an endpoint that were downloaded completely. The windows may complete out of order,
+    ``completed_until`` is the end of the windows completed without a gap since the start of the period. When the
+    download is interrupted, the checkpoint is stored and the next run continues from it instead of the period start.
+    """
+
+    def __init__(self, field: str, period_start: str = None, completed_until: str = None):
+        self.field = field
+        self.period_start = parse_datetime(period_start)
+        self.completed_until = parse_datetime(completed_until)
+        self.error: Optional[Exception] = None
+        self._started_at: Optional[datetime.datetime] = None
+        self._pending = []
+
+    def get_resume_date(self, start_date: datetime.datetime,
+                        end_date: datetime.datetime) -> Optional[datetime.datetime]:
+        """
+        Returns: Timezone aware datetime the download of the period continues from, None if there is no checkpoint
+        within the period or the period starts before the interrupted one (e.g. a longer backfill was configured).
+        """
+        if self.period_start is None or self.completed_until is None:
+            return None
+        completed_until = as_aware(self.completed_until)
+        if as_aware(start_date) < as_aware(self.period_start) \
+                or not as_aware(start_date) < completed_until < as_aware(end_date):
+            return None
+        return completed_until
+
+    def start(self, datetime_min: datetime.datetime):
+        """
+        Start tracking the windows from the start of the download, the period start of a resumed download is kept.
+        """
+        resumed = self.period_start is not None and self.completed_until is not None \
+            and as_aware(datetime_min) == as_aware(self.completed_until)
+        if not resumed:
+            self.period_start = datetime_min
+        self._started_at = datetime_min
+        self.completed_until = datetime_min
+        self.error = None
+        self._pending = []
+
+    def complete(self, window: tuple):
+        self._pending.append(window)
+        self._pending.sort()
+        while self._pending and self._pending[0][0] <= self.completed_until:
+            self.completed_until = max(self.completed_until, self._pending.pop(0)[1])
+
+    @property
+    def has_progress(self) -> bool:
+        """
+        True if a window was completed since the start of this download.
+        """
+        return self._started_at is not None and self.completed_until > self._started_at
+
+    def interrupt(self, error: Exception):
+        self.error = error
+
+    @property
+    def interrupted(self) -> bool:
+        return self.error is not None
+
+
+def load_window_checkpoint(state: dict, endpoint: str, field: str) -> WindowCheckpoint:
+    """
+    Returns the checkpoint of the interrupted last run stored in the state, checkpoint of a different field is ignored.
+    """
+    stored = state.get(KEY_CHECKPOINTS, {}).get(endpoint, {})
+    if stored.get('field') != field:
+        return WindowCheckpoint(field)
+    return WindowCheckpoint(field, stored.get('period_start'), stored.get('completed_until'))
+
+
+def store_window_checkpoint(state: dict, endpoint: str, checkpoint: WindowCheckpoint):
+    """
+    Stores the checkpoint of an interrupted download, the checkpoint of a completed download is removed.
+    """
+    checkpoints = state.setdefault(KEY_CHECKPOINTS, {})
+    if checkpoint.interrupted:
+        checkpoints[endpoint] = {'field': checkpoint.field, 'period_start': checkpoint.period_start.isoformat(),
+                                 'completed_until': checkpoint.completed_until.isoformat()}
+    else:
+        checkpoints.pop(endpoint, None)
+    if not checkpoints:
+        del state[KEY_CHECKPOINTS]
@@ -0,0 +1,151 @@
+"""
+Inventory of the downloaded products.
+"""
+import datetime
+import hashlib
+import json
+from typing import Callable, Dict, Iterable, List
+
+from incremental import parse_datetime
+from shopify_cli import MAX_INVENTORY_ITEM_IDS, MAX_INVENTORY_LEVEL_ITEM_IDS, ShopifyClient, TaskPool
+
+KEY_INVENTORY_CACHE = 'inventory_cache'
+
+DEFAULT_FULL_REFRESH_INTERVAL = datetime.timedelta(days=7)
+# max number of variant hashes kept in the state file, the least recently seen are dropped first
+MAX_CACHED_VARIANTS = 100000
+
+
+def _variant_hash(variant: dict) -> str:
+    content = json.dumps(variant, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+
+class InventoryCache:
+    """
+    Content hashes of the product variants whose inventory was downloaded, keyed by the inventory item id, ordered
+    from the least recently seen. Persisted in the state file.
+
+    The inventory of a variant is downloaded again only when the variant changed (e.g. its sku or
+    ``inventory_quantity``). The cache is dropped once the full refresh interval elapses, so changes not visible on
+    the variant (e.g. stock moved between locations) are picked up then. Only the ``max_variants`` most recently seen
+    variants are kept, the inventory of the dropped ones (e.g. deleted variants) is downloaded when they are seen again.
+    """
+
+    def __init__(self, refreshed_at: str = None, variants: Dict[str, str] = None,
+                 max_variants: int = MAX_CACHED_VARIANTS):
+        self.refreshed_at = refreshed_at or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.max_variants = max_variants
+        self.variants: Dict[str, str] = {}
+        for inventory_item_id, content_hash in list((variants or {}).items())[-max_variants:]:
+            self.variants[inventory_item_id] = content_hash
+        self.skipped = 0
+
+    def is_changed(self, variant: dict) -> bool:
+        """
+        Returns True if the inventory of the variant needs to be downloaded, the new hash is remembered.
+        """
+        inventory_item_id = str(variant['inventory_item_id'])
+        content_hash = _variant_hash(variant)
+        # moved to the end as the most recently seen
+        cached_hash = self.variants.pop(inventory_item_id, None)
+        self.variants[inventory_item_id] = content_hash
+        if cached_hash == content_hash:
+            self.skipped += 1
+            return False
+        if len(self.variants) > self.max_variants:
+            del self.variants[next(iter(self.variants))]
+        return True
+
+    def to_dict(self) -> dict:
+        return {'refreshed_at': self.refreshed_at, 'variants': self.variants}
+
+
+def load_inventory_cache(state: dict,
+                         full_refresh_interval: datetime.timedelta = DEFAULT_FULL_REFRESH_INTERVAL) -> InventoryCache:
+    """
+    Returns the cache stored in the state, empty cache if there is none or the full refresh is due.
+    """
+    stored = state.get(KEY_INVENTORY_CACHE) or {}
+    refreshed_at = parse_datetime(stored.get('refreshed_at'))
+    if not refreshed_at or datetime.datetime.now(datetime.timezone.utc) - refreshed_at >= full_refresh_interval:
+        return InventoryCache()
+    return InventoryCache(stored['refreshed_at'], stored.get('variants'))
+
+
+def store_inventory_cache(state: dict, cache: InventoryCache):
+    state[KEY_INVENTORY_CACHE] = cache.to_dict()
+
+
+class InventoryBatcher:
+    """
+    Accumulates ids and submits a fetch for every full batch, so the batches are not limited by the chunks the ids
+    arrive in. The results are written by the caller thread.
+    """
+
+    def __init__(self, pool: TaskPool, fetch: Callable[[List[str]], Iterable[dict]], writer, batch_size: int):
+        self.pool = pool
+        self.fetch = fetch
+        self.writer = writer
+        self.batch_size = batch_size
+        self.requests = 0
+        self._ids = []
+
+    def add(self, ids: List[str]):
+        self._ids.extend(ids)
+        while len(self._ids) >= self.batch_size:
+            self._submit(self._ids[:self.batch_size])
+            self._ids = self._ids[self.batch_size:]
+
+    def flush(self):
+        if self._ids:
+            self._submit(self._ids)
+            self._ids = []
+
+    def _submit(self, ids: List[str]):
+        self.requests += 1
+        self.pool.submit(self._fetch_batch, ids)
+
+    def _fetch_batch(self, ids: List[str]):
+        return self.writer, list(self.fetch(ids))
+
+
+class InventoryCollector:
+    """
+    Collects the inventory item ids of the product variants across the product chunks and fetches the inventory
+    items and levels in batches of the max size accepted by the API. The fetches run on the task pool while the
+    products are paged.
+    """
+
+    def __init__(self, client: ShopifyClient, pool: TaskPool, items_writer, levels_writer,
+                 items_batch_size: int = MAX_INVENTORY_ITEM_IDS,
+                 levels_batch_size: int = MAX_INVENTORY_LEVEL_ITEM_IDS,
+                 cache: InventoryCache = None):
+        self.pool = pool
+        self.cache = cache
+        self.items = InventoryBatcher(pool, client.get_inventory_items, items_writer, items_batch_size)
+        self.levels = InventoryBatcher(pool, client.get_inventory_item_levels, levels_writer, levels_batch_size)
+
+    def add(self, variants: List[dict]):
+        """
+        Add the variants of the next products and write the already fetched inventory.
+        """
+        if self.cache:
+            variants = [v for v in variants if self.cache.is_changed(v)]
+        inventory_ids = [str(v['inventory_item_id']) for v in variants]
+        self.items.add(inventory_ids)
+        self.levels.add(inventory_ids)
+        for writer, records in self.pool.completed():
+            self._write(writer, records)
+
+    def finish(self):
+        """
+        Fetch the remaining ids and write all the inventory.
+        """
+        self.items.flush()
+        self.levels.flush()
+        for writer, records in self.pool.drain():
+            self._write(writer, records)
+
+    def _write(self, writer, records: List[dict]):
+        writer.write_all(records)
@@ -0,0 +1,186 @@
+"""
+Performance metrics of the run, per endpoint and per table.
+
+The requests are recorded by the metered connection of the client per endpoint, the API path with the ids replaced
+(e.g. ``orders/{id}/transactions``). Waits for the API call limit and retry backoffs are attributed to an endpoint by
+the thread they happen in: a call limit wait to the next request of the thread, a backoff to the request that failed.
+The table writers record their rows on close and the pipelines the items and busy time of their stages, e.g. the
+fetch, flatten and write stage of an endpoint. The metrics are logged and optionally written as a JSON file to the
+output files, so a slow run can be told throttled, network-bound or CPU-bound.
+"""
+import json
+import logging
+import math
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from typing import Dict, List
+
+METRICS_FILE_NAME = 'shopify_metrics.json'
+
+UNKNOWN_ENDPOINT = 'unknown'
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+_API_PREFIX = re.compile(r'^.*?/admin/(api/[^/]+/)?')
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def get_endpoint(url: str) -> str:
+    """
+    Returns the endpoint of a request URL, e.g. ``orders/{id}/transactions`` for
+    ``https://shop.myshopify.com/admin/api/2022-10/orders/1/transactions.json?limit=250``.
+    """
+    path = _API_PREFIX.sub('', urllib.parse.urlsplit(url).path).lstrip('/')
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    return _ID_SEGMENT.sub('/{id}', path).lstrip('/') or UNKNOWN_ENDPOINT
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of the sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class EndpointMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes_received = 0
+        self.latencies: List[float] = []
+        self.status_codes = Counter()
+        self.backoff_time = 0.0
+        self.limit_wait_time = 0.0
+
+    @property
+    def throttled(self) -> int:
+        return self.status_codes[429]
+
+    @property
+    def server_errors(self) -> int:
+        return sum(count for status, count in self.status_codes.items() if 500 <= status < 600)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        latency_ms = {f'p{p}': round(percentile(latencies, p) * 1000, 1) for p in LATENCY_PERCENTILES}
+        latency_ms['max'] = round(latencies[-1] * 1000, 1) if latencies else 0.0
+        return {'requests': self.requests,
+                'bytes_received': self.bytes_received,
+                'latency_ms': latency_ms,
+                'status_codes': {str(status): count for status, count in sorted(self.status_codes.items())},
+                'throttled': self.throttled,
+                'server_errors': self.server_errors,
+                'backoff_s': round(self.backoff_time, 3),
+                'limit_wait_s': round(self.limit_wait_time, 3)}
+
+
+class TableMetrics:
+
+    def __init__(self):
+        self.rows = 0
+        self.write_time = 0.0
+
+    def to_dict(self) -> dict:
+        return {'rows': self.rows,
+                'write_s': round(self.write_time, 3),
+                'rows_per_s': round(self.rows / self.write_time, 1) if self.write_time else None}
+
+
+class RunMetrics:
+    """
+    Thread safe collector of the run metrics.
+    """
+
+    def __init__(self):
+        self.endpoints: Dict[str, EndpointMetrics] = {}
+        self.tables: Dict[str, TableMetrics] = {}
+        # pipeline -> stage -> stats
+        self.pipelines: Dict[str, Dict[str, dict]] = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        # endpoint of the last request and the call limit wait before the next one, per thread
+        self._local = threading.local()
+
+    def record_request(self, url: str, status: int, latency: float, bytes_received: int):
+        endpoint = get_endpoint(url)
+        limit_wait_time = getattr(self._local, 'limit_wait_time', 0.0)
+        self._local.limit_wait_time = 0.0
+        self._local.endpoint = endpoint
+        with self._lock:
+            metrics = self.endpoints.get(endpoint) or self.endpoints.setdefault(endpoint, EndpointMetrics())
+            metrics.requests += 1
+            metrics.bytes_received += bytes_received
+            metrics.latencies.append(latency)
+            metrics.status_codes[status] += 1
+            metrics.limit_wait_time += limit_wait_time
+
+    def record_limit_wait(self, wait_time: float):
+        """
+        Wait for the API call limit, counted to the next request of the current thread.
+        """
+        self._local.limit_wait_time = getattr(self._local, 'limit_wait_time', 0.0) + wait_time
+
+    def record_backoff(self, wait_time: float):
+        """
+        Backoff before a retry, counted to the last (failed) request of the current thread.
+        """
+        endpoint = getattr(self._local, 'endpoint', UNKNOWN_ENDPOINT)
+        with self._lock:
+            metrics = self.endpoints.get(endpoint) or self.endpoints.setdefault(endpoint, EndpointMetrics())
+            metrics.backoff_time += wait_time
+
+    def record_table(self, table: str, rows: int, write_time: float):
+        with self._lock:
+            metrics = self.tables.get(table) or self.tables.setdefault(table, TableMetrics())
+            metrics.rows += rows
+            metrics.write_time = max(metrics.write_time, write_time)
+
+    def record_pipeline(self, name: str, stages: list):
+        """
+        Records the StageStats of a finished pipeline.
+        """
+        with self._lock:
+            self.pipelines[name] = {stage.name: {'items': stage.items,
+                                                 'busy_s': round(stage.busy_time, 3),
+                                                 'items_per_s': round(stage.throughput, 1)}
+                                    for stage in stages}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            endpoints = {endpoint: m.to_dict() for endpoint, m in sorted(self.endpoints.items())}
+            tables = {table: m.to_dict() for table, m in sorted(self.tables.items())}
+            pipelines = dict(self.pipelines)
+        return {'elapsed_s': round(time.monotonic() - self._started, 3),
+                'requests': sum(e['requests'] for e in endpoints.values()),
+                'bytes_received': sum(e['bytes_received'] for e in endpoints.values()),
+                'throttled': sum(e['throttled'] for e in endpoints.values()),
+                'server_errors': sum(e['server_errors'] for e in endpoints.values()),
+                'backoff_s': round(sum(e['backoff_s'] for e in endpoints.values()), 3),
+                'limit_wait_s': round(sum(e['limit_wait_s'] for e in endpoints.values()), 3),
+                'rows': sum(t['rows'] for t in tables.values()),
+                'endpoints': endpoints,
+                'tables': tables,
+                'pipelines': pipelines}
+
+    def log_summary(self):
+        for endpoint, m in self.to_dict()['endpoints'].items():
+            logging.info(f"Endpoint {endpoint}: {m['requests']} requests, {m['bytes_received'] / 1024 / 1024:.1f} MB, "
+                         f"latency p50 {m['latency_ms']['p50']:.0f} ms / p99 {m['latency_ms']['p99']:.0f} ms, "
+                         f"{m['throttled']} throttled, {m['server_errors']} server errors, "
+                         f"{m['backoff_s']:.1f}s backoff, {m['limit_wait_s']:.1f}s call limit wait")
+
+    def write(self, path: str):
+        """
+        Writes the metrics as JSON with a file manifest.
+        """
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+        with open(f'{path}.manifest', 'w') as manifest:
+            json.dump({'is_permanent': False, 'tags': ['shopify', 'metrics']}, manifest)
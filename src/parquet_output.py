@@ -0,0 +1,95 @@
+"""
+Parquet output of the result tables.
+
+The column types are resolved from the values seen in the run together with the example responses in the schema
+folder, so a column keeps its type even in runs where all its values are empty. Columns with mixed or nested values
+are written as strings. Rows are converted in record batches of bounded size.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Set
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+# rows converted and written at once, bounds the memory used by the writer
+DEFAULT_BATCH_SIZE = 10000
+
+NONE_TYPE = type(None)
+
+
+def is_available() -> bool:
+    return pyarrow is not None
+
+
+def resolve_type(observed: Set[type]):
+    """
+    Returns the Arrow type of a column with the given python types of values.
+    """
+    types = observed - {NONE_TYPE}
+    if types == {bool}:
+        return pyarrow.bool_()
+    if types == {int}:
+        return pyarrow.int64()
+    if types and types <= {int, float}:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def _to_string(value):
+    if value is None or type(value) is str:
+        return value
+    if type(value) in (list, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+def write_parquet(path: str, columns: List[str], column_types: Dict[str, Set[type]], rows: Iterable[list],
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Writes the rows (lists of values in the order of the columns) to a Parquet file.
+
+    Args:
+        path: Output file path
+        columns: Column names
+        column_types: Column -> python types of its values, including the types of the schema examples
+        rows: Rows to write
+        batch_size: Number of rows converted at once
+
+    Returns: Number of rows written
+    """
+    schema = pyarrow.schema([(column, resolve_type(column_types.get(column, set()))) for column in columns])
+    string_columns = [i for i, field in enumerate(schema) if field.type == pyarrow.string()]
+
+    written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                written += _write_batch(writer, schema, string_columns, batch)
+                batch = []
+        if batch:
+            written += _write_batch(writer, schema, string_columns, batch)
+    return written
+
+
+def _write_batch(writer, schema, string_columns: List[int], batch: List[list]) -> int:
+    values = [list(column) for column in zip(*batch)]
+    for i in string_columns:
+        values[i] = [_to_string(value) for value in values[i]]
+    arrays = [pyarrow.array(column, type=field.type) for column, field in zip(values, schema)]
+    writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+    return len(batch)
+
+
+def write_file_manifest(path: str, tags: List[str]):
+    with open(f'{path}.manifest', 'w') as manifest:
+        json.dump({'is_permanent': False, 'tags': tags}, manifest)
+
+
+def parquet_path(files_path: str, file_name: str) -> str:
+    return os.path.join(files_path, f'{os.path.splitext(file_name)[0]}.parquet')
@@ -0,0 +1,205 @@
+"""
+Staged extraction pipeline.
+
+The fetch stage (HTTP requests and decoding of the responses) runs in its own thread, so the network waits overlap
+with the CPU work of the transformations and the writers. Stages are connected by bounded queues, the writer stage
+runs in the calling thread because the result writers are not thread safe. The records may be passed between the
+stages in page-sized batches, so the queues are not synchronized for each record.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Tuple
+
+# max number of items waiting between two stages
+DEFAULT_QUEUE_SIZE = 1000
+
+# interval the blocked stages check whether the pipeline was stopped
+STOP_CHECK_INTERVAL = 0.5
+
+_END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class StageStats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        # time spent by the stage itself, without the waits for the neighbouring stages
+        self.busy_time = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.busy_time if self.busy_time else 0.0
+
+    def __str__(self):
+        return f'{self.name} {self.items} items in {self.busy_time:.1f}s ({self.throughput:.1f}/s)'
+
+
+class Pipeline:
+    """
+    Runs ``source -> transformations -> sink``, each transformation in its own thread.
+
+    Example:
+        Pipeline('orders', thread_initializer=client.activate_session).run(client.get_orders(...), writer.write)
+    """
+
+    def __init__(self, name: str, transformations: List[Tuple[str, Callable]] = None,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, thread_initializer: Callable = None, metrics=None,
+                 batch_size: int = None):
+        """
+
+        Args:
+            name: Name used in the logs
+            transformations: List of (stage name, function) applied to each item, returning None drops the item
+            queue_size: Max number of items waiting between two stages
+            thread_initializer: Called at the start of each stage thread, e.g. to activate the Shopify session
+            metrics: RunMetrics the stage stats are recorded in
+            batch_size: Group the items of the source to lists of this size (e.g. a page of records), which are passed
+                        to the transformations and the sink instead of the single items. The transformations have to
+                        return sized batches too, the stages count the items of the batches.
+        """
+        self.name = name
+        self.transformations = transformations or []
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.thread_initializer = thread_initializer
+        self.metrics = metrics
+        self.stats: List[StageStats] = []
+
+        self._stopped = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def run(self, source: Iterable, sink: Callable):
+        """
+        Consume the source and pass all items through the transformations to the sink.
+        The first exception raised by any stage stops the pipeline and is re-raised.
+        """
+        fetch_stats = StageStats('fetch')
+        self.stats = [fetch_stats]
+        # the queues hold about the same number of items when batched
+        queue_size = max(1, self.queue_size // self.batch_size) if self.batch_size else self.queue_size
+        queues = [queue.Queue(queue_size)]
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0], fetch_stats),
+                                    name=f'{self.name}-fetch', daemon=True)]
+
+        for stage_name, fnc in self.transformations:
+            stats = StageStats(stage_name)
+            self.stats.append(stats)
+            queues.append(queue.Queue(queue_size))
+            threads.append(threading.Thread(target=self._run_transformation,
+                                            args=(fnc, queues[-2], queues[-1], stats),
+                                            name=f'{self.name}-{stage_name}', daemon=True))
+
+        write_stats = StageStats('write')
+        self.stats.append(write_stats)
+
+        for t in threads:
+            t.start()
+        try:
+            self._run_sink(sink, queues[-1], write_stats)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._stopped.set()
+            for t in threads:
+                t.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        logging.info(f'{self.name} pipeline: ' + ', '.join(str(s) for s in self.stats))
+        if self.metrics:
+            self.metrics.record_pipeline(self.name, self.stats)
+
+    def _fail(self, error: BaseException):
+        if not isinstance(error, PipelineStopped):
+            self._errors.append(error)
+        self._stopped.set()
+
+    def _put(self, output: queue.Queue, item):
+        while True:
+            if self._stopped.is_set():
+                raise PipelineStopped()
+            try:
+                output.put(item, timeout=STOP_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, input_queue: queue.Queue):
+        while True:
+            if self._stopped.is_set():
+                raise PipelineStopped()
+            try:
+                return input_queue.get(timeout=STOP_CHECK_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _count(self, item) -> int:
+        return len(item) if self.batch_size else 1
+
+    def _initialize_thread(self):
+        if self.thread_initializer:
+            self.thread_initializer()
+
+    def _run_source(self, source: Iterable, output: queue.Queue, stats: StageStats):
+        iterator = iter(source)
+        batch = []
+        try:
+            self._initialize_thread()
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, _END)
+                stats.busy_time += time.perf_counter() - start
+                if item is _END:
+                    break
+                stats.items += 1
+                if not self.batch_size:
+                    self._put(output, item)
+                    continue
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._put(output, batch)
+                    batch = []
+            if batch:
+                self._put(output, batch)
+            self._put(output, _END)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            # release the resources of generators that were stopped early, e.g. the window task pools
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def _run_transformation(self, fnc: Callable, input_queue: queue.Queue, output: queue.Queue, stats: StageStats):
+        try:
+            self._initialize_thread()
+            while True:
+                item = self._get(input_queue)
+                if item is _END:
+                    break
+                start = time.perf_counter()
+                result = fnc(item)
+                stats.busy_time += time.perf_counter() - start
+                stats.items += self._count(item)
+                if result is not None:
+                    self._put(output, result)
+            self._put(output, _END)
+        except BaseException as e:
+            self._fail(e)
+
+    def _run_sink(self, sink: Callable, input_queue: queue.Queue, stats: StageStats):
+        while True:
+            item = self._get(input_queue)
+            if item is _END:
+                return
+            start = time.perf_counter()
+            sink(item)
+            stats.busy_time += time.perf_counter() - start
+            stats.items += self._count(item)
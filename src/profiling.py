@@ -0,0 +1,126 @@
+"""
+Profiling mode of the run.
+
+Each phase of the run (e.g. the download of an endpoint) is profiled by cProfile, including the threads started
+during the phase like the fetch stages of the pipelines and the background pools, and its memory allocations are
+traced by tracemalloc. The reports of each phase are written to the output files:
+
+- ``profile_<phase>.prof`` - cProfile stats of all threads, e.g. for ``python -m pstats`` or snakeviz
+- ``profile_<phase>_cpu.txt`` - functions with the highest cumulative and own time
+- ``profile_<phase>_memory.txt`` - peak traced memory and the lines that allocated the most memory in the phase
+
+Both profilers slow the run down considerably, tracemalloc the most.
+"""
+import cProfile
+import contextlib
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import List
+
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 30
+# stack frames kept per traced allocation, more frames cost more memory and time
+TRACEMALLOC_FRAMES = 5
+
+# since Python 3.12 cProfile profiles all threads, before that each thread needs its own profiler
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+_IGNORED_TRACES = (tracemalloc.Filter(False, tracemalloc.__file__),
+                   tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                   tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+                   tracemalloc.Filter(False, '<unknown>'))
+
+
+class PhaseProfiler:
+    """
+    Profiles the phases of the run one at a time and writes their reports to the output folder.
+
+    Example:
+        with profiler.profile('orders'):
+            download_orders()
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._thread_profiles: List[cProfile.Profile] = []
+
+    @contextlib.contextmanager
+    def profile(self, phase: str):
+        """
+        Profile the enclosed phase, the reports are written also when the phase fails.
+        """
+        logging.info(f'Profiling the {phase} phase')
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        start_snapshot = tracemalloc.take_snapshot()
+
+        self._thread_profiles = []
+        if PER_THREAD_PROFILERS:
+            threading.setprofile(self._profile_thread)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            threading.setprofile(None)
+            _, peak = tracemalloc.get_traced_memory()
+            end_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            self._write_cpu_reports(phase, elapsed, [profile] + self._thread_profiles)
+            self._write_memory_report(phase, peak, start_snapshot, end_snapshot)
+
+    def _profile_thread(self, frame, event, arg):
+        # first profiling event of a thread started in the phase, the profiler replaces this function in the thread
+        profile = cProfile.Profile()
+        with self._lock:
+            self._thread_profiles.append(profile)
+        profile.enable()
+
+    def _write_cpu_reports(self, phase: str, elapsed: float, profiles: List[cProfile.Profile]):
+        stream = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=stream)
+        stream.write(f'Phase {phase}: {elapsed:.1f}s wall time, {len(profiles)} profiled threads\n\n')
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+
+        stats_path = self._path(f'profile_{phase}.prof')
+        stats.dump_stats(stats_path)
+        self._write_manifest(stats_path)
+        self._write_text(f'profile_{phase}_cpu.txt', stream.getvalue())
+
+    def _write_memory_report(self, phase: str, peak: int, start_snapshot: tracemalloc.Snapshot,
+                             end_snapshot: tracemalloc.Snapshot):
+        differences = end_snapshot.filter_traces(_IGNORED_TRACES).compare_to(
+            start_snapshot.filter_traces(_IGNORED_TRACES), 'lineno')
+        allocated = sorted((d for d in differences if d.size_diff > 0), key=lambda d: d.size_diff, reverse=True)
+
+        lines = [f'Phase {phase}: peak traced memory {peak / 1024 / 1024:.1f} MB',
+                 f'Top {TOP_ALLOCATIONS} lines by memory allocated in the phase and not freed by its end:', '']
+        lines.extend(str(d) for d in allocated[:TOP_ALLOCATIONS])
+        self._write_text(f'profile_{phase}_memory.txt', '\n'.join(lines) + '\n')
+        logging.info(f'Profiled the {phase} phase, peak traced memory {peak / 1024 / 1024:.1f} MB')
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.output_dir, file_name)
+
+    def _write_text(self, file_name: str, text: str):
+        path = self._path(file_name)
+        with open(path, 'w') as report:
+            report.write(text)
+        self._write_manifest(path)
+
+    @staticmethod
+    def _write_manifest(path: str):
+        with open(f'{path}.manifest', 'w') as manifest:
+            json.dump({'is_permanent': False, 'tags': ['shopify', 'profiling']}, manifest)
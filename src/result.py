@@ -1,46 +1,504 @@
-from kbc.result import ResultWriter, KBCTableDef
+import csv
+import functools
+import gzip
+import io
+import json
+import logging
+import marshal
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from kbc.result import ResultWriter, KBCTableDef, KBCResult
+
+import parquet_output
+from incremental import parse_datetime
+from metrics import RunMetrics
 
 EXTRACTION_TIME = 'extraction_time'
 
 KEY_ROW_NR = 'row_nr'
 
+# gzip level of the compressed slices, a good ratio at a fraction of the time of the maximum level
+SLICE_COMPRESS_LEVEL = 6
+
+# number of customer ids indexed in memory, the rest is looked up in the on-disk store
+CUSTOMERS_INDEX_LIMIT = 200000
+
+SCHEMA_DIR = Path(__file__).resolve().parent.parent.joinpath('schema')
+
+# table -> example API response in the schema folder and path of the objects written to the table
+SCHEMA_SAMPLES = {
+    'order': ('order.json', 'orders'),
+    'line_item': ('order.json', 'orders.line_items'),
+    'line_item_discount_allocations': ('order.json', 'orders.line_items.discount_allocations'),
+    'line_item_tax_lines': ('order.json', 'orders.line_items.tax_lines'),
+    'order_fulfillments': ('order.json', 'orders.fulfillments'),
+    'fulfillment_line_item': ('order.json', 'orders.fulfillments.line_items'),
+    'fulfillment_line_item_discount_allocations': ('order.json', 'orders.fulfillments.line_items.discount_allocations'),
+    'fulfillment_line_item_tax_lines': ('order.json', 'orders.fulfillments.line_items.tax_lines'),
+    'fulfillment_discount_allocations': ('order.json', 'orders.fulfillments.discount_applications'),
+    'fulfillment_tax_lines': ('order.json', 'orders.fulfillments.tax_lines'),
+    'order_discount_applications': ('order.json', 'orders.discount_applications'),
+    'order_discount_codes': ('order.json', 'orders.discount_codes'),
+    'order_tax_lines': ('order.json', 'orders.tax_lines'),
+    'product': ('products.json', 'products'),
+    'product_variant': ('products.json', 'products.variants'),
+    'product_variant_presentment_prices': ('products.json', 'products.variants.presentment_prices'),
+    'product_options': ('products.json', 'products.options'),
+    'product_images': ('products.json', 'products.images'),
+    'customer': ('customers.json', 'customers'),
+    'customer_addresses': ('customers.json', 'customers.addresses'),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_schema(file_name: str) -> dict:
+    with open(SCHEMA_DIR.joinpath(file_name)) as schema_file:
+        return json.load(schema_file)
+
+
+def get_schema_samples(table_name: str) -> List[dict]:
+    """
+    Returns the example objects of the table from the schema folder, empty list for tables without an example.
+    """
+    if table_name not in SCHEMA_SAMPLES:
+        return []
+    file_name, path = SCHEMA_SAMPLES[table_name]
+    try:
+        samples = [_load_schema(file_name)]
+    except FileNotFoundError:
+        return []
+
+    for key in path.split('.'):
+        values = [sample.get(key) for sample in samples if isinstance(sample, dict)]
+        samples = []
+        for value in values:
+            samples.extend(value if isinstance(value, list) else [value])
+    return [sample for sample in samples if isinstance(sample, dict)]
+
+
+def get_schema_types(table_name: str, separator: str = '__') -> Dict[str, Set[type]]:
+    """
+    Returns column -> python types of the values in the example objects of the table.
+    """
+    plan = FlattenPlan(separator)
+    types = {}
+    for sample in get_schema_samples(table_name):
+        for column, value in plan.flatten(sample).items():
+            types.setdefault(column, set()).add(type(value))
+    return types
+
+
+class FlattenPlan:
+    """
+    Flattens nested objects to rows, nested keys are joined by the separator (``{"a": {"b": 1}}`` -> ``a__b``).
+
+    Column names of the key paths are compiled once and kept in a tree of ``key -> (column, children)``, so a record
+    is projected to a row by plain dict lookups. The plan is seeded from example objects and extended whenever a new
+    key shows up. Produces the same rows as the generic flattening of the ResultWriter.
+    """
+
+    def __init__(self, separator: str = '__', samples: List[dict] = None):
+        self.separator = separator
+        self._root = {}
+        for sample in samples or []:
+            self.flatten(sample)
+
+    def flatten(self, obj: dict) -> dict:
+        row = {}
+        self._flatten(obj, self._root, '', row)
+        return row
+
+    def _flatten(self, obj: dict, node: dict, prefix: str, row: dict):
+        for key, value in obj.items():
+            entry = node.get(key)
+            if entry is None:
+                column = f'{prefix}{key}'
+                entry = node[key] = (column, {}, f'{column}{self.separator}')
+            if type(value) is dict:
+                self._flatten(value, entry[1], entry[2], row)
+            else:
+                row[entry[0]] = value
+
+
+class RowSpool:
+    """
+    Rows of a table kept in a temporary file until the full column set is known.
+
+    Each row is stored as marshalled ``(column positions, values)``, the column names are kept once in ``columns``.
+    New columns are appended in the order they first appear, after the initial ones. With ``track_types`` the python
+    types of the values of each column are collected in ``types``.
+    """
+
+    def __init__(self, columns: List[str], track_types: bool = False):
+        self.columns = list(columns)
+        self.rows = 0
+        self.types: List[Set[type]] = [set() for _ in self.columns] if track_types else None
+        self._positions = {column: position for position, column in enumerate(self.columns)}
+        self._file = tempfile.TemporaryFile()
+
+    def append(self, row: dict):
+        positions = self._positions
+        types = self.types
+        row_positions = []
+        for column in row:
+            position = positions.get(column)
+            if position is None:
+                position = positions[column] = len(self.columns)
+                self.columns.append(column)
+                if types is not None:
+                    types.append(set())
+            row_positions.append(position)
+        values = tuple(row.values())
+        if types is not None:
+            for position, value in zip(row_positions, values):
+                types[position].add(type(value))
+        marshal.dump((tuple(row_positions), values), self._file)
+        self.rows += 1
+
+    def __iter__(self):
+        self._file.seek(0)
+        columns = self.columns
+        while True:
+            try:
+                positions, values = marshal.load(self._file)
+            except EOFError:
+                return
+            yield {columns[position]: value for position, value in zip(positions, values)}
+
+    def iter_lists(self, columns: List[str]):
+        """
+        Yields the rows as lists of values in the order of the given columns, missing values are None.
+        """
+        self._file.seek(0)
+        mapping = [columns.index(column) for column in self.columns]
+        size = len(columns)
+        while True:
+            try:
+                positions, values = marshal.load(self._file)
+            except EOFError:
+                return
+            row = [None] * size
+            for position, value in zip(positions, values):
+                row[mapping[position]] = value
+            yield row
+
+    def close(self):
+        self._file.close()
+
+
+class SlicedCsvWriter:
+    """
+    Writes a table as a folder of headless CSV slices (``order.csv/part_0001.csv.gz``), each slice is closed once
+    it reaches the slice size. The size is measured on disk, after compression.
+    """
+
+    def __init__(self, path: str, slice_size: int, compress: bool = False):
+        self.path = path
+        self.slice_size = slice_size
+        self.compress = compress
+        self.slices = 0
+        self._raw = None
+        self._stream = None
+        self._writer = None
+        os.makedirs(path, exist_ok=True)
+
+    def _open_slice(self):
+        self.slices += 1
+        file_name = f'part_{self.slices:04d}.csv' + ('.gz' if self.compress else '')
+        self._raw = open(os.path.join(self.path, file_name), 'wb')
+        binary = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=SLICE_COMPRESS_LEVEL) \
+            if self.compress else self._raw
+        self._stream = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._stream)
+
+    def _close_slice(self):
+        # closes the gzip stream and the underlying file as well
+        self._stream.close()
+        if self.compress:
+            self._raw.close()
+        self._stream = self._writer = self._raw = None
+
+    def writerow(self, row: list):
+        if self._writer is None:
+            self._open_slice()
+        self._writer.writerow(row)
+        if self._raw.tell() >= self.slice_size:
+            self._close_slice()
+
+    def close(self):
+        if self._writer is not None:
+            self._close_slice()
+
+
+# tables of the order and product writers, the largest ones, written to File Storage with the 'parquet' output format
+PARQUET_TABLES = frozenset(['order', 'line_item', 'line_item_discount_allocations', 'line_item_tax_lines',
+                            'order_fulfillments', 'fulfillment_line_item', 'fulfillment_line_item_discount_allocations',
+                            'fulfillment_line_item_tax_lines', 'fulfillment_discount_allocations',
+                            'fulfillment_tax_lines', 'order_discount_applications', 'order_discount_codes',
+                            'order_tax_lines', 'product', 'product_variant', 'product_variant_presentment_prices',
+                            'product_options', 'product_images'])
+
+
+class OutputOptions:
+    """
+    Output settings shared by all table writers, set once by the component.
+    """
+
+    def __init__(self, one_pass_headers: bool = False, slice_size: int = 0, compress_slices: bool = False,
+                 output_format: str = 'csv', files_path: str = None):
+        """
+
+        Args:
+            one_pass_headers: Spool the rows and write each table once its full column set is known, instead of
+                              fixing the headers of the already written output.
+            slice_size: Write the tables as folders of headless slices of max this size in bytes, 0 writes a single
+                        CSV file. Sliced tables are always written in one pass.
+            compress_slices: gzip the slices
+            output_format: 'csv' tables or 'parquet' files of the ``PARQUET_TABLES``, the other tables are always
+                           written as CSV. Parquet files are always written in one pass.
+            files_path: Folder of the Parquet files
+        """
+        self.one_pass_headers = one_pass_headers or slice_size > 0
+        self.slice_size = slice_size
+        self.compress_slices = compress_slices
+        self.output_format = output_format
+        self.files_path = files_path
+
+    def is_parquet(self, table_name: str) -> bool:
+        return self.output_format == 'parquet' and table_name in PARQUET_TABLES
+
+
+# page of the thread flattening records without writing them, see TableWriter.flatten_page
+_flattening = threading.local()
+
+
+class FlattenedPage:
+    """
+    Rows of a page of records flattened by the TableWriters (including the child tables), not written yet. The page is
+    flattened in a pipeline transformation stage and written by ``write`` in the writer stage, the writers themselves
+    are not thread safe.
+    """
+
+    def __init__(self, records: list):
+        self.records = records
+        self._rows = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, writer: 'TableWriter', row: dict, *args):
+        self._rows.append((writer, row, args))
+
+    def write(self):
+        for writer, row, args in self._rows:
+            writer.write_row(row, *args)
+        self._rows = []
+
+
+class TableWriter(ResultWriter):
+    """
+    Result writer flattening the objects by a FlattenPlan of the table instead of the generic flattening.
+
+    With ``OutputOptions.one_pass_headers`` the rows are spooled and written on close, when all columns are known.
+    With ``OutputOptions.slice_size`` the spooled rows are written as headless slices, the results of the sliced
+    tables point to the folder of slices and need headless manifests. With the 'parquet' ``output_format`` the
+    ``PARQUET_TABLES`` are written as Parquet files with their own file manifests and have no table results.
+
+    With ``metrics`` set, the number of rows and the time from the first write to close are recorded on close.
+
+    The records of a page can be flattened by ``flatten_page`` in another thread than the one writing them.
+    """
 
-class LineItemWriter(ResultWriter):
-    def __init__(self, result_dir_path, extraction_time, additional_pk: list = None, prefix='', file_headers=None):
+    def __init__(self, result_dir_path, table_def: KBCTableDef, fix_headers=False, child_separator='__',
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
+        ResultWriter.__init__(self, result_dir_path, table_def, fix_headers=fix_headers, flatten_objects=False,
+                              child_separator=child_separator)
+        self.output_options = output_options or OutputOptions()
+        self.metrics = metrics
+        self.flatten_plan = FlattenPlan(child_separator, get_schema_samples(table_def.name))
+        self.parquet = self.output_options.is_parquet(table_def.name)
+        self.one_pass_headers = self.output_options.one_pass_headers or self.parquet
+        # columns added to the initial (state file) columns of the table
+        self.gained_columns: List[str] = []
+        self._spools: Dict[str, RowSpool] = {}
+        self._sliced_results: Dict[str, KBCResult] = {}
+        self.rows_written = 0
+        self._first_write_time = None
+
+    def flatten_page(self, records: list) -> FlattenedPage:
+        """
+        Flattens the records to rows of this writer and its child writers without writing them. The records are
+        shallow copied, the nested objects written to the child tables are kept, e.g. for the inventory of variants.
+        """
+        page = FlattenedPage(records)
+        _flattening.page = page
+        try:
+            for record in records:
+                self.write(dict(record))
+        finally:
+            _flattening.page = None
+        return page
+
+    def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
+        if not data:
+            return
+        row = self.flatten_plan.flatten(data)
+        page = getattr(_flattening, 'page', None)
+        if page is not None:
+            page.add(self, row, file_name, user_values, object_from_arrays, write_header)
+            return
+        self.write_row(row, file_name, user_values, object_from_arrays, write_header)
+
+    def write_row(self, row: dict, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
+        """
+        Writes the already flattened row.
+        """
+        if self._first_write_time is None:
+            self._first_write_time = time.monotonic()
+        self.rows_written += 1
+        if not self.one_pass_headers:
+            super().write(row, file_name, user_values, object_from_arrays, write_header)
+            return
+
+        if user_values:
+            row.update(user_values)
+        file_name = file_name or f'{self.table_def.name}.csv'
+        spool = self._spools.get(file_name)
+        if spool is None:
+            spool = self._spools[file_name] = RowSpool(self.table_def.columns,
+                                                       track_types=self.parquet)
+        spool.append(row)
+
+    def _write_spooled_rows(self):
+        spools, self._spools = self._spools, {}
+        if not spools:
+            return
+
+        columns = list(self.table_def.columns)
+        known = set(columns)
+        for spool in spools.values():
+            for column in spool.columns:
+                if column not in known:
+                    known.add(column)
+                    columns.append(column)
+        self.gained_columns = columns[len(self.table_def.columns):]
+        # all columns are known upfront, so the output is written once without fixing the headers
+        self.table_def.columns[:] = columns
+
+        rows = sum(spool.rows for spool in spools.values())
+        logging.info(f'Table {self.table_def.name}: {rows} rows, {len(self.gained_columns)} new columns'
+                     + (f' ({", ".join(self.gained_columns)})' if self.gained_columns else ''))
+
+        for file_name, spool in spools.items():
+            try:
+                if self.parquet:
+                    self._write_parquet(file_name, spool)
+                elif self.output_options.slice_size:
+                    self._write_slices(file_name, spool)
+                else:
+                    for row in spool:
+                        ResultWriter.write(self, row, file_name)
+            finally:
+                spool.close()
+
+    def _write_slices(self, file_name: str, spool: RowSpool):
+        path = os.path.join(self.result_dir_path, file_name)
+        writer = SlicedCsvWriter(path, self.output_options.slice_size, self.output_options.compress_slices)
+        try:
+            for row in spool.iter_lists(self.table_def.columns):
+                writer.writerow(row)
+        finally:
+            writer.close()
+        logging.info(f'Table {self.table_def.name} written in {writer.slices} slices')
+        self._sliced_results[file_name] = KBCResult(file_name, path, self.table_def)
+
+    def _write_parquet(self, file_name: str, spool: RowSpool):
+        column_types = get_schema_types(self.table_def.name, self.flatten_plan.separator)
+        for column, types in zip(spool.columns, spool.types):
+            column_types.setdefault(column, set()).update(types)
+
+        path = parquet_output.parquet_path(self.output_options.files_path, file_name)
+        rows = parquet_output.write_parquet(path, self.table_def.columns, column_types,
+                                            spool.iter_lists(self.table_def.columns))
+        parquet_output.write_file_manifest(path, tags=['shopify', self.table_def.name])
+        logging.info(f'Table {self.table_def.name} written to {os.path.basename(path)} ({rows} rows)')
+
+    def collect_results(self):
+        return super().collect_results() + list(self._sliced_results.values())
+
+    def close(self):
+        self._write_spooled_rows()
+        super().close()
+        if self.metrics and self._first_write_time is not None:
+            self.metrics.record_table(self.table_def.name, self.rows_written,
+                                      time.monotonic() - self._first_write_time)
+            # closed writers may be closed again
+            self._first_write_time = None
+
+
+class SynchronizedResultWriter(TableWriter):
+    """
+    Result writer shared by endpoints that are downloaded concurrently.
+    """
+
+    def __init__(self, *args, **kwargs):
+        TableWriter.__init__(self, *args, **kwargs)
+        self._lock = threading.RLock()
+
+    def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
+        with self._lock:
+            super().write(data, file_name, user_values, object_from_arrays, write_header)
+
+    def write_all(self, data_array, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
+        with self._lock:
+            super().write_all(data_array, file_name, user_values, object_from_arrays, write_header)
+
+
+class LineItemWriter(TableWriter):
+    def __init__(self, result_dir_path, extraction_time, additional_pk: list = None, prefix='', file_headers=None,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
         pk = ['id']
         if additional_pk:
             pk.extend(additional_pk)
         file_name = f'{prefix}line_item'
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=file_name, pk=pk, columns=file_headers.get(f'{file_name}.csv', []),
-                                          destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name=file_name, pk=pk, columns=file_headers.get(f'{file_name}.csv', []),
+                                         destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
 
         self.result_dir_path = result_dir_path
 
         # discount_allocations writer
-        self.discount_allocations_writer = ResultWriter(result_dir_path,
-                                                        KBCTableDef(name=f'{prefix}line_item_discount_allocations',
-                                                                    pk=[KEY_ROW_NR, 'line_item_id'],
-                                                                    columns=file_headers.get(
-                                                                        f'{prefix}line_item_discount_allocations.csv',
-                                                                        []),
-                                                                    destination=''),
-                                                        flatten_objects=True,
-                                                        fix_headers=True,
-                                                        child_separator='__')
+        self.discount_allocations_writer = TableWriter(result_dir_path,
+                                                       KBCTableDef(name=f'{prefix}line_item_discount_allocations',
+                                                                   pk=[KEY_ROW_NR, 'line_item_id'],
+                                                                   columns=file_headers.get(
+                                                                       f'{prefix}line_item_discount_allocations.csv',
+                                                                       []),
+                                                                   destination=''),
+                                                       fix_headers=True,
+                                                       child_separator='__',
+                                                       output_options=self.output_options, metrics=self.metrics)
         # tax_lines writer
-        self.tax_lines_writer = ResultWriter(result_dir_path,
-                                             KBCTableDef(name=f'{prefix}line_item_tax_lines',
-                                                         pk=[KEY_ROW_NR, 'line_item_id'],
-                                                         columns=file_headers.get(
-                                                             f'{prefix}line_item_tax_lines.csv',
-                                                             []),
-                                                         destination=''),
-                                             flatten_objects=True,
-                                             fix_headers=True,
-                                             child_separator='__')
+        self.tax_lines_writer = TableWriter(result_dir_path,
+                                            KBCTableDef(name=f'{prefix}line_item_tax_lines',
+                                                        pk=[KEY_ROW_NR, 'line_item_id'],
+                                                        columns=file_headers.get(
+                                                            f'{prefix}line_item_tax_lines.csv',
+                                                            []),
+                                                        destination=''),
+                                            fix_headers=True,
+                                            child_separator='__',
+                                            output_options=self.output_options, metrics=self.metrics)
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
         # flatten obj
@@ -71,45 +529,48 @@ class LineItemWriter(ResultWriter):
         super().close()
 
 
-class FulfillmentsWriter(ResultWriter):
-    def __init__(self, result_dir_path, extraction_time, additional_pk: list = None, prefix='', file_headers=None):
+class FulfillmentsWriter(TableWriter):
+    def __init__(self, result_dir_path, extraction_time, additional_pk: list = None, prefix='', file_headers=None,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
         pk = ['id', 'order_id']
         if not additional_pk:
             pk.extend(additional_pk)
 
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=f'{prefix}fulfillments', pk=pk,
-                                          columns=file_headers.get(
-                                              f'{prefix}fulfillments.csv', []), destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name=f'{prefix}fulfillments', pk=pk,
+                                         columns=file_headers.get(
+                                             f'{prefix}fulfillments.csv', []), destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
 
         self.result_dir_path = result_dir_path
         # lineitems writer
         self.line_item_writer = LineItemWriter(result_dir_path, extraction_time, additional_pk=['fulfillment_id'],
-                                               prefix='fulfillment_', file_headers=file_headers)
+                                               prefix='fulfillment_', file_headers=file_headers,
+                                               output_options=self.output_options, metrics=self.metrics)
 
         # discount_allocations writer
-        self.discount_allocations_writer = ResultWriter(result_dir_path,
-                                                        KBCTableDef(name='fulfillment_discount_allocations',
-                                                                    pk=[KEY_ROW_NR, 'fulfillment_id'],
-                                                                    columns=file_headers.get(
-                                                                        'fulfillment_discount_allocations.csv', []),
-                                                                    destination=''),
-                                                        flatten_objects=True,
-                                                        fix_headers=True,
-                                                        child_separator='__')
+        self.discount_allocations_writer = TableWriter(result_dir_path,
+                                                       KBCTableDef(name='fulfillment_discount_allocations',
+                                                                   pk=[KEY_ROW_NR, 'fulfillment_id'],
+                                                                   columns=file_headers.get(
+                                                                       'fulfillment_discount_allocations.csv', []),
+                                                                   destination=''),
+                                                       fix_headers=True,
+                                                       child_separator='__',
+                                                       output_options=self.output_options, metrics=self.metrics)
         # tax_lines writer
-        self.tax_lines_writer = ResultWriter(result_dir_path,
-                                             KBCTableDef(name='fulfillment_tax_lines',
-                                                         pk=[KEY_ROW_NR, 'fulfillment_id'],
-                                                         columns=file_headers.get(
-                                                             'fulfillment_tax_lines.csv',
-                                                             []),
-                                                         destination=''),
-                                             flatten_objects=True,
-                                             fix_headers=True,
-                                             child_separator='__')
+        self.tax_lines_writer = TableWriter(result_dir_path,
+                                            KBCTableDef(name='fulfillment_tax_lines',
+                                                        pk=[KEY_ROW_NR, 'fulfillment_id'],
+                                                        columns=file_headers.get(
+                                                            'fulfillment_tax_lines.csv',
+                                                            []),
+                                                        destination=''),
+                                            fix_headers=True,
+                                            child_separator='__',
+                                            output_options=self.output_options, metrics=self.metrics)
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
         # flatten obj
@@ -144,15 +605,17 @@ class FulfillmentsWriter(ResultWriter):
         super().close()
 
 
-class OrderWriter(ResultWriter):
+class OrderWriter(TableWriter):
 
-    def __init__(self, result_dir_path, result_name, extraction_time, customers_writer, file_headers=None):
+    def __init__(self, result_dir_path, result_name, extraction_time, customers_writer, file_headers=None,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
 
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=result_name, pk=['id'],
-                                          columns=file_headers.get('order.csv', []),
-                                          destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name=result_name, pk=['id'],
+                                         columns=file_headers.get('order.csv', []),
+                                         destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
         # custom user added col
         self.user_value_cols = ['extraction_time']
@@ -160,45 +623,47 @@ class OrderWriter(ResultWriter):
 
         # lineitems writer
         self.line_item_writer = LineItemWriter(result_dir_path, extraction_time, additional_pk=['order_id'],
-                                               file_headers=file_headers)
+                                               file_headers=file_headers,
+                                               output_options=self.output_options, metrics=self.metrics)
 
         # fulfillments writer
         self.fulfillments_writer = FulfillmentsWriter(result_dir_path, extraction_time, additional_pk=['order_id'],
                                                       prefix='order_',
-                                                      file_headers=file_headers)
+                                                      file_headers=file_headers,
+                                                      output_options=self.output_options, metrics=self.metrics)
 
         # discount_applications writer
-        self.discount_applications_writer = ResultWriter(result_dir_path,
-                                                         KBCTableDef(name='order_discount_applications',
-                                                                     pk=['order_id', KEY_ROW_NR],
-                                                                     columns=file_headers.get(
-                                                                         'order_discount_applications.csv', []),
-                                                                     destination=''),
-                                                         fix_headers=True,
-                                                         flatten_objects=True,
-                                                         child_separator='__')
+        self.discount_applications_writer = TableWriter(result_dir_path,
+                                                        KBCTableDef(name='order_discount_applications',
+                                                                    pk=['order_id', KEY_ROW_NR],
+                                                                    columns=file_headers.get(
+                                                                        'order_discount_applications.csv', []),
+                                                                    destination=''),
+                                                        fix_headers=True,
+                                                        child_separator='__',
+                                                        output_options=self.output_options, metrics=self.metrics)
 
         # discount_codes writer
-        self.discount_codes_writer = ResultWriter(result_dir_path,
-                                                  KBCTableDef(name='order_discount_codes',
-                                                              pk=['order_id', KEY_ROW_NR],
-                                                              columns=file_headers.get(
-                                                                  'order_discount_codes.csv', []),
-                                                              destination=''),
-                                                  fix_headers=True,
-                                                  flatten_objects=True,
-                                                  child_separator='__')
+        self.discount_codes_writer = TableWriter(result_dir_path,
+                                                 KBCTableDef(name='order_discount_codes',
+                                                             pk=['order_id', KEY_ROW_NR],
+                                                             columns=file_headers.get(
+                                                                 'order_discount_codes.csv', []),
+                                                             destination=''),
+                                                 fix_headers=True,
+                                                 child_separator='__',
+                                                 output_options=self.output_options, metrics=self.metrics)
 
         # tax_lines writer
-        self.tax_lines_writer = ResultWriter(result_dir_path,
-                                             KBCTableDef(name='order_tax_lines',
-                                                         pk=['order_id', KEY_ROW_NR],
-                                                         columns=file_headers.get(
-                                                             'order_tax_lines.csv', []),
-                                                         destination=''),
-                                             fix_headers=True,
-                                             flatten_objects=True,
-                                             child_separator='__')
+        self.tax_lines_writer = TableWriter(result_dir_path,
+                                            KBCTableDef(name='order_tax_lines',
+                                                        pk=['order_id', KEY_ROW_NR],
+                                                        columns=file_headers.get(
+                                                            'order_tax_lines.csv', []),
+                                                        destination=''),
+                                            fix_headers=True,
+                                            child_separator='__',
+                                            output_options=self.output_options, metrics=self.metrics)
 
         # customer writer
         self.customer_writer = customers_writer
@@ -260,29 +725,32 @@ class OrderWriter(ResultWriter):
 
 # ###################### PRODUCTS
 
-class ProductVariantWriter(ResultWriter):
-    def __init__(self, result_dir_path, extraction_time, file_headers, additional_pk: list = None):
+class ProductVariantWriter(TableWriter):
+    def __init__(self, result_dir_path, extraction_time, file_headers, additional_pk: list = None,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
         pk = ['id', 'product_id']
         if additional_pk:
             pk.extend(additional_pk)
 
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name='product_variant', pk=pk,
-                                          columns=file_headers.get('product_variant.csv', []),
-                                          destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name='product_variant', pk=pk,
+                                         columns=file_headers.get('product_variant.csv', []),
+                                         destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
 
         self.result_dir_path = result_dir_path
 
         # presentment_prices writer
-        self.presentment_prices_writer = ResultWriter(result_dir_path,
-                                                      KBCTableDef(name='product_variant_presentment_prices',
-                                                                  pk=[KEY_ROW_NR, 'product_variant_id'],
-                                                                  columns=file_headers.get(
-                                                                      'product_variant_presentment_prices.csv', []),
-                                                                  destination=''),
-                                                      fix_headers=True, flatten_objects=True, child_separator='__')
+        self.presentment_prices_writer = TableWriter(result_dir_path,
+                                                     KBCTableDef(name='product_variant_presentment_prices',
+                                                                 pk=[KEY_ROW_NR, 'product_variant_id'],
+                                                                 columns=file_headers.get(
+                                                                     'product_variant_presentment_prices.csv', []),
+                                                                 destination=''),
+                                                     fix_headers=True, child_separator='__',
+                                                     output_options=self.output_options, metrics=self.metrics)
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
         # flatten obj
@@ -306,37 +774,42 @@ class ProductVariantWriter(ResultWriter):
         super().close()
 
 
-class ProductsWriter(ResultWriter):
+class ProductsWriter(TableWriter):
 
-    def __init__(self, result_dir_path, result_name, extraction_time, file_headers):
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=result_name, pk=['id'],
-                                          columns=file_headers.get(
-                                              f'{result_name}.csv', []),
-                                          destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+    def __init__(self, result_dir_path, result_name, extraction_time, file_headers,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name=result_name, pk=['id'],
+                                         columns=file_headers.get(
+                                             f'{result_name}.csv', []),
+                                         destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
         # custom user added col
         self.user_value_cols = ['extraction_time']
         self.result_dir_path = result_dir_path
 
         # variants writer
-        self.variants_writer = ProductVariantWriter(result_dir_path, extraction_time, file_headers)
+        self.variants_writer = ProductVariantWriter(result_dir_path, extraction_time, file_headers,
+                                                    output_options=self.output_options, metrics=self.metrics)
 
         # options writer
-        self.product_options_writer = ResultWriter(result_dir_path, KBCTableDef(name='product_options',
-                                                                                pk=['id', 'product_id'],
-                                                                                columns=file_headers.get(
-                                                                                    'product_options.csv', []),
-                                                                                destination=''),
-                                                   fix_headers=True, flatten_objects=True, child_separator='__')
-        # images writer
-        self.product_images_writer = ResultWriter(result_dir_path, KBCTableDef(name='product_images',
+        self.product_options_writer = TableWriter(result_dir_path, KBCTableDef(name='product_options',
                                                                                pk=['id', 'product_id'],
                                                                                columns=file_headers.get(
-                                                                                   'product_images.csv', []),
+                                                                                   'product_options.csv', []),
                                                                                destination=''),
-                                                  fix_headers=True, flatten_objects=True, child_separator='__')
+                                                  fix_headers=True, child_separator='__',
+                                                  output_options=self.output_options, metrics=self.metrics)
+        # images writer
+        self.product_images_writer = TableWriter(result_dir_path, KBCTableDef(name='product_images',
+                                                                              pk=['id', 'product_id'],
+                                                                              columns=file_headers.get(
+                                                                                  'product_images.csv', []),
+                                                                              destination=''),
+                                                 fix_headers=True, child_separator='__',
+                                                 output_options=self.output_options, metrics=self.metrics)
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
         product_id = data['id']
@@ -369,36 +842,132 @@ class ProductsWriter(ResultWriter):
 
 # ############ CUSTOMERS
 
+def _get_timestamp(value: str) -> float:
+    # bulk operation results use the Z suffix, REST responses the shop offset
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    return parsed.timestamp() if parsed else 0.0
+
+
+class LatestVersionStore:
+    """
+    Keeps the latest version of each object by ``id``, versions are compared by ``updated_at``. The versions are merged
+    field by field: the fields of the newer version win, the fields missing in it are kept from the older one, e.g.
+    the ``addresses`` of the full customer object which the customers embedded in orders don't have.
+
+    The objects are stored in an SQLite database in a temporary directory, only a compact ``id -> updated_at`` index
+    is kept in memory, up to ``index_limit`` ids. Past the limit the ids are looked up in the database only.
+    """
+
+    def __init__(self, index_limit: int = CUSTOMERS_INDEX_LIMIT):
+        self.index_limit = index_limit
+        # id -> updated_at timestamp of the stored version, None when the ids are looked up in the database
+        self._index: Optional[Dict[str, float]] = {}
+        self._tmp_dir = None
+        self._db = None
+
+    def __len__(self):
+        if not self._db:
+            return 0
+        return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def put(self, obj: dict):
+        key = json.dumps(obj.get('id'))
+        updated_at = _get_timestamp(obj.get('updated_at'))
+        if not self._db:
+            self._connect()
+
+        current_updated_at = self._get_updated_at(key)
+        if current_updated_at is None:
+            self._db.execute('INSERT INTO objects (id, updated_at, data) VALUES (?, ?, ?)',
+                             (key, updated_at, json.dumps(obj)))
+        else:
+            current = json.loads(self._db.execute('SELECT data FROM objects WHERE id = ?', (key,)).fetchone()[0])
+            if updated_at >= current_updated_at:
+                merged = {**current, **obj}
+            else:
+                merged = {**obj, **current}
+                updated_at = current_updated_at
+            self._db.execute('UPDATE objects SET updated_at = ?, data = ? WHERE id = ?',
+                             (updated_at, json.dumps(merged), key))
+        self._index_updated_at(key, updated_at)
+
+    def _connect(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix='latest_versions_')
+        self._db = sqlite3.connect(os.path.join(self._tmp_dir, 'objects.db'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE objects (id TEXT PRIMARY KEY, updated_at REAL, data TEXT)')
+
+    def _get_updated_at(self, key: str) -> Optional[float]:
+        if self._index is not None:
+            return self._index.get(key)
+        row = self._db.execute('SELECT updated_at FROM objects WHERE id = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _index_updated_at(self, key: str, updated_at: float):
+        if self._index is None:
+            return
+        self._index[key] = updated_at
+        if len(self._index) > self.index_limit:
+            # the database has the same values, the ids are looked up by its primary key from now on
+            self._index = None
+
+    def __iter__(self):
+        if not self._db:
+            return
+        # in the order the objects were first seen
+        for row in self._db.execute('SELECT data FROM objects ORDER BY rowid'):
+            yield json.loads(row[0])
+
+    def close(self):
+        self._index = {}
+        if self._db:
+            self._db.close()
+            self._db = None
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
 
-class CustomersWriter(ResultWriter):
+
+class CustomersWriter(TableWriter):
     """
-    Sliced
+    Customers come from the customers endpoint and embedded in orders, only the latest version of each customer is
+    kept and the rows are written on close. Writes are safe from concurrently downloaded endpoints.
     """
 
-    def __init__(self, result_dir_path, result_name, extraction_time, file_headers):
-        ResultWriter.__init__(self, result_dir_path,
-                              KBCTableDef(name=result_name, pk=['id'],
-                                          columns=file_headers.get(
-                                              'customer.csv', []),
-                                          destination=''),
-                              fix_headers=True, flatten_objects=True, child_separator='__')
+    def __init__(self, result_dir_path, result_name, extraction_time, file_headers,
+                 output_options: OutputOptions = None, metrics: Optional[RunMetrics] = None):
+        TableWriter.__init__(self, result_dir_path,
+                             KBCTableDef(name=result_name, pk=['id'],
+                                         columns=file_headers.get(
+                                             'customer.csv', []),
+                                         destination=''),
+                             fix_headers=True, child_separator='__',
+                             output_options=output_options, metrics=metrics)
         self.extraction_time = extraction_time
         # custom user added col
         self.user_value_cols = ['extraction_time']
 
         # addresses writer
-        self.address_writer = ResultWriter(result_dir_path, KBCTableDef(name='customer_addresses',
-                                                                        pk=['id', 'customer_id'],
-                                                                        columns=file_headers.get(
-                                                                            'customer_addresses.csv', []),
-                                                                        destination=''),
-                                           fix_headers=True, flatten_objects=True, child_separator='__')
+        self.address_writer = TableWriter(result_dir_path, KBCTableDef(name='customer_addresses',
+                                                                       pk=['id', 'customer_id'],
+                                                                       columns=file_headers.get(
+                                                                           'customer_addresses.csv', []),
+                                                                       destination=''),
+                                          fix_headers=True, child_separator='__',
+                                          output_options=self.output_options, metrics=self.metrics)
+        self.customers = LatestVersionStore()
+        self._lock = threading.Lock()
 
     def write(self, data, file_name=None, user_values=None, object_from_arrays=False, write_header=True):
-        self.address_writer.write_all(data.pop('addresses', []), user_values={
-            EXTRACTION_TIME: self.extraction_time})
+        if data:
+            with self._lock:
+                self.customers.put(data)
+
+    def _write_customers(self):
+        for data in self.customers:
+            self.address_writer.write_all(data.pop('addresses', []), user_values={
+                EXTRACTION_TIME: self.extraction_time})
 
-        super().write(data, user_values=user_values, write_header=True)
+            super().write(data, write_header=True)
 
     def collect_results(self):
         results = super().collect_results()
@@ -407,5 +976,7 @@ class CustomersWriter(ResultWriter):
         return results
 
     def close(self):
+        self._write_customers()
+        self.customers.close()
         self.address_writer.close()
         super().close()
@@ -0,0 +1,427 @@
+"""
+Extraction engine based on the GraphQL Admin API Bulk Operations.
+
+The query is submitted as ``bulkOperationRunQuery``, the operation is polled until it finishes and the resulting JSONL
+file is streamed line by line. Nested connections are returned as separate lines linked by ``__parentId``, so the
+objects are reassembled and converted to the shape of the REST resources used by the result writers.
+"""
+import datetime
+import http.client
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, Iterable, List
+
+import backoff
+
+MAX_RETRIES = 5
+
+POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
+
+RUN_QUERY_MUTATION = '''
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+'''
+
+OPERATION_STATUS_QUERY = '''
+query bulkOperationStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url partialDataUrl }
+  }
+}
+'''
+
+# Fields are aliased to the names of the REST resources so the existing writers can be used.
+ORDERS_QUERY = '''
+{
+  orders(query: "%(filter)s") {
+    edges {
+      node {
+        id
+        name
+        email
+        phone
+        note
+        tags
+        test
+        confirmed
+        created_at: createdAt
+        updated_at: updatedAt
+        processed_at: processedAt
+        closed_at: closedAt
+        cancelled_at: cancelledAt
+        cancel_reason: cancelReason
+        currency: currencyCode
+        presentment_currency: presentmentCurrencyCode
+        financial_status: displayFinancialStatus
+        fulfillment_status: displayFulfillmentStatus
+        taxes_included: taxesIncluded
+        total_weight: totalWeight
+        subtotal_price: subtotalPriceSet { shopMoney { amount } }
+        total_price: totalPriceSet { shopMoney { amount } }
+        total_tax: totalTaxSet { shopMoney { amount } }
+        total_discounts: totalDiscountsSet { shopMoney { amount } }
+        customer {
+          id
+          email
+          phone
+          first_name: firstName
+          last_name: lastName
+          state
+          created_at: createdAt
+          updated_at: updatedAt
+        }
+        line_items: lineItems {
+          edges {
+            node {
+              id
+              name
+              title
+              sku
+              vendor
+              quantity
+              taxable
+              requires_shipping: requiresShipping
+              product { id }
+              variant { id }
+              price: originalUnitPriceSet { shopMoney { amount } }
+              total_discount: totalDiscountSet { shopMoney { amount } }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+PRODUCTS_QUERY = '''
+{
+  products(query: "%(filter)s") {
+    edges {
+      node {
+        id
+        title
+        handle
+        vendor
+        status
+        tags
+        body_html: bodyHtml
+        product_type: productType
+        template_suffix: templateSuffix
+        created_at: createdAt
+        updated_at: updatedAt
+        published_at: publishedAt
+        options { id name position values }
+        variants {
+          edges {
+            node {
+              id
+              title
+              sku
+              barcode
+              price
+              position
+              taxable
+              weight
+              compare_at_price: compareAtPrice
+              inventory_policy: inventoryPolicy
+              inventory_quantity: inventoryQuantity
+              weight_unit: weightUnit
+              created_at: createdAt
+              updated_at: updatedAt
+              inventory_item: inventoryItem { id }
+            }
+          }
+        }
+        images {
+          edges {
+            node {
+              id
+              alt: altText
+              src: url
+              width
+              height
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+# GraphQL type of a nested connection node -> REST collection it belongs to
+ORDER_CHILD_COLLECTIONS = {'LineItem': 'line_items'}
+PRODUCT_CHILD_COLLECTIONS = {'ProductVariant': 'variants', 'ProductImage': 'images'}
+
+
+class BulkOperationError(Exception):
+    pass
+
+
+class BulkOperationThrottled(BulkOperationError):
+    pass
+
+
+def is_transient_request_error(exc: BaseException) -> bool:
+    """
+    True for the failures of a request that are likely to pass when it is sent again: throttling, server errors,
+    connection failures, dropped connections and timeouts.
+    """
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code == 429 or exc.code >= 500
+    return isinstance(exc, (BulkOperationThrottled, urllib.error.URLError, socket.timeout, ConnectionError,
+                            http.client.HTTPException))
+
+
+def _retry_handler(details):
+    # called in the except block of the failed request
+    logging.info(f"Bulk operation request failed with {sys.exc_info()[1]!r} -- "
+                 f"Retry {details['tries']}/{MAX_RETRIES}")
+
+
+def _get_gid_type(gid: str) -> str:
+    # gid://shopify/LineItem/123
+    return gid.split('/')[-2]
+
+
+def _get_gid_id(gid: str) -> int:
+    return int(gid.split('/')[-1].split('?')[0])
+
+
+def _is_gid(value) -> bool:
+    return isinstance(value, str) and value.startswith('gid://')
+
+
+def to_rest_record(obj):
+    """
+    Convert an object returned by the GraphQL API to the shape of the REST resource:
+    global ids to numeric ids, references ``{"variant": {"id": ...}}`` to ``variant_id``, money sets to their shop
+    amount and tag lists to comma separated strings.
+    """
+    if isinstance(obj, list):
+        return [to_rest_record(o) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+
+    record = {}
+    for key, value in obj.items():
+        if key == 'id' and _is_gid(value):
+            record[key] = _get_gid_id(value)
+        elif isinstance(value, dict) and list(value.keys()) == ['id']:
+            record[f'{key}_id'] = _get_gid_id(value['id']) if _is_gid(value['id']) else value['id']
+        elif isinstance(value, dict) and 'shopMoney' in value:
+            record[key] = value['shopMoney']['amount']
+        elif key == 'tags' and isinstance(value, list):
+            record[key] = ', '.join(value)
+        else:
+            record[key] = to_rest_record(value)
+    return record
+
+
+def reassemble_objects(lines: Iterable[dict], child_collections: Dict[str, str]):
+    """
+    Rebuild the nested objects from the flat JSONL lines. Bulk operations output the parent before its children,
+    so a top level object is complete once the next top level object starts.
+
+    Args:
+        lines: Decoded JSONL lines
+        child_collections: GraphQL type of a child node -> key of the parent collection it is appended to
+
+    Yields:
+        Top level objects with the nested children
+    """
+    current = None
+    objects_by_id = {}
+    for obj in lines:
+        parent_id = obj.pop('__parentId', None)
+        if parent_id is None:
+            if current is not None:
+                yield current
+            current = obj
+            objects_by_id = {obj['id']: obj}
+            continue
+
+        parent = objects_by_id.get(parent_id)
+        if parent is None:
+            raise BulkOperationError(f'Parent object {parent_id} of {obj.get("id")} was not found in the result!')
+
+        object_type = _get_gid_type(obj['id'])
+        collection = child_collections.get(object_type)
+        if not collection:
+            raise BulkOperationError(f'Unexpected nested object of type {object_type}!')
+        parent.setdefault(collection, []).append(obj)
+        objects_by_id[obj['id']] = obj
+
+    if current is not None:
+        yield current
+
+
+def _build_search_query(fetch_parameter: str, datetime_min: datetime.datetime, datetime_max: datetime.datetime,
+                        additional_filters: List[str] = None) -> str:
+    filters = [f"{fetch_parameter}:>='{datetime_min.isoformat()}'",
+               f"{fetch_parameter}:<'{datetime_max.isoformat()}'"]
+    if additional_filters:
+        filters.extend(additional_filters)
+    return ' AND '.join(filters)
+
+
+def _iter_complete_lines(response: http.client.HTTPResponse):
+    """
+    Yields the non-empty lines of the response. Reading a response closed by the server before its end only stops
+    early, so the missing part of the content length is raised as IncompleteRead.
+    """
+    for line in response:
+        if response.length and not line.endswith(b'\n'):
+            raise http.client.IncompleteRead(line, response.length)
+        if line.strip():
+            yield line
+    if response.length:
+        raise http.client.IncompleteRead(b'', response.length)
+
+
+class BulkOperationsClient:
+
+    def __init__(self, shop_url: str, access_token: str, api_version: str, graphql_url: str = None,
+                 poll_interval: float = POLL_INTERVAL, max_poll_interval: float = MAX_POLL_INTERVAL):
+        """
+
+        Args:
+            shop_url: [shop].myshopify.com
+            access_token: Admin API access token
+            api_version: Admin API version
+            graphql_url: Override of the GraphQL endpoint url
+            poll_interval: Initial interval of the operation status polling in seconds
+            max_poll_interval: Max interval of the operation status polling in seconds
+        """
+        self.graphql_url = graphql_url or f'https://{shop_url}/admin/api/{api_version}/graphql.json'
+        self.access_token = access_token
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        # only one bulk query operation can run in a shop at a time
+        self._operation_lock = threading.Lock()
+
+    @backoff.on_exception(backoff.expo, Exception, giveup=lambda e: not is_transient_request_error(e),
+                          on_backoff=_retry_handler, max_tries=MAX_RETRIES)
+    def execute(self, query: str, variables: dict = None) -> dict:
+        payload = json.dumps({'query': query, 'variables': variables or {}}).encode('utf-8')
+        request = urllib.request.Request(self.graphql_url, data=payload, method='POST',
+                                         headers={'Content-Type': 'application/json',
+                                                  'X-Shopify-Access-Token': self.access_token})
+        try:
+            with urllib.request.urlopen(request) as response:
+                body = json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                raise BulkOperationThrottled(f'GraphQL request failed with {e.code}') from e
+            raise BulkOperationError(f'GraphQL request failed with {e.code}: {e.read().decode("utf-8")}') from e
+
+        errors = body.get('errors')
+        if errors:
+            if any(e.get('extensions', {}).get('code') == 'THROTTLED' for e in errors):
+                raise BulkOperationThrottled('GraphQL request was throttled')
+            raise BulkOperationError(f'GraphQL request failed: {errors}')
+        return body['data']
+
+    def run_query(self, query: str) -> str:
+        """
+        Submit the bulk operation.
+
+        Returns: Operation id
+        """
+        result = self.execute(RUN_QUERY_MUTATION, {'query': query})['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise BulkOperationError(f'Failed to start the bulk operation: {result["userErrors"]}')
+        return result['bulkOperation']['id']
+
+    def wait_for_completion(self, operation_id: str) -> dict:
+        """
+        Poll the operation status until it is finished.
+
+        Returns: Completed bulk operation
+        """
+        poll_interval = self.poll_interval
+        while True:
+            operation = self.execute(OPERATION_STATUS_QUERY, {'id': operation_id})['node']
+            status = operation['status']
+            if status == 'COMPLETED':
+                logging.info(f'Bulk operation {operation_id} completed with {operation["objectCount"]} objects')
+                return operation
+            if status not in ('CREATED', 'RUNNING'):
+                raise BulkOperationError(f'Bulk operation {operation_id} finished with status {status}, '
+                                         f'error: {operation.get("errorCode")}')
+
+            logging.debug(f'Bulk operation {operation_id} is {status}, {operation["objectCount"]} objects so far')
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, self.max_poll_interval)
+
+    @staticmethod
+    def iter_result_lines(url: str):
+        """
+        Stream the JSONL result file line by line. A download failed by a transient error is retried with the backoff
+        of the requests, the file is downloaded again and the lines already read are skipped.
+        """
+        lines_read = 0
+        wait_gen = backoff.expo()
+        # the generator starts with None
+        next(wait_gen)
+        for tries in range(1, MAX_RETRIES + 1):
+            try:
+                with urllib.request.urlopen(url) as response:
+                    lines = _iter_complete_lines(response)
+                    for _ in range(lines_read):
+                        next(lines)
+                    for line in lines:
+                        obj = json.loads(line)
+                        lines_read += 1
+                        yield obj
+                return
+            except Exception as e:
+                if tries == MAX_RETRIES or not is_transient_request_error(e):
+                    raise
+                _retry_handler({'tries': tries})
+                time.sleep(backoff.full_jitter(next(wait_gen)))
+
+    def get_objects(self, query: str, child_collections: Dict[str, str]):
+        """
+        Run the bulk query and yield the reassembled objects in the shape of REST resources.
+        Operations requested concurrently are run one after another, the results are streamed in parallel.
+        """
+        with self._operation_lock:
+            operation_id = self.run_query(query)
+            logging.info(f'Bulk operation {operation_id} submitted, waiting for the result')
+            operation = self.wait_for_completion(operation_id)
+
+        # no url is returned when the operation didn't match any object
+        if not operation.get('url'):
+            return
+
+        for obj in reassemble_objects(self.iter_result_lines(operation['url']), child_collections):
+            yield to_rest_record(obj)
+
+    def get_orders(self, fetch_parameter: str, datetime_min: datetime.datetime, datetime_max: datetime.datetime):
+        search_query = _build_search_query(fetch_parameter, datetime_min, datetime_max)
+        for order in self.get_objects(ORDERS_QUERY % {'filter': search_query}, ORDER_CHILD_COLLECTIONS):
+            order.setdefault('line_items', [])
+            yield order
+
+    def get_products(self, fetch_parameter: str, datetime_min: datetime.datetime, datetime_max: datetime.datetime,
+                     status: str = 'active'):
+        status_filter = ' OR '.join(f'status:{s}' for s in status.split(','))
+        search_query = _build_search_query(fetch_parameter, datetime_min, datetime_max, [f'({status_filter})'])
+        for product in self.get_objects(PRODUCTS_QUERY % {'filter': search_query}, PRODUCT_CHILD_COLLECTIONS):
+            for child in ('variants', 'images', 'options'):
+                for item in product.setdefault(child, []):
+                    item['product_id'] = product['id']
+            yield product
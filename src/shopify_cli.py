@@ -4,27 +4,56 @@ import json
 import logging
 import math
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
-from typing import Type, List, Union
+from typing import Callable, Dict, Type, List, Optional, Tuple, Union
 
 import backoff
 import pyactiveresource
 import pyactiveresource.formats
 import shopify
-from pyactiveresource.connection import ResourceNotFound, UnauthorizedAccess, ClientError
+from pyactiveresource.connection import ResourceNotFound, UnauthorizedAccess, ClientError, ServerError
 # ##################  Taken from Shopify Singer-Tap
 from shopify import PaginatedIterator
 
+from incremental import WindowCheckpoint
+from metrics import RunMetrics
+from shopify_bulk import BulkOperationsClient, is_transient_request_error
+from transport import UrllibTransport
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 RESULTS_PER_PAGE = 250
 
+# max number of ids accepted by the inventory_items (ids) and inventory_levels (inventory_item_ids) filters
+MAX_INVENTORY_ITEM_IDS = 100
+MAX_INVENTORY_LEVEL_ITEM_IDS = 50
+
 # We've observed 500 errors returned if this is too large (30 days was too
 # large for a customer)
 DATE_WINDOW_SIZE = 30
 
+# Limits of the adaptive date window, the window is sized to contain around TARGET_WINDOW_RECORDS records
+MIN_DATE_WINDOW = datetime.timedelta(hours=1)
+MAX_DATE_WINDOW = datetime.timedelta(days=365)
+TARGET_WINDOW_RECORDS = 10 * RESULTS_PER_PAGE
+
 # We will retry a 500 error a maximum of 5 times before giving up
 MAX_RETRIES = 5
-BASE_SLEEP_TIME = 10
+
+# REST Admin API leaky bucket, bucket size -> restore rate (requests per second). Plus stores have bigger buckets.
+DEFAULT_BUCKET_SIZE = 40
+BUCKET_RESTORE_RATES = {40: 2, 80: 4, 400: 20}
+# requests are paced so that this number of slots is always kept free in the bucket
+BUCKET_SAFETY_MARGIN = 2
+# seconds after which a request without reported response is no longer counted as in flight
+IN_FLIGHT_TIMEOUT = 60
 
 
 class ShopifyClientError(Exception):
@@ -41,16 +70,39 @@ def is_not_status_code_fn(status_code):
     return gen_fn
 
 
+def _record_backoff(details):
+    # the decorated functions are client methods
+    metrics = getattr(details['args'][0], 'metrics', None) if details['args'] else None
+    if metrics:
+        metrics.record_backoff(details['wait'])
+
+
+def _get_rate_limiter(args) -> Optional['LeakyBucketRateLimiter']:
+    # the decorated functions are client methods
+    return getattr(args[0], 'rate_limiter', None) if args else None
+
+
+def _acquire_retry_slot(details):
+    # the retried request is paced like any other, the slot of the failed one was released
+    rate_limiter = _get_rate_limiter(details['args'])
+    if rate_limiter:
+        rate_limiter.acquire()
+
+
 # Taken from Sopify Singer-Tap
 def leaky_bucket_handler(details):
     logging.info("Received 429 -- sleeping for %s seconds",
                  details['wait'])
+    _record_backoff(details)
+    _acquire_retry_slot(details)
 
 
 # Taken from Sopify Singer-Tap
 def retry_handler(details):
     logging.info("Received 500 or retryable error -- Retry %s/%s",
                  details['tries'], MAX_RETRIES)
+    _record_backoff(details)
+    _acquire_retry_slot(details)
 
 
 # ################  Taken from Sopify Singer-Tap
@@ -90,7 +142,14 @@ def error_handling(fnc):
                           jitter=None)
     @functools.wraps(fnc)
     def wrapper(*args, **kwargs):
-        return fnc(*args, **kwargs)
+        try:
+            return fnc(*args, **kwargs)
+        except Exception:
+            # the failed request doesn't report the call limit, a retry acquires a new slot
+            rate_limiter = _get_rate_limiter(args)
+            if rate_limiter:
+                rate_limiter.release()
+            raise
 
     return wrapper
 
@@ -117,6 +176,21 @@ def response_error_handling(func):
     return wrapper
 
 
+def is_transient_error(exc: BaseException) -> bool:
+    """
+    True for the errors that are likely to pass in a later run: server errors, connection failures and throttling that
+    persisted after all retries. Client, authentication and programming errors are not transient.
+    """
+    if isinstance(exc, ShopifyClientError):
+        # the 4xx errors are raised from the original error of the library
+        cause = exc.__cause__
+        return isinstance(cause, ClientError) and cause.code == 429
+    if isinstance(exc, ServerError) or is_transient_request_error(exc):
+        return True
+    # the library wraps the connection failures in its general error without a status code
+    return type(exc) is pyactiveresource.connection.Error
+
+
 class Error(Exception):
     """Base exception for the API interaction module"""
 
@@ -153,6 +227,238 @@ class ShopifyResource(Enum):
                 ', '.join(errors) + f'\n Supported Resources are: [{cls.list()}]')
 
 
+class LeakyBucketRateLimiter:
+    """
+    Client side model of the Shopify leaky bucket. The bucket level is synchronized from the
+    X-Shopify-Shop-Api-Call-Limit header and leaks with the restore rate of the bucket size (standard or Plus),
+    requests are spaced so the bucket never overflows and the API doesn't respond with 429.
+
+    Every request reserves a slot with ``acquire`` and reports the header of its response with ``update``, or
+    ``release`` when it failed. Each thread sends one request at a time, so the slots are kept per thread.
+    Shared by all threads of the client, the time spent waiting is kept in ``total_wait_time`` and reported to
+    ``on_wait`` in the waiting thread.
+    """
+
+    def __init__(self, bucket_size: int = DEFAULT_BUCKET_SIZE, safety_margin: int = BUCKET_SAFETY_MARGIN,
+                 on_wait: Callable[[float], None] = None):
+        self.safety_margin = safety_margin
+        self.on_wait = on_wait
+        self.total_wait_time = 0.0
+        self.wait_count = 0
+
+        self._lock = threading.Lock()
+        self._level = 0.0
+        self._last_leak = time.monotonic()
+        # thread -> send time of its request whose response wasn't reported yet
+        self._in_flight: Dict[int, float] = {}
+        self._set_bucket_size(bucket_size)
+
+    def _set_bucket_size(self, bucket_size: int):
+        self.bucket_size = bucket_size
+        # all known buckets are drained in 20 seconds
+        self.restore_rate = BUCKET_RESTORE_RATES.get(bucket_size, bucket_size / 20)
+
+    def _leak(self):
+        now = time.monotonic()
+        self._level = max(0.0, self._level - (now - self._last_leak) * self.restore_rate)
+        self._last_leak = now
+        # requests of threads that stopped without reporting back, they are reflected in the bucket level by now
+        for thread, send_time in list(self._in_flight.items()):
+            if send_time < now - IN_FLIGHT_TIMEOUT:
+                del self._in_flight[thread]
+
+    def update(self, used: int, bucket_size: int):
+        """
+        Synchronize the model with the call limit reported in a response.
+        """
+        with self._lock:
+            if bucket_size != self.bucket_size:
+                self._set_bucket_size(bucket_size)
+            self._leak()
+            self._in_flight.pop(threading.get_ident(), None)
+            # requests of other threads may not be counted in the response yet
+            self._level = used + len(self._in_flight)
+
+    def acquire(self):
+        """
+        Reserve a slot for a single request, blocks until the request can be sent.
+        """
+        with self._lock:
+            self._leak()
+            self._level += 1
+            overflow = self._level - (self.bucket_size - self.safety_margin)
+            wait_time = overflow / self.restore_rate if overflow > 0 else 0
+            self._in_flight[threading.get_ident()] = time.monotonic() + wait_time
+            if wait_time:
+                self.total_wait_time += wait_time
+                self.wait_count += 1
+
+        if wait_time:
+            if self.on_wait:
+                self.on_wait(wait_time)
+            time.sleep(wait_time)
+
+    def release(self):
+        """
+        Release the slot of the request of the current thread that failed without a call limit in the response,
+        the bucket level is kept as it was.
+        """
+        with self._lock:
+            self._in_flight.pop(threading.get_ident(), None)
+
+
+class TaskPool:
+    """
+    Runs client calls on a bounded pool of worker threads. Shopify keeps the HTTP connection and session per thread,
+    so each worker activates the client session on start. Results are returned in the order of submission and at
+    most ``max_pending`` tasks are kept in flight. With a single worker the tasks are executed inline.
+    """
+
+    def __init__(self, client: 'ShopifyClient', max_workers: int, max_pending: int = None):
+        self._executor = None
+        if max_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='shopify-worker',
+                                                initializer=client.activate_session)
+        self._max_pending = max_pending or max_workers * 2
+        self._pending = deque()
+
+    def submit(self, fnc, *args, **kwargs):
+        if self._executor:
+            self._pending.append(self._executor.submit(fnc, *args, **kwargs))
+            return
+
+        future = Future()
+        try:
+            future.set_result(fnc(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        self._pending.append(future)
+
+    def completed(self):
+        """
+        Yields results of the finished tasks. Blocks while the pool is full, so the caller can't run ahead.
+        """
+        while self._pending and (self._pending[0].done() or len(self._pending) >= self._max_pending):
+            yield self._pending.popleft().result()
+
+    def drain(self):
+        """
+        Yields results of all remaining tasks.
+        """
+        while self._pending:
+            yield self._pending.popleft().result()
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DateWindowPlanner:
+    """
+    Plans the date windows used to page through the time-filtered resources. The window size adapts to the record
+    density observed so far: it grows after sparse or empty windows and shrinks after dense windows. Windows that
+    failed with a server error are split into smaller windows and planned again.
+
+    Iterating the planner is safe from multiple threads; windows reported back out of order are accepted.
+    """
+
+    def __init__(self, datetime_min: datetime.datetime, datetime_max: datetime.datetime,
+                 window_size: datetime.timedelta,
+                 target_records: int = TARGET_WINDOW_RECORDS,
+                 min_window_size: datetime.timedelta = MIN_DATE_WINDOW,
+                 max_window_size: datetime.timedelta = MAX_DATE_WINDOW):
+        self.window_size = window_size
+        self.target_records = target_records
+        self.min_window_size = min_window_size
+        self.max_window_size = max_window_size
+
+        self._next_start = datetime_min
+        self._stop_time = datetime_max
+        self._retry_windows = deque()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        while True:
+            window = self._next_window()
+            if not window:
+                return
+            yield window
+
+    def has_windows(self) -> bool:
+        with self._lock:
+            return bool(self._retry_windows) or self._next_start < self._stop_time
+
+    def _next_window(self):
+        with self._lock:
+            if self._retry_windows:
+                return self._retry_windows.popleft()
+
+            if self._next_start >= self._stop_time:
+                return None
+
+            window_min = self._next_start
+            window_max = min(window_min + self.window_size, self._stop_time)
+            self._next_start = window_max
+            return window_min, window_max
+
+    def record(self, window: tuple, record_count: int):
+        """
+        Adjust the window size based on the number of records returned in the window.
+        """
+        window_min, window_max = window
+        window_length = window_max - window_min
+        with self._lock:
+            if record_count == 0:
+                new_size = self.window_size * 2
+            else:
+                # grow at most 2x at a time, density of a single window may be misleading
+                new_size = min(window_length * (self.target_records / record_count), self.window_size * 2)
+            self._set_window_size(new_size)
+
+    def _set_window_size(self, window_size: datetime.timedelta):
+        # ## Original Singer Tap comment
+        # It's important that `updated_at_min` has microseconds
+        # truncated. Why has been lost to the mists of time but we
+        # think it has something to do with how the API treats
+        # microseconds on its date windows. Maybe it's possible to
+        # drop data due to rounding errors or something like that?
+        window_size = datetime.timedelta(seconds=int(window_size.total_seconds()))
+        self.window_size = max(self.min_window_size, min(window_size, self.max_window_size))
+
+    def split(self, window: tuple) -> bool:
+        """
+        Shrink the window size and plan the failed window again in smaller pieces.
+
+        Returns: False if the window can't be split any further.
+        """
+        window_min, window_max = window
+        window_length = window_max - window_min
+        if window_length <= self.min_window_size:
+            return False
+
+        with self._lock:
+            self._set_window_size(min(self.window_size, window_length / 2))
+            pieces = []
+            while window_min < window_max:
+                piece_max = min(window_min + self.window_size, window_max)
+                pieces.append((window_min, piece_max))
+                window_min = piece_max
+            self._retry_windows.extendleft(reversed(pieces))
+
+        logging.warning(f"Server error for the window {window[0]} - {window[1]}, "
+                        f"retrying with smaller window of {self.window_size}")
+        return True
+
+
 def _get_date_param_min(fetch_parameter: str):
     return f"{fetch_parameter}_min"
 
@@ -161,17 +467,93 @@ def _get_date_param_max(fetch_parameter: str):
     return f"{fetch_parameter}_max"
 
 
+def _decode_json(body: bytes):
+    if orjson:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _parse_link_header(headers) -> dict:
+    """
+    Parses the pagination Link header the same way as the PaginatedCollection, e.g. {'next': url}
+    """
+    values = headers.get('Link', headers.get('link'))
+    if not values:
+        return {}
+
+    result = {}
+    for value in values.split(', '):
+        link, rel = value.split('; ')
+        result[rel.split('"')[1]] = link[1:-1]
+    return result
+
+
+class RawPage(list):
+    """
+    Page of records decoded directly to plain dicts, without building the ShopifyResource objects.
+    Provides the pagination interface of the PaginatedCollection used by the client.
+    """
+
+    def __init__(self, records: List[dict], next_page_url: str = None):
+        super().__init__(records)
+        self.next_page_url = next_page_url
+
+    def has_next_page(self) -> bool:
+        return bool(self.next_page_url)
+
+
 class ShopifyClient:
 
-    def __init__(self, shop: str, access_token: str, api_version: str = '2022-10'):
+    def __init__(self, shop: str, access_token: str, api_version: str = '2022-10', max_workers: int = 1,
+                 raw_json: bool = False, transport=None):
+        """
+
+        Args:
+            shop: Shop id
+            access_token: Admin API access token
+            api_version: Admin API version
+            max_workers: Max number of requests (e.g. date windows) that are fetched in parallel.
+            raw_json: Decode the responses directly to dicts instead of building the ShopifyResource objects.
+            transport: HTTP transport of the REST requests (see transport.py), the library default if not set.
+        """
         shop_url = f'{shop}.myshopify.com'
         self.session = shopify.Session(shop_url, api_version, access_token)
-        self.wait_time_seconds = BASE_SLEEP_TIME
+        self.max_workers = max(1, max_workers)
+        self.raw_json = raw_json
+        self.transport = transport or UrllibTransport()
+
+        # requests, retries and call limit waits of all worker threads
+        self.metrics = RunMetrics()
+        # shared call limit budget of all worker threads
+        self.rate_limiter = LeakyBucketRateLimiter(on_wait=self.metrics.record_limit_wait)
+        self.activate_session()
+
+        self.bulk_client = BulkOperationsClient(shop_url, access_token, api_version)
+
+    def activate_session(self):
+        """
+        Activates the session in the current thread. Connection and headers are thread local in the Shopify library.
+        """
         shopify.ShopifyResource.activate_session(self.session)
+        self.transport.install(shopify.ShopifyResource, self.metrics)
+
+    def close(self):
+        self.transport.close()
+
+    def task_pool(self, max_workers: int = None, max_pending: int = None) -> TaskPool:
+        """
+        Pool of workers sharing the client session and rate limit.
+
+        Args:
+            max_workers: Number of worker threads, defaults to the ``max_workers`` of the client.
+            max_pending: Max number of tasks in flight, defaults to twice the number of workers.
+        """
+        return TaskPool(self, max_workers or self.max_workers, max_pending)
 
     def get_orders(self, fetch_parameter: str, datetime_min: datetime.datetime = None,
                    datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0),
-                   status='any', fields=None, results_per_page=RESULTS_PER_PAGE):
+                   status='any', fields=None, results_per_page=RESULTS_PER_PAGE,
+                   checkpoint: WindowCheckpoint = None):
         """
         Get orders
         Args:
@@ -181,6 +563,7 @@ class ShopifyClient:
             status:
             fields:
             results_per_page:
+            checkpoint: Tracks the completed date windows, see ``get_objects_paginated``
 
         Returns: Generator object, list of orders
 
@@ -194,6 +577,7 @@ class ShopifyClient:
                                           datetime_min=datetime_min,
                                           datetime_max=datetime_max,
                                           results_per_page=results_per_page,
+                                          checkpoint=checkpoint,
                                           status=status,
                                           datetime_param_min=_get_date_param_min(fetch_parameter),
                                           datetime_param_max=_get_date_param_max(fetch_parameter),
@@ -201,11 +585,11 @@ class ShopifyClient:
 
     def get_order_transactions(self, order_id: str, results_per_page=RESULTS_PER_PAGE):
         """
-        Get orders
+        Get order transactions
         Args:
             order_id: Order ID
 
-        Returns: Generator object, list of orders
+        Returns: Generator object, list of transactions
 
         """
 
@@ -214,8 +598,20 @@ class ShopifyClient:
         return self.get_objects_paginated_simple(shopify.Transaction, results_per_page=results_per_page,
                                                  **additional_params)
 
-    def get_payments_transactions(self, results_per_page=RESULTS_PER_PAGE):
-        return self.get_objects_paginated_simple(shopify.Transactions, results_per_page=results_per_page)
+    def get_payments_transactions(self, since_id: int = None, results_per_page=RESULTS_PER_PAGE):
+        """
+        Get Shopify Payments balance transactions
+        Args:
+            since_id: Return only the transactions with a higher id
+
+        Returns: Generator object, list of transactions
+
+        """
+        additional_params = {}
+        if since_id:
+            additional_params['since_id'] = since_id
+        return self.get_objects_paginated_simple(shopify.Transactions, results_per_page=results_per_page,
+                                                 **additional_params)
 
     def get_metafields(self, resource: str, resource_id: str, results_per_page=RESULTS_PER_PAGE):
 
@@ -226,7 +622,8 @@ class ShopifyClient:
 
     def get_products(self, fetch_parameter: str, datetime_min: datetime.datetime = None,
                      datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0),
-                     status='active', fields=None, results_per_page=RESULTS_PER_PAGE, return_chunk_size=90):
+                     status='active', fields=None, results_per_page=RESULTS_PER_PAGE, return_chunk_size=90,
+                     checkpoint: WindowCheckpoint = None):
         """
         Get products
         Args:
@@ -237,6 +634,7 @@ class ShopifyClient:
             fields:
             results_per_page:
             return_chunk_size: Max size of the chunk of products to return
+            checkpoint: Tracks the completed date windows, see ``get_objects_paginated``
 
         Returns: Generator object, list of products
 
@@ -246,23 +644,49 @@ class ShopifyClient:
         if fields:
             additional_params['fields'] = fields
 
-        buffered = 0
+        products = self.get_objects_paginated(shopify.Product,
+                                              datetime_min=datetime_min,
+                                              datetime_max=datetime_max,
+                                              results_per_page=results_per_page,
+                                              checkpoint=checkpoint,
+                                              status=status,
+                                              datetime_param_min=_get_date_param_min(fetch_parameter),
+                                              datetime_param_max=_get_date_param_max(fetch_parameter),
+                                              **additional_params)
+        return self._split_to_chunks(products, return_chunk_size)
+
+    def get_orders_bulk(self, fetch_parameter: str, datetime_min: datetime.datetime,
+                        datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0)):
+        """
+        Get orders using the GraphQL Bulk Operation, the orders are converted to the shape of the REST resource.
+
+        Returns: Generator object, list of orders
+
+        """
+        return self.bulk_client.get_orders(fetch_parameter, datetime_min, datetime_max)
+
+    def get_products_bulk(self, fetch_parameter: str, datetime_min: datetime.datetime,
+                          datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0),
+                          status='active', return_chunk_size=90):
+        """
+        Get products using the GraphQL Bulk Operation, the products are converted to the shape of the REST resource.
+
+        Returns: Generator object, list of products
+
+        """
+        products = self.bulk_client.get_products(fetch_parameter, datetime_min, datetime_max, status)
+        return self._split_to_chunks(products, return_chunk_size)
+
+    @staticmethod
+    def _split_to_chunks(objects, return_chunk_size: int):
         buffer = []
-        for p in self.get_objects_paginated(shopify.Product,
-                                            datetime_min=datetime_min,
-                                            datetime_max=datetime_max,
-                                            results_per_page=results_per_page,
-                                            status=status,
-                                            datetime_param_min=_get_date_param_min(fetch_parameter),
-                                            datetime_param_max=_get_date_param_max(fetch_parameter),
-                                            **additional_params):
-            buffered += 1
+        for p in objects:
             buffer.append(p)
-            if buffered >= return_chunk_size:
-                results = buffer.copy()
+            if len(buffer) >= return_chunk_size:
+                yield buffer
                 buffer = []
-                yield results
-        yield buffer
+        if buffer:
+            yield buffer
 
     def get_inventory_items(self, inventory_ids: list,
                             results_per_page=RESULTS_PER_PAGE):
@@ -289,7 +713,8 @@ class ShopifyClient:
                    datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0),
                    filter_resource: List[Union[ShopifyResource, str]] = None, event_type: str = None,
                    fields: List[str] = None,
-                   results_per_page: int = RESULTS_PER_PAGE
+                   results_per_page: int = RESULTS_PER_PAGE,
+                   checkpoint: WindowCheckpoint = None
                    ):
 
         """
@@ -307,6 +732,7 @@ class ShopifyClient:
                 a list of possible verbs.
             fields: List of fields to limit the response
             results_per_page:
+            checkpoint: Tracks the completed date windows, see ``get_objects_paginated``
 
         Returns:
 
@@ -332,11 +758,13 @@ class ShopifyClient:
                                           datetime_param_min='created_at_min',
                                           datetime_param_max='created_at_max',
                                           results_per_page=results_per_page,
+                                          checkpoint=checkpoint,
                                           **additional_params)
 
     def get_customers(self, fetch_parameter: str, datetime_min: datetime.datetime = None,
                       datetime_max: datetime.datetime = datetime.datetime.now().replace(microsecond=0),
-                      state=None, fields=None, results_per_page=RESULTS_PER_PAGE):
+                      state=None, fields=None, results_per_page=RESULTS_PER_PAGE,
+                      checkpoint: WindowCheckpoint = None):
         additional_params = {}
         if fields:
             additional_params['fields'] = fields
@@ -348,6 +776,7 @@ class ShopifyClient:
                                           datetime_min=datetime_min,
                                           datetime_max=datetime_max,
                                           results_per_page=results_per_page,
+                                          checkpoint=checkpoint,
                                           datetime_param_min=_get_date_param_min(fetch_parameter),
                                           datetime_param_max=_get_date_param_max(fetch_parameter),
                                           **additional_params)
@@ -355,10 +784,57 @@ class ShopifyClient:
     @response_error_handling
     @error_handling
     def call_api_all_pages(self, shopify_object: Type[shopify.ShopifyResource], query_params):
+        if self.raw_json:
+            return self._get_raw_pages(shopify_object, query_params)
         # this makes the PaginatedCollection iterator actually fetch all pages automatically
         query_params['no_iter_next'] = False
         return PaginatedIterator(shopify_object.find(**query_params))
 
+    def _get_raw_pages(self, shopify_object: Type[shopify.ShopifyResource], query_params):
+        """
+        Yields all pages as RawPage, the next pages are followed using the Link header.
+        """
+        prefix_options, query_options = shopify_object._split_options(query_params)
+        url = shopify_object._collection_path(prefix_options, query_options)
+        while url:
+            page = self._get_raw_page(shopify_object, url)
+            yield page
+            url = page.next_page_url
+
+    @response_error_handling
+    @error_handling
+    def _get_raw_page(self, shopify_object: Type[shopify.ShopifyResource], url: str) -> RawPage:
+        # the thread local connection keeps the response, so the call limit header is available as usual
+        response = shopify_object.connection.get(url, shopify_object.headers)
+        try:
+            decoded = _decode_json(response.body)
+        except ValueError as e:
+            raise pyactiveresource.formats.Error(f'Failed to decode the response of {url}: {e}') from e
+
+        # remove the root element, e.g. {"orders": [...]}
+        records = next(iter(decoded.values())) if isinstance(decoded, dict) and len(decoded) == 1 else decoded
+        return RawPage(records, _parse_link_header(response.headers).get('next'))
+
+    @staticmethod
+    def _get_page_records(page):
+        if isinstance(page, RawPage):
+            return page
+        return (obj.to_dict() for obj in page)
+
+    def _get_all_pages_records(self, shopify_object: Type[shopify.ShopifyResource], query_params):
+        self.rate_limiter.acquire()
+        try:
+            result_iterator = self.call_api_all_pages(shopify_object, query_params)
+
+            # iterate through pages (the iterator does this on the background
+            for collection in result_iterator:
+                self.check_api_limit_use(collection.has_next_page())
+                yield from self._get_page_records(collection)
+        except BaseException:
+            # failed page or the slot of the next page isn't needed anymore
+            self.rate_limiter.release()
+            raise
+
     def get_objects_paginated_simple(self, shopify_object: Type[shopify.ShopifyResource],
                                      results_per_page=RESULTS_PER_PAGE,
                                      **kwargs):
@@ -366,13 +842,7 @@ class ShopifyClient:
             "limit": results_per_page
         }, **kwargs}
 
-        result_iterator = self.call_api_all_pages(shopify_object, query_params)
-
-        # iterate through pages (the iterator does this on the background
-        for collection in result_iterator:
-            self.check_api_limit_use()
-            for obj in collection:
-                yield obj.to_dict()
+        yield from self._get_all_pages_records(shopify_object, query_params)
 
     def get_objects_paginated(self, shopify_object: Type[shopify.ShopifyResource],
                               datetime_min: datetime.datetime = None,
@@ -381,18 +851,22 @@ class ShopifyClient:
                               results_per_page=RESULTS_PER_PAGE,
                               datetime_param_min='updated_at_min',
                               datetime_param_max='updated_at_max',
+                              checkpoint: WindowCheckpoint = None,
                               **kwargs):
         """
         Get all objects and paginate per date. The pagination is also limited by the ``date_window_size`` parameter,
-        that prevents overloading the API and getting too many 500s.
+        that prevents overloading the API and getting too many 500s. The window size then adapts to the density of
+        the data, see ``DateWindowPlanner``.
         Args:
             shopify_object (Type[shopify.ShopifyResource]): Shopify object to retrieve.
             datetime_min (datetime): Min date
             datetime_max (datetime): Max date
-            date_window_size: Size of the window to get in each request days
+            date_window_size: Initial size of the window to get in each request days
             results_per_page:
             datetime_param_min: field date min parameter
             datetime_param_max: field date max parameter
+            checkpoint: Tracks the completed windows. When given, an error after some windows were completed
+                interrupts the download instead of failing, the objects of the completed windows are all returned.
             **kwargs:
 
         Yields:
@@ -401,59 +875,114 @@ class ShopifyClient:
         """
         datetime_min = datetime_min.replace(microsecond=0)
 
-        stop_time = datetime_max
-
         # Page through till the end of the result set
         # NOTE: "Artificial" pagination done in Singer Tap, keeping it since it apparently causes 500 errors
         # when requesting full period. Eg. paging per window_size (1day)
         # however it was simplified to leverage shopify native pagination function
-        while datetime_min < stop_time:
-
-            # ## Original Singer Tap comment
-            # It's important that `updated_at_min` has microseconds
-            # truncated. Why has been lost to the mists of time but we
-            # think it has something to do with how the API treats
-            # microseconds on its date windows. Maybe it's possible to
-            # drop data due to rounding errors or something like that?
-            datetime_max = datetime_min + datetime.timedelta(days=date_window_size)
-            if datetime_max > stop_time:
-                datetime_max = stop_time
-
-            query_params = {**{
-                datetime_param_min: datetime_min.isoformat(),
-                datetime_param_max: datetime_max.isoformat(),
-                "limit": results_per_page
-            }, **kwargs}
-
-            result_iterator = self.call_api_all_pages(shopify_object, query_params)
-
-            # iterate through pages (the iterator does this on the background
-            for collection in result_iterator:
-                self.check_api_limit_use()
-                for obj in collection:
-                    yield obj.to_dict()
+        planner = DateWindowPlanner(datetime_min, datetime_max, datetime.timedelta(days=date_window_size))
+        objects = self._get_windows_objects(planner, shopify_object, results_per_page, datetime_param_min,
+                                            datetime_param_max, checkpoint, **kwargs)
+        if not checkpoint:
+            yield from objects
+            return
+
+        checkpoint.start(datetime_min)
+        try:
+            yield from objects
+        except Exception as e:
+            # nothing to continue from, or the next run would fail the same way
+            if not checkpoint.has_progress or not is_transient_error(e):
+                raise
+            checkpoint.interrupt(e)
+
+    def _get_windows_objects(self, planner: DateWindowPlanner, shopify_object: Type[shopify.ShopifyResource],
+                             results_per_page, datetime_param_min, datetime_param_max,
+                             checkpoint: WindowCheckpoint = None, **kwargs):
+        if self.max_workers == 1:
+            for window in planner:
+                record_count = 0
+                try:
+                    for obj in self._get_objects_in_window(shopify_object, *window, results_per_page,
+                                                           datetime_param_min, datetime_param_max, **kwargs):
+                        record_count += 1
+                        yield obj
+                except ServerError:
+                    # nothing was returned from the window yet, so it can be safely requested again
+                    if record_count or not planner.split(window):
+                        raise
+                    continue
+                planner.record(window, record_count)
+                if checkpoint:
+                    checkpoint.complete(window)
+            return
+
+        # fetch multiple windows in parallel, records are returned in the order the windows were planned
+        with self.task_pool() as pool:
+            while planner.has_windows():
+                for window in planner:
+                    pool.submit(self._get_window_objects_list, shopify_object, window, results_per_page,
+                                datetime_param_min, datetime_param_max, **kwargs)
+                    for result in pool.completed():
+                        yield from self._process_window_result(planner, checkpoint, *result)
+
+                for result in pool.drain():
+                    yield from self._process_window_result(planner, checkpoint, *result)
+
+    @staticmethod
+    def _process_window_result(planner: DateWindowPlanner, checkpoint: WindowCheckpoint, window: tuple,
+                               objects: List[dict], error: Exception):
+        if error:
+            if not planner.split(window):
+                raise error
+            return []
+        planner.record(window, len(objects))
+        if checkpoint:
+            checkpoint.complete(window)
+        return objects
+
+    def _get_objects_in_window(self, shopify_object: Type[shopify.ShopifyResource],
+                               datetime_min: datetime.datetime, datetime_max: datetime.datetime,
+                               results_per_page, datetime_param_min, datetime_param_max, **kwargs):
+        query_params = {**{
+            datetime_param_min: datetime_min.isoformat(),
+            datetime_param_max: datetime_max.isoformat(),
+            "limit": results_per_page
+        }, **kwargs}
 
-            datetime_min = datetime_max
+        yield from self._get_all_pages_records(shopify_object, query_params)
 
-    def check_api_limit_use(self):
-        used_credits, max_credits = self._try_get_credits()
-        if int(used_credits) >= int(max_credits) - 1:
-            time.sleep(self.wait_time_seconds)
+    def _get_window_objects_list(self, shopify_object: Type[shopify.ShopifyResource], window: tuple,
+                                 *args, **kwargs):
+        """
+        Returns all objects of the window at once, server errors are returned so the window can be planned again.
+        """
+        try:
+            return window, list(self._get_objects_in_window(shopify_object, *window, *args, **kwargs)), None
+        except ServerError as e:
+            return window, None, e
 
-    def _try_get_credits(self):
+    def check_api_limit_use(self, next_page: bool = True):
+        """
+        Update the rate limiter from the last response and wait for a slot if the next page is going to be requested.
+        """
+        credits = self._try_get_credits()
+        if credits:
+            self.rate_limiter.update(*credits)
+        else:
+            self.rate_limiter.release()
+        if next_page:
+            self.rate_limiter.acquire()
+
+    def _try_get_credits(self) -> Optional[Tuple[int, int]]:
         """
         Sometimes shopify.Limits.api_credit_limit_param() fails because the X-Shopify-Shop-Api-Call-Limit is lower case
-        Returns:
+        Returns: Used and max credits, None if the header is missing
 
         """
-        used_credits, max_credits = 1, 1
         lower_case_ratelimit = shopify.Limits.CREDIT_LIMIT_HEADER_PARAM.lower()
-        header_found = False
         for key, value in shopify.Limits.response().headers.items():
             if key.lower() == lower_case_ratelimit:
                 used_credits, max_credits = value.split("/")
-                header_found = True
-                break
-        if not header_found:
-            logging.warning(f"Header {lower_case_ratelimit} was not found in the response!")
-        return used_credits, max_credits
+                return int(used_credits), int(max_credits)
+        logging.warning(f"Header {lower_case_ratelimit} was not found in the response!")
+        return None
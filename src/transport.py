@@ -0,0 +1,262 @@
+"""
+HTTP transports of the ShopifyClient.
+
+The default transport of the Shopify library opens a new urllib connection (including the TLS handshake) for every
+request and doesn't ask for compressed responses. The pooled transport keeps the connections alive in a pool shared by
+all threads of the client and negotiates gzip. It replaces only the ``_urlopen`` call of the pyactiveresource
+connection, so the HTTP errors are still raised by the library and the retry decorators of the client work unchanged.
+
+Both transports install a metered connection recording each request (endpoint, status, latency and size) in the run
+metrics of the client.
+"""
+import gzip
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+from typing import Dict, List, Tuple
+
+import pyactiveresource.connection
+import shopify
+from shopify.base import ShopifyConnection
+
+from metrics import RunMetrics
+
+# max number of idle connections kept per host
+DEFAULT_MAX_IDLE_CONNECTIONS = 10
+DEFAULT_TIMEOUT = 300
+
+# requests that are safe to send again when a reused connection turns out to be closed by the server
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# redirects followed by the pool, a 303 is followed by a GET without the body
+REDIRECT_STATUSES = (301, 302, 303)
+MAX_REDIRECTS = 5
+# headers of the request body, dropped with the body
+CONTENT_HEADERS = ('content-length', 'content-type')
+
+
+class PooledResponse:
+    """
+    Fully read response, provides the interface of the urllib response used by the pyactiveresource connection.
+    """
+
+    def __init__(self, url: str, code: int, msg: str, headers: http.client.HTTPMessage, body: bytes):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def read(self) -> bytes:
+        return self.body
+
+    def close(self):
+        # the connection is already back in the pool
+        pass
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of keep-alive HTTP(S) connections. A connection is used by one request at a time and returned
+    to the pool once the response is read.
+    """
+
+    def __init__(self, max_idle_connections: int = DEFAULT_MAX_IDLE_CONNECTIONS, timeout: float = DEFAULT_TIMEOUT):
+        self.max_idle_connections = max_idle_connections
+        self.timeout = timeout
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> idle connections
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+
+    def _new_connection(self, key: Tuple[str, str, int]) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        with self._lock:
+            self.connections_opened += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key: Tuple[str, str, int]) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(key), False
+
+    def _release(self, key: Tuple[str, str, int], connection: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method: str, url: str, headers: Dict[str, str] = None, body: bytes = None) -> PooledResponse:
+        """
+        Send the request over a pooled connection and read the whole response, gzip responses are decompressed.
+        The 301, 302 and 303 redirects are followed up to MAX_REDIRECTS hops, like the default urllib transport
+        does, the last redirect response is returned after that.
+
+        Raises:
+            urllib.error.URLError: on connection errors, like the default urllib transport
+        """
+        headers = headers or {}
+        response = self._request(method, url, headers, body)
+        for _ in range(MAX_REDIRECTS):
+            location = response.headers.get('Location')
+            if response.code not in REDIRECT_STATUSES or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            logging.debug(f'Following the {response.code} redirect to {url}')
+            if response.code == 303:
+                method = 'HEAD' if method == 'HEAD' else 'GET'
+                body = None
+                headers = {k: v for k, v in headers.items() if k.lower() not in CONTENT_HEADERS}
+            response = self._request(method, url, headers, body)
+        return response
+
+    def _request(self, method: str, url: str, headers: Dict[str, str], body: bytes) -> PooledResponse:
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = {**headers, 'Accept-Encoding': 'gzip'}
+
+        connection, reused = self._acquire(key)
+        try:
+            response = self._send(connection, method, path, headers, body)
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            if not (reused and method in IDEMPOTENT_METHODS):
+                raise urllib.error.URLError(e) from e
+
+            # keep-alive connection closed by the server in the meantime
+            logging.debug(f'Pooled connection to {parts.hostname} was closed ({e}), reconnecting')
+            connection = self._new_connection(key)
+            try:
+                response = self._send(connection, method, path, headers, body)
+            except (http.client.HTTPException, OSError) as retry_error:
+                connection.close()
+                raise urllib.error.URLError(retry_error) from retry_error
+
+        response_body = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+            response_body = gzip.decompress(response_body)
+            del response.headers['Content-Encoding']
+
+        return PooledResponse(url, response.status, response.reason, response.headers, response_body)
+
+    def _send(self, connection: http.client.HTTPConnection, method: str, path: str, headers: Dict[str, str],
+              body: bytes) -> http.client.HTTPResponse:
+        connection.request(method, path, body=body, headers=headers)
+        with self._lock:
+            self.requests_sent += 1
+        return connection.getresponse()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class MeteredShopifyConnection(ShopifyConnection):
+    """
+    Shopify library connection recording the requests in the run metrics, including the failed ones.
+    """
+
+    def __init__(self, *args, metrics: RunMetrics = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def _open(self, method, path, *args, **kwargs):
+        # network errors have no status
+        self._status = 0
+        start = time.monotonic()
+        try:
+            response = super()._open(method, path, *args, **kwargs)
+        except pyactiveresource.connection.Error:
+            self._record(path, time.monotonic() - start, 0)
+            raise
+        self._record(path, time.monotonic() - start, len(response.body or b''))
+        return response
+
+    def _handle_error(self, err):
+        # all responses pass here, the server errors raised by the library don't keep the status code
+        self._status = err.code
+        return super()._handle_error(err)
+
+    def _record(self, path: str, latency: float, bytes_received: int):
+        if self.metrics:
+            self.metrics.record_request(urllib.parse.urljoin(self.site, path), self._status, latency, bytes_received)
+
+
+class PooledShopifyConnection(MeteredShopifyConnection):
+    """
+    Shopify library connection sending the requests through the connection pool.
+    """
+
+    def __init__(self, pool: ConnectionPool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def _urlopen(self, request):
+        return self.pool.request(request.get_method(), request.full_url, dict(request.header_items()), request.data)
+
+
+class UrllibTransport:
+    """
+    Default transport of the Shopify library, a new connection for each request.
+    """
+
+    def install(self, resource_class=shopify.ShopifyResource, metrics: RunMetrics = None):
+        """
+        Replace the connection of the active session in the current thread by a metered one.
+        """
+        default = resource_class.connection
+        if metrics is None or isinstance(default, MeteredShopifyConnection):
+            return
+        resource_class._threadlocal.connection = MeteredShopifyConnection(resource_class.site, default.user,
+                                                                          default.password, default.timeout,
+                                                                          default.format, metrics=metrics)
+
+    def close(self):
+        pass
+
+
+class PooledTransport:
+    """
+    Keep-alive connections with gzip, shared by all threads of the client.
+    """
+
+    def __init__(self, max_idle_connections: int = DEFAULT_MAX_IDLE_CONNECTIONS, timeout: float = DEFAULT_TIMEOUT):
+        self.pool = ConnectionPool(max_idle_connections, timeout)
+
+    def install(self, resource_class=shopify.ShopifyResource, metrics: RunMetrics = None):
+        """
+        Replace the connection of the active session in the current thread.
+        """
+        # the default connection initializes the thread local session attributes
+        default = resource_class.connection
+        if isinstance(default, PooledShopifyConnection):
+            return
+        resource_class._threadlocal.connection = PooledShopifyConnection(self.pool, resource_class.site,
+                                                                         default.user, default.password,
+                                                                         default.timeout, default.format,
+                                                                         metrics=metrics)
+
+    def close(self):
+        logging.info(f'Pooled transport sent {self.pool.requests_sent} requests '
+                     f'over {self.pool.connections_opened} connections')
+        self.pool.close()
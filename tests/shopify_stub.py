@@ -0,0 +1,460 @@
+"""
+Local stand-in for the Shopify Admin REST API, used by the end-to-end tests and benchmarks.
+
+Serves a synthetic shop generated from the example responses in the schema folder, with Link header pagination, the
+X-Shopify-Shop-Api-Call-Limit header of a simulated leaky bucket, gzip responses and injectable error responses.
+
+Example:
+    with ShopifyStub(ShopData(orders=100)) as stub, stub.redirect_client():
+        run_component(data_dir, parameters)
+"""
+import base64
+import copy
+import datetime
+import gzip
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import mock
+
+from shopify_cli import ShopifyClient
+
+SCHEMA_DIR = Path(__file__).resolve().parent.parent.joinpath('schema')
+
+SHOP_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-5))
+DEFAULT_START = datetime.datetime(2020, 1, 1, tzinfo=SHOP_TIMEZONE)
+
+MAX_PAGE_SIZE = 250
+DEFAULT_PAGE_SIZE = 50
+
+EVENT_VERBS = ['create', 'update', 'confirmed', 'destroy']
+EVENT_SUBJECTS = ['Order', 'Product']
+
+ERROR_MESSAGES = {429: 'Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted '
+                       'service.',
+                  500: 'Internal Server Error'}
+
+# injected instead of a status, the connection is closed without a response
+CONNECTION_RESET = -1
+
+
+def _sample(file_name: str, key: str) -> dict:
+    with open(SCHEMA_DIR.joinpath(file_name)) as schema_file:
+        return json.load(schema_file)[key][0]
+
+
+def _format_datetime(value: datetime.datetime) -> str:
+    return value.isoformat(timespec='seconds')
+
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    value = value.strip().replace(' ', 'T', 1)
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.datetime.fromisoformat(value)
+    # dates without offset are in the shop timezone
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=SHOP_TIMEZONE)
+
+
+class ShopData:
+    """
+    Synthetic shop, the objects are copies of the schema examples with unique ids, dates are spread evenly over the
+    period. Ids start at 1 for each resource.
+    """
+
+    def __init__(self, orders: int = 100, line_items: int = 3, products: int = 20, variants: int = 2,
+                 customers: int = 20, events: int = 100, payments_transactions: int = 100,
+                 start: datetime.datetime = DEFAULT_START, period: datetime.timedelta = datetime.timedelta(days=30)):
+        self.start = start
+        self.period = period
+        self.line_items = line_items
+        self.variants = variants
+
+        self.orders = [self._order(i, orders, customers) for i in range(1, orders + 1)]
+        self.products = [self._product(i, products) for i in range(1, products + 1)]
+        self.customers = [self._customer(i, customers) for i in range(1, customers + 1)]
+        self.events = [self._event(i, events) for i in range(1, events + 1)]
+        # newest first, like the API
+        self.payments_transactions = [self._payments_transaction(i) for i in range(payments_transactions, 0, -1)]
+        self.locations = [{'id': 1, 'name': 'Warehouse', 'active': True, 'country_code': 'US'}]
+        self.variants_by_inventory_item = {v['inventory_item_id']: v for p in self.products for v in p['variants']}
+
+    def _date(self, i: int, count: int) -> str:
+        return _format_datetime(self.start + self.period * (i / (count + 1)))
+
+    def _order(self, i: int, count: int, customers: int) -> dict:
+        order = copy.deepcopy(_sample('order.json', 'orders'))
+        date = self._date(i, count)
+        order.update(id=i, number=i, order_number=1000 + i, name=f'#{1000 + i}', created_at=date, updated_at=date,
+                     processed_at=date, admin_graphql_api_id=f'gid://shopify/Order/{i}')
+
+        line_item_samples = order['line_items']
+        order['line_items'] = []
+        for k in range(self.line_items):
+            line_item = copy.deepcopy(line_item_samples[k % len(line_item_samples)])
+            line_item['id'] = i * 1000 + k
+            order['line_items'].append(line_item)
+
+        for k, fulfillment in enumerate(order['fulfillments']):
+            fulfillment.update(id=i * 100 + k, order_id=i, created_at=date, updated_at=date)
+
+        if customers:
+            order['customer'].update(id=(i - 1) % customers + 1, updated_at=date)
+        else:
+            order.pop('customer')
+        return order
+
+    def _product(self, i: int, count: int) -> dict:
+        product = copy.deepcopy(_sample('products.json', 'products'))
+        date = self._date(i, count)
+        product.update(id=i, created_at=date, updated_at=date, handle=f'product-{i}',
+                       admin_graphql_api_id=f'gid://shopify/Product/{i}')
+
+        variant_samples = product['variants']
+        product['variants'] = []
+        for k in range(self.variants):
+            variant = copy.deepcopy(variant_samples[k % len(variant_samples)])
+            variant.update(id=i * 100 + k, product_id=i, inventory_item_id=i * 100 + k, sku=f'SKU-{i}-{k}',
+                           updated_at=date)
+            product['variants'].append(variant)
+        for k, image in enumerate(product['images']):
+            image.update(id=i * 100 + k, product_id=i)
+        for option in product['options']:
+            option['product_id'] = i
+        product['image'] = product['images'][0] if product['images'] else None
+        return product
+
+    def _customer(self, i: int, count: int) -> dict:
+        customer = copy.deepcopy(_sample('customers.json', 'customers'))
+        date = self._date(i, count)
+        customer.update(id=i, created_at=date, updated_at=date, email=f'customer{i}@example.com')
+        for k, address in enumerate(customer['addresses']):
+            address.update(id=i * 10 + k, customer_id=i)
+        customer['default_address'] = customer['addresses'][0] if customer['addresses'] else None
+        return customer
+
+    def _event(self, i: int, count: int) -> dict:
+        subject_type = EVENT_SUBJECTS[i % len(EVENT_SUBJECTS)]
+        verb = EVENT_VERBS[i % len(EVENT_VERBS)]
+        return {'id': i, 'subject_id': i, 'created_at': self._date(i, count), 'subject_type': subject_type,
+                'verb': verb, 'arguments': [f'#{1000 + i}'], 'body': None, 'message': f'{subject_type} {verb}',
+                'author': 'Shopify', 'description': f'{subject_type} {i} {verb}',
+                'path': f'/admin/{subject_type.lower()}s/{i}'}
+
+    def _payments_transaction(self, i: int) -> dict:
+        return {'id': i, 'type': 'charge', 'test': False, 'payout_id': i // 10 + 1, 'payout_status': 'paid',
+                'currency': 'USD', 'amount': '10.00', 'fee': '0.59', 'net': '9.41', 'source_id': i,
+                'source_type': 'charge', 'source_order_id': i, 'source_order_transaction_id': i,
+                'processed_at': self._date(i, len(str(i)) * 10)}
+
+    def order_transactions(self, order_id: int) -> List[dict]:
+        order = next((o for o in self.orders if o['id'] == order_id), None)
+        if not order:
+            return []
+        return [{'id': order_id * 10, 'order_id': order_id, 'kind': 'sale', 'gateway': 'bogus', 'status': 'success',
+                 'amount': order['total_price'], 'currency': order['currency'], 'created_at': order['created_at']}]
+
+    def inventory_item(self, inventory_item_id: int) -> Optional[dict]:
+        variant = self.variants_by_inventory_item.get(inventory_item_id)
+        if not variant:
+            return None
+        return {'id': inventory_item_id, 'sku': variant['sku'], 'created_at': variant['updated_at'],
+                'updated_at': variant['updated_at'], 'requires_shipping': True, 'cost': '1.00',
+                'country_code_of_origin': None, 'province_code_of_origin': None, 'harmonized_system_code': None,
+                'tracked': True, 'country_harmonized_system_codes': []}
+
+    def inventory_levels(self, inventory_item_id: int) -> List[dict]:
+        variant = self.variants_by_inventory_item.get(inventory_item_id)
+        if not variant:
+            return []
+        return [{'inventory_item_id': inventory_item_id, 'location_id': location['id'],
+                 'available': variant.get('inventory_quantity', 0), 'updated_at': variant['updated_at']}
+                for location in self.locations]
+
+    def metafields(self, owner_resource: str, owner_id: int) -> List[dict]:
+        # metafields only for odd ids
+        if owner_id % 2 == 0:
+            return []
+        return [{'id': owner_id * 7, 'namespace': 'custom', 'key': 'note', 'value': f'{owner_resource} {owner_id}',
+                 'type': 'single_line_text_field', 'owner_id': owner_id, 'owner_resource': owner_resource}]
+
+
+class LeakyBucket:
+    """
+    Server side Shopify leaky bucket, requests over the bucket size are rejected with 429.
+    """
+
+    def __init__(self, size: int, restore_rate: float):
+        self.size = size
+        self.restore_rate = restore_rate
+        self._level = 0.0
+        self._last_leak = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> Optional[int]:
+        """
+        Returns the bucket level after the request, None if the bucket is full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._level = max(0.0, self._level - (now - self._last_leak) * self.restore_rate)
+            self._last_leak = now
+            if self._level + 1 > self.size:
+                return None
+            self._level += 1
+            return math.ceil(self._level)
+
+
+class ShopifyStub:
+    """
+    HTTP server answering the REST requests of the ShopifyClient from the ShopData.
+    """
+
+    def __init__(self, data: ShopData = None, bucket_size: int = 40, restore_rate: float = None):
+        """
+
+        Args:
+            data: Served shop
+            bucket_size: Size of the simulated leaky bucket
+            restore_rate: Requests per second leaking from the bucket, by default the bucket drains in 20 seconds
+        """
+        self.data = data or ShopData()
+        self.bucket = LeakyBucket(bucket_size, restore_rate or bucket_size / 20)
+        # request paths with the query (e.g. ``orders.json?limit=250``) in the order they were received
+        self.requests: List[str] = []
+        self.status_counts = Counter()
+
+        self._faults: List[list] = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    def start(self) -> 'ShopifyStub':
+        stub = self
+
+        class Handler(StubRequestHandler):
+            shopify_stub = stub
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='shopify-stub', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def inject(self, path_pattern: str, status: int, times: int = 1):
+        """
+        Respond with the status to the next requests whose path and query (e.g. ``orders.json?limit=250``) match the
+        pattern, ``CONNECTION_RESET`` closes the connection instead.
+        """
+        with self._lock:
+            self._faults.append([re.compile(path_pattern), status, times])
+
+    def redirect_client(self):
+        """
+        Returns a patch sending the requests of all ShopifyClients to this stub.
+        """
+        return redirect_client(self.port)
+
+    def _take_fault(self, path: str) -> Optional[int]:
+        with self._lock:
+            for fault in self._faults:
+                pattern, status, remaining = fault
+                if remaining > 0 and pattern.search(path):
+                    fault[2] -= 1
+                    return status
+        return None
+
+    def _record(self, path: str, status: int):
+        with self._lock:
+            self.requests.append(path)
+            self.status_counts[status] += 1
+
+
+def redirect_client(port: int):
+    """
+    Patch of the ShopifyClient session sending the requests to the stub on the local port.
+    """
+    original = ShopifyClient.activate_session
+
+    def activate_session(client):
+        client.session.protocol = 'http'
+        client.session.url = f'127.0.0.1:{port}'
+        original(client)
+
+    return mock.patch.object(ShopifyClient, 'activate_session', activate_session)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    shopify_stub: ShopifyStub = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.shopify_stub
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r'^/admin/api/[^/]+/', '', url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        request = f'{path}?{url.query}'
+
+        status = stub._take_fault(request)
+        if status == CONNECTION_RESET:
+            stub._record(request, status)
+            self.close_connection = True
+            return
+
+        level = stub.bucket.take()
+        if level is None:
+            status = 429
+        if status:
+            stub._record(request, status)
+            self._send(status, {'errors': ERROR_MESSAGES.get(status, 'Error')}, level)
+            return
+
+        key, records = self._find(path, query)
+        if key is None:
+            stub._record(request, 404)
+            self._send(404, {'errors': 'Not Found'}, level)
+            return
+
+        stub._record(request, 200)
+        limit = min(int(query.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = 0
+        if 'page_info' in query:
+            offset = self._decode_cursor(query['page_info'])['offset']
+
+        headers = {}
+        if offset + limit < len(records):
+            page_info = self._encode_cursor({'offset': offset + limit, 'query': self._filters(query)})
+            next_url = f"http://{self.headers['Host']}{url.path}?limit={limit}&page_info={page_info}"
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        self._send(200, {key: records[offset:offset + limit]}, level, headers)
+
+    @staticmethod
+    def _encode_cursor(cursor: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(page_info: str) -> dict:
+        return json.loads(base64.urlsafe_b64decode(page_info))
+
+    def _filters(self, query: dict) -> dict:
+        # filters of the next pages are carried in the cursor, like in the real API
+        if 'page_info' in query:
+            return self._decode_cursor(query['page_info'])['query']
+        return query
+
+    def _find(self, path: str, query: dict):
+        """
+        Returns the root element and all records matching the filters of the query.
+        """
+        data = self.shopify_stub.data
+        query = self._filters(query)
+
+        match = re.fullmatch(r'orders/(\d+)/transactions\.json', path)
+        if match:
+            return 'transactions', data.order_transactions(int(match.group(1)))
+        match = re.fullmatch(r'(products|variants)/(\d+)/metafields\.json', path)
+        if match:
+            return 'metafields', data.metafields(match.group(1)[:-1], int(match.group(2)))
+        if path == 'metafields.json':
+            owner_id = query.get('metafield[owner_id]')
+            owner_resource = query.get('metafield[owner_resource]', 'product')
+            return 'metafields', data.metafields(owner_resource, int(owner_id)) if owner_id else []
+        if path == 'inventory_items.json':
+            ids = [int(i) for i in query.get('ids', '').split(',') if i]
+            return 'inventory_items', [item for item in map(data.inventory_item, ids) if item]
+        if path == 'inventory_levels.json':
+            ids = [int(i) for i in query.get('inventory_item_ids', '').split(',') if i]
+            return 'inventory_levels', [level for i in ids for level in data.inventory_levels(i)]
+        if path == 'locations.json':
+            return 'locations', data.locations
+        if path == 'shopify_payments/balance/transactions.json':
+            since_id = int(query.get('since_id', 0))
+            return 'transactions', [t for t in data.payments_transactions if t['id'] > since_id]
+
+        collections = {'orders.json': data.orders, 'products.json': data.products,
+                       'customers.json': data.customers, 'events.json': data.events}
+        if path not in collections:
+            return None, None
+        return path[:-len('.json')], self._filter(collections[path], query)
+
+    @staticmethod
+    def _filter(records: List[dict], query: Dict[str, str]) -> List[dict]:
+        for field in ('updated_at', 'created_at'):
+            if f'{field}_min' in query:
+                start = _parse_datetime(query[f'{field}_min'])
+                records = [r for r in records if start <= _parse_datetime(r[field])]
+            if f'{field}_max' in query:
+                end = _parse_datetime(query[f'{field}_max'])
+                records = [r for r in records if _parse_datetime(r[field]) <= end]
+        if 'ids' in query:
+            ids = {int(i) for i in query['ids'].split(',')}
+            records = [r for r in records if r['id'] in ids]
+        if 'since_id' in query:
+            records = [r for r in records if r['id'] > int(query['since_id'])]
+        if 'verb' in query:
+            records = [r for r in records if r.get('verb') == query['verb']]
+        if 'filter' in query:
+            subject_types = set(query['filter'].split(','))
+            records = [r for r in records if r.get('subject_type') in subject_types]
+        return records
+
+    def _send(self, status: int, body: dict, level: Optional[int], headers: Dict[str, str] = None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        bucket = self.shopify_stub.bucket
+        self.send_header('X-Shopify-Shop-Api-Call-Limit', f'{level or bucket.size}/{bucket.size}')
+        if status == 429:
+            self.send_header('Retry-After', '0.5')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def run_component(data_dir: str, parameters: dict, state: dict = None):
+    """
+    Run the component with the configuration parameters in the data folder, the output is in ``data_dir/out``.
+    Requests are sent to the stub when called within its ``redirect_client``.
+    """
+    from component import Component
+
+    for folder in ('in', 'out/tables', 'out/files'):
+        os.makedirs(os.path.join(data_dir, folder), exist_ok=True)
+    with open(os.path.join(data_dir, 'config.json'), 'w') as config_file:
+        json.dump({'parameters': parameters}, config_file)
+    if state is not None:
+        with open(os.path.join(data_dir, 'in', 'state.json'), 'w') as state_file:
+            json.dump(state, state_file)
+
+    with mock.patch.dict(os.environ, {'KBC_DATADIR': data_dir}):
+        Component().run()
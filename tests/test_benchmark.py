@@ -0,0 +1,183 @@
+"""
+End-to-end benchmarks of Component.run against the local Shopify stub, reporting the throughput, request counts and
+peak memory of each scenario. Skipped unless the SHOPIFY_BENCHMARK environment variable is set:
+
+    SHOPIFY_BENCHMARK=1 python -m unittest tests.test_benchmark
+
+Each scenario runs in a fresh process, so the peak memory is not affected by the other scenarios. The report is
+printed and written as JSON to the path in SHOPIFY_BENCHMARK_REPORT, if set.
+"""
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import traceback
+import unittest
+from typing import Dict
+
+from tests.shopify_stub import ShopData, ShopifyStub, redirect_client, run_component
+
+BENCHMARK_ENABLED = bool(os.environ.get('SHOPIFY_BENCHMARK'))
+REPORT_PATH = os.environ.get('SHOPIFY_BENCHMARK_REPORT')
+
+# bucket large enough for the call limit not to dominate the measured time
+UNTHROTTLED_BUCKET_SIZE = 4000
+
+BASE_PARAMETERS = {'#api_token': 'shpat_benchmark', 'shop': 'benchmark',
+                   'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                       'fetch_parameter': 'updated_at', 'incremental_output': 1},
+                   'endpoints': {}}
+
+SCENARIOS = {
+    'orders': dict(
+        data=dict(orders=1000, line_items=5, products=0, customers=250, events=0, payments_transactions=0),
+        loading_options={},
+        endpoints={'orders': True},
+        expected_rows={'order.csv': 1000, 'line_item.csv': 5000, 'customer.csv': 250},
+        # 1000 orders in pages of 250, split by the date windows
+        max_requests=10),
+    'large_orders': dict(
+        data=dict(orders=200, line_items=250, products=0, customers=50, events=0, payments_transactions=0),
+        loading_options={'raw_json': True, 'http_transport': 'pooled'},
+        endpoints={'orders': True},
+        expected_rows={'order.csv': 200, 'line_item.csv': 50000},
+        max_requests=10),
+    'all_endpoints': dict(
+        data=dict(orders=500, line_items=5, products=300, variants=3, customers=200, events=1000,
+                  payments_transactions=1000),
+        loading_options={'parallel_endpoints': True, 'max_workers': 4, 'raw_json': True,
+                         'http_transport': 'pooled'},
+        endpoints={'orders': True, 'transactions': True, 'products': True, 'inventory': True,
+                   'customers': True, 'payments_transactions': True,
+                   'events': [{'filters': ['Order', 'Product'], 'types': ''}]},
+        expected_rows={'order.csv': 500, 'transactions.csv': 500, 'product.csv': 300, 'product_variant.csv': 900,
+                       'inventory_items.csv': 900, 'inventory_levels.csv': 900, 'customer.csv': 200,
+                       'events.csv': 1000, 'payments_transactions.csv': 1000},
+        # 500 order transactions and 9 inventory items + 18 inventory levels batches
+        max_requests=600),
+    'throttled': dict(
+        data=dict(orders=80, line_items=3, products=0, customers=20, events=0, payments_transactions=0),
+        loading_options={'max_workers': 2},
+        endpoints={'orders': True, 'transactions': True},
+        bucket_size=40,
+        expected_rows={'order.csv': 80, 'transactions.csv': 80},
+        max_requests=90),
+}
+
+
+def _run_scenario(port: int, data_dir: str, parameters: dict, results: multiprocessing.Queue):
+    """
+    Runs the component in the benchmark process and reports the elapsed time and peak memory.
+    """
+    try:
+        start = time.perf_counter()
+        with redirect_client(port):
+            run_component(data_dir, parameters)
+        elapsed = time.perf_counter() - start
+        results.put({'elapsed_s': elapsed, 'peak_rss_mb': peak_rss_mb()})
+    except BaseException:
+        results.put({'error': traceback.format_exc()})
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak memory of this process. The high water mark of the process memory is preferred, ru_maxrss keeps the peak of
+    the parent the process was forked from.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_rows(tables_path: str) -> Dict[str, int]:
+    rows = {}
+    for file_name in sorted(os.listdir(tables_path)):
+        if file_name.endswith('.csv'):
+            with open(os.path.join(tables_path, file_name), newline='') as f:
+                rows[file_name] = sum(1 for _ in csv.DictReader(f))
+    return rows
+
+
+@unittest.skipUnless(BENCHMARK_ENABLED, 'Set SHOPIFY_BENCHMARK to run the benchmarks')
+class TestBenchmark(unittest.TestCase):
+    report = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.report:
+            return
+        print('\n' + format_report(cls.report))
+        if REPORT_PATH:
+            with open(REPORT_PATH, 'w') as report_file:
+                json.dump(cls.report, report_file, indent=2)
+
+    def run_scenario(self, name: str) -> dict:
+        scenario = SCENARIOS[name]
+        parameters = json.loads(json.dumps(BASE_PARAMETERS))
+        parameters['loading_options'].update(scenario['loading_options'])
+        parameters['endpoints'].update(scenario['endpoints'])
+
+        context = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as data_dir, \
+                ShopifyStub(ShopData(**scenario['data']),
+                            bucket_size=scenario.get('bucket_size', UNTHROTTLED_BUCKET_SIZE)) as stub:
+            results = context.Queue()
+            process = context.Process(target=_run_scenario, args=(stub.port, data_dir, parameters, results))
+            process.start()
+            result = results.get()
+            process.join()
+            self.assertNotIn('error', result, result.get('error'))
+            rows = count_rows(os.path.join(data_dir, 'out', 'tables'))
+
+        total_rows = sum(rows.values())
+        requests = len(stub.requests)
+        self.report[name] = {'elapsed_s': round(result['elapsed_s'], 3),
+                             'requests': requests,
+                             'requests_per_s': round(requests / result['elapsed_s'], 1),
+                             'throttled_requests': stub.status_counts[429],
+                             'rows': total_rows,
+                             'rows_per_s': round(total_rows / result['elapsed_s'], 1),
+                             'peak_rss_mb': round(result['peak_rss_mb'], 1),
+                             'tables': rows}
+
+        for file_name, expected in scenario['expected_rows'].items():
+            self.assertEqual(expected, rows.get(file_name), file_name)
+        self.assertLessEqual(requests, scenario['max_requests'])
+        # the client paces the requests by the call limit header, nothing should be rejected
+        self.assertEqual(0, stub.status_counts[429])
+        return self.report[name]
+
+    def test_orders(self):
+        self.run_scenario('orders')
+
+    def test_large_orders(self):
+        self.run_scenario('large_orders')
+
+    def test_all_endpoints(self):
+        self.run_scenario('all_endpoints')
+
+    def test_throttled(self):
+        self.run_scenario('throttled')
+
+
+def format_report(report: dict) -> str:
+    header = f"{'scenario':<16}{'time [s]':>10}{'requests':>10}{'req/s':>8}{'429':>6}{'rows':>9}{'rows/s':>10}" \
+             f"{'peak RSS [MB]':>15}"
+    lines = [header, '-' * len(header)]
+    for name, r in report.items():
+        lines.append(f"{name:<16}{r['elapsed_s']:>10.2f}{r['requests']:>10}{r['requests_per_s']:>8.1f}"
+                     f"{r['throttled_requests']:>6}{r['rows']:>9}{r['rows_per_s']:>10.0f}{r['peak_rss_mb']:>15.1f}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,12 +3,21 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import csv
+import datetime
+import json
 import mock
 import os
+import tempfile
+import threading
+import time
 import unittest
+import urllib.parse
 from freezegun import freeze_time
 
 from component import Component
+from incremental import as_aware
+from tests.shopify_stub import CONNECTION_RESET, SHOP_TIMEZONE, ShopData, ShopifyStub, run_component
 
 
 class TestComponent(unittest.TestCase):
@@ -35,6 +44,233 @@ class TestComponent(unittest.TestCase):
         self.assertEqual(cm.exception.code, 1)
 
 
+class TestComponentEndToEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ShopData(orders=20, line_items=2, products=30, customers=10, events=40,
+                             payments_transactions=60)
+        self.stub = ShopifyStub(self.data).start()
+        self.addCleanup(self.stub.stop)
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+
+    def _row_count(self, file_name):
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', file_name)) as f:
+            return sum(1 for _ in csv.DictReader(f))
+
+    def test_run_with_retried_errors(self):
+        self.stub.inject(r'^orders\.json', 429)
+        self.stub.inject(r'^products\.json', 500)
+        with self.stub.redirect_client():
+            run_component(self.data_dir.name,
+                          {'#api_token': 'shpat_test', 'shop': 'test',
+                           'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                               'fetch_parameter': 'updated_at', 'incremental_output': 1,
+                                               'write_metrics': True},
+                           'endpoints': {'orders': True, 'transactions': True, 'products': True,
+                                         'inventory': True, 'customers': True, 'payments_transactions': True,
+                                         'events': [{'filters': ['Order'], 'types': 'create'}]}})
+
+        self.assertEqual(1, self.stub.status_counts[429])
+        self.assertEqual(1, self.stub.status_counts[500])
+        self.assertEqual(20, self._row_count('order.csv'))
+        self.assertEqual(40, self._row_count('line_item.csv'))
+        self.assertEqual(20, self._row_count('transactions.csv'))
+        self.assertEqual(60, self._row_count('product_variant.csv'))
+        self.assertEqual(60, self._row_count('inventory_items.csv'))
+        self.assertEqual(10, self._row_count('customer.csv'))
+        self.assertEqual(60, self._row_count('payments_transactions.csv'))
+        self.assertEqual(10, self._row_count('events.csv'))
+
+        with open(os.path.join(self.data_dir.name, 'out', 'files', 'shopify_metrics.json')) as f:
+            metrics = json.load(f)
+        self.assertEqual(len(self.stub.requests), metrics['requests'])
+        self.assertEqual(1, metrics['endpoints']['orders']['throttled'])
+        self.assertEqual(1, metrics['endpoints']['products']['server_errors'])
+        self.assertGreater(metrics['endpoints']['products']['backoff_s'], 0)
+        self.assertEqual(20, metrics['endpoints']['orders/{id}/transactions']['requests'])
+        self.assertEqual(40, metrics['tables']['line_item']['rows'])
+        self.assertEqual(20, metrics['tables']['transactions']['rows'])
+        self.assertEqual(20, metrics['pipelines']['orders']['write']['items'])
+
+    def test_interrupted_download_continues_from_checkpoint(self):
+        self.stub.stop()
+        data = ShopData(orders=20, line_items=1, products=0, customers=5, events=0, payments_transactions=0,
+                        start=datetime.datetime(2019, 12, 1, tzinfo=SHOP_TIMEZONE), period=datetime.timedelta(days=90))
+        self.stub = ShopifyStub(data).start()
+        # the second orders window fails
+        self.stub.inject(r'^orders\.json\?(?!.*updated_at_min=2019-12-01T)', CONNECTION_RESET)
+        parameters = {'#api_token': 'shpat_test', 'shop': 'test',
+                      'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                          'fetch_parameter': 'updated_at', 'incremental_output': 1,
+                                          'checkpoint_windows': True},
+                      'endpoints': {'orders': True}}
+
+        with self.stub.redirect_client():
+            run_component(self.data_dir.name, parameters)
+        first_run_ids = self._order_ids()
+        with open(os.path.join(self.data_dir.name, 'out', 'state.json')) as f:
+            state = json.load(f)
+        checkpoint = state['checkpoints']['orders']
+        self.assertEqual('updated_at', checkpoint['field'])
+        self.assertTrue(0 < len(first_run_ids) < 20)
+
+        self.stub.requests.clear()
+        with self.stub.redirect_client():
+            run_component(self.data_dir.name, parameters, state=state)
+        with open(os.path.join(self.data_dir.name, 'out', 'state.json')) as f:
+            self.assertNotIn('checkpoints', json.load(f))
+
+        first_request = urllib.parse.parse_qs(urllib.parse.urlsplit(self.stub.requests[0]).query)
+        # the checkpoint of the configured period is in local time, the continued period is timezone aware
+        self.assertEqual(as_aware(datetime.datetime.fromisoformat(checkpoint['completed_until'])),
+                         datetime.datetime.fromisoformat(first_request['updated_at_min'][0]))
+        self.assertEqual(set(str(i) for i in range(1, 21)), first_run_ids | self._order_ids())
+
+    def test_customers_of_orders_keep_addresses(self):
+        self.stub.stop()
+        self.stub = ShopifyStub(ShopData(orders=30, customers=10)).start()
+        with self.stub.redirect_client():
+            run_component(self.data_dir.name,
+                          {'#api_token': 'shpat_test', 'shop': 'test',
+                           'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                               'fetch_parameter': 'updated_at', 'incremental_output': 1},
+                           'endpoints': {'orders': True, 'customers': True}})
+
+        self.assertEqual(10, self._row_count('customer.csv'))
+        self.assertEqual(10, self._row_count('customer_addresses.csv'))
+
+    def test_since_last_run_requires_incremental_output(self):
+        state = {'watermarks': {'orders': {'field': 'updated_at', 'value': '2020-01-20T00:00:00+00:00'}}}
+        for incremental_output, since in ((1, '2020-01-19T23:50:00+00:00'), (0, '2019-12-01T00:00:00')):
+            self.stub.requests.clear()
+            with self.stub.redirect_client():
+                run_component(self.data_dir.name,
+                              {'#api_token': 'shpat_test', 'shop': 'test',
+                               'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                                   'fetch_parameter': 'updated_at',
+                                                   'incremental_output': incremental_output,
+                                                   'incremental_since_last_run': True},
+                               'endpoints': {'orders': True}}, state=state)
+
+            first_request = urllib.parse.parse_qs(urllib.parse.urlsplit(self.stub.requests[0]).query)
+            self.assertEqual(since, first_request['updated_at_min'][0])
+
+    def test_payments_cursor_requires_incremental_output(self):
+        state = {'cursors': {'payments_transactions': {'since_id': 40,
+                                                       'refreshed_at': datetime.datetime.now(
+                                                           datetime.timezone.utc).isoformat()}}}
+        for incremental_output, rows in ((1, 20), (0, 60)):
+            self.stub.requests.clear()
+            with self.stub.redirect_client():
+                run_component(self.data_dir.name,
+                              {'#api_token': 'shpat_test', 'shop': 'test',
+                               'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                                   'fetch_parameter': 'updated_at',
+                                                   'incremental_output': incremental_output,
+                                                   'incremental_since_last_run': True},
+                               'endpoints': {'payments_transactions': True}}, state=state)
+
+            self.assertEqual(rows, self._row_count('payments_transactions.csv'))
+            self.assertEqual(incremental_output == 1, any('since_id=40' in r for r in self.stub.requests))
+
+    def _run_orders(self, get_order_transactions):
+        with self.stub.redirect_client(), \
+                mock.patch.object(Component, 'get_order_transactions', autospec=True,
+                                  side_effect=get_order_transactions):
+            run_component(self.data_dir.name,
+                          {'#api_token': 'shpat_test', 'shop': 'test',
+                           'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                               'fetch_parameter': 'updated_at', 'incremental_output': 1,
+                                               'max_workers': 1},
+                           'endpoints': {'orders': True, 'transactions': True}})
+
+    def test_order_transactions_fetched_in_background(self):
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def get_order_transactions(component, order_id):
+            with lock:
+                running.append(order_id)
+                concurrency.append(len(running))
+            # transactions of the earlier orders take longer
+            time.sleep(0.02 if order_id % 2 else 0)
+            with lock:
+                running.remove(order_id)
+            return [{'id': order_id * 10, 'order_id': order_id, 'amount': '1.00'}]
+
+        self._run_orders(get_order_transactions)
+
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'order.csv')) as f:
+            order_ids = [row['id'] for row in csv.DictReader(f)]
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'transactions.csv')) as f:
+            transaction_order_ids = [row['order_id'] for row in csv.DictReader(f)]
+        # written in the order of the orders, fetched by the MIN_BACKGROUND_WORKERS threads
+        self.assertEqual(order_ids, transaction_order_ids)
+        self.assertEqual(2, max(concurrency))
+
+    def test_order_transactions_error_fails_run(self):
+        def get_order_transactions(component, order_id):
+            if order_id == 5:
+                raise ValueError('Failed transactions')
+            return []
+
+        with self.assertRaisesRegex(ValueError, 'Failed transactions'):
+            self._run_orders(get_order_transactions)
+
+    def _run_products(self, get_metafields):
+        with self.stub.redirect_client(), \
+                mock.patch.object(Component, 'get_metafields', autospec=True, side_effect=get_metafields):
+            run_component(self.data_dir.name,
+                          {'#api_token': 'shpat_test', 'shop': 'test',
+                           'loading_options': {'date_since': '2019-12-01', 'date_to': '2020-03-01',
+                                               'fetch_parameter': 'updated_at', 'incremental_output': 1},
+                           'endpoints': {'products': True, 'product_metafields': True,
+                                         'variant_metafields': True}})
+
+    def test_metafields_fetched_in_background(self):
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def get_metafields(component, object_type, owner_id):
+            owner = (object_type, owner_id)
+            with lock:
+                running.append(owner)
+                concurrency.append(len(running))
+            # metafields of every other owner take longer
+            time.sleep(0.01 if owner_id % 2 else 0)
+            with lock:
+                running.remove(owner)
+            return [{'id': f'{object_type}-{owner_id}', 'owner_id': owner_id, 'owner_resource': object_type}]
+
+        self._run_products(get_metafields)
+
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'product.csv')) as f:
+            product_ids = [row['id'] for row in csv.DictReader(f)]
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'product_variant.csv')) as f:
+            variant_ids = [row['id'] for row in csv.DictReader(f)]
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'metafields.csv')) as f:
+            owners = [(row['owner_resource'], row['owner_id']) for row in csv.DictReader(f)]
+        # written in the order of the products followed by their variants, all in a single chunk
+        self.assertEqual([('products', i) for i in product_ids] + [('variants', i) for i in variant_ids], owners)
+        self.assertEqual(2, max(concurrency))
+
+    def test_metafields_error_fails_run(self):
+        def get_metafields(component, object_type, owner_id):
+            if object_type == 'variants':
+                raise ValueError('Failed metafields')
+            return []
+
+        with self.assertRaisesRegex(ValueError, 'Failed metafields'):
+            self._run_products(get_metafields)
+
+    def _order_ids(self):
+        with open(os.path.join(self.data_dir.name, 'out', 'tables', 'order.csv')) as f:
+            return {row['id'] for row in csv.DictReader(f)}
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
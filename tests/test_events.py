@@ -0,0 +1,34 @@
+import unittest
+
+from events import EventsSelection
+
+
+class TestEventsSelection(unittest.TestCase):
+
+    def test_single_verb_filtered_by_api(self):
+        selection = EventsSelection([{'filters': ['Order'], 'types': 'create'}])
+        self.assertEqual(['Order'], selection.filters)
+        self.assertEqual('create', selection.verb)
+
+    def test_verbs_matched_on_client(self):
+        selection = EventsSelection([{'filters': ['Order', 'Product'], 'types': 'create, destroy'},
+                                     {'filters': ['Collection'], 'types': 'update'}])
+        self.assertEqual(['Collection', 'Order', 'Product'], selection.filters)
+        self.assertIsNone(selection.verb)
+
+        self.assertTrue(selection.matches({'subject_type': 'Product', 'verb': 'destroy'}))
+        self.assertTrue(selection.matches({'subject_type': 'Collection', 'verb': 'update'}))
+        self.assertFalse(selection.matches({'subject_type': 'Collection', 'verb': 'create'}))
+        self.assertFalse(selection.matches({'subject_type': 'Order', 'verb': 'confirmed'}))
+
+    def test_empty_selects_all(self):
+        selection = EventsSelection([{'filters': ['Order'], 'types': ''}, {'filters': [], 'types': 'create'}])
+        self.assertIsNone(selection.filters)
+        self.assertIsNone(selection.verb)
+        self.assertTrue(selection.matches({'subject_type': 'Order', 'verb': 'confirmed'}))
+        self.assertTrue(selection.matches({'subject_type': 'Blog', 'verb': 'create'}))
+        self.assertFalse(selection.matches({'subject_type': 'Blog', 'verb': 'destroy'}))
+
+
+if __name__ == "__main__":
+    unittest.main()
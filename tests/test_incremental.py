@@ -0,0 +1,115 @@
+import datetime
+import unittest
+
+from incremental import IdCursor, Watermark, WindowCheckpoint, load_id_cursor, load_watermark, \
+    load_window_checkpoint, store_id_cursor, store_watermark, store_window_checkpoint
+
+
+class TestWatermark(unittest.TestCase):
+
+    def test_tracks_latest_instant(self):
+        watermark = Watermark('updated_at')
+        watermark.track({'updated_at': '2020-11-01T01:30:00-04:00'})
+        # earlier wall clock time, but later instant
+        watermark.track({'updated_at': '2020-11-01T01:10:00-05:00'})
+        watermark.track({'updated_at': '2020-10-01T00:00:00Z'})
+        watermark.track({'updated_at': None})
+
+        self.assertEqual('2020-11-01T01:10:00-05:00', watermark.value)
+        self.assertEqual(datetime.datetime(2020, 11, 1, 1, 0, tzinfo=datetime.timezone(-datetime.timedelta(hours=5))),
+                         watermark.get_resume_date())
+
+    def test_state_round_trip(self):
+        state = {}
+        watermark = Watermark('updated_at')
+        store_watermark(state, 'orders', watermark)
+        self.assertEqual({}, state)
+
+        watermark.track({'updated_at': '2020-01-01T10:00:00+01:00'})
+        store_watermark(state, 'orders', watermark)
+
+        self.assertEqual('2020-01-01T10:00:00+01:00', load_watermark(state, 'orders', 'updated_at').value)
+        # watermark of a different fetch parameter is not used
+        self.assertIsNone(load_watermark(state, 'orders', 'created_at').get_resume_date())
+
+
+
+class TestIdCursor(unittest.TestCase):
+
+    def test_tracks_max_id(self):
+        cursor = IdCursor()
+        self.assertTrue(cursor.is_refresh_due(None))
+        for record in ({'id': 5}, {'id': 12}, {'id': 7}, {'id': None}):
+            cursor.track(record)
+        self.assertEqual(12, cursor.value)
+        self.assertFalse(cursor.is_refresh_due(None))
+
+    def test_full_refresh_interval(self):
+        state = {}
+        cursor = IdCursor(10)
+        cursor.mark_refreshed()
+        store_id_cursor(state, 'payments_transactions', cursor)
+
+        cursor = load_id_cursor(state, 'payments_transactions')
+        self.assertEqual(10, cursor.value)
+        self.assertFalse(cursor.is_refresh_due(datetime.timedelta(days=7)))
+
+        cursor.refreshed_at = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=8)).isoformat()
+        self.assertTrue(cursor.is_refresh_due(datetime.timedelta(days=7)))
+        self.assertFalse(cursor.is_refresh_due(None))
+
+
+def day(d: int) -> datetime.datetime:
+    return datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(days=d)
+
+
+class TestWindowCheckpoint(unittest.TestCase):
+
+    def test_windows_completed_out_of_order(self):
+        checkpoint = WindowCheckpoint('updated_at')
+        checkpoint.start(day(0))
+        self.assertFalse(checkpoint.has_progress)
+
+        checkpoint.complete((day(2), day(4)))
+        self.assertEqual(day(0), checkpoint.completed_until)
+        checkpoint.complete((day(0), day(1)))
+        self.assertEqual(day(1), checkpoint.completed_until)
+        checkpoint.complete((day(1), day(2)))
+        self.assertEqual(day(4), checkpoint.completed_until)
+        self.assertTrue(checkpoint.has_progress)
+
+    def test_interrupted_download_resumed(self):
+        state = {}
+        checkpoint = WindowCheckpoint('updated_at')
+        checkpoint.start(day(0))
+        checkpoint.complete((day(0), day(10)))
+        checkpoint.interrupt(ValueError('Failed window'))
+        store_window_checkpoint(state, 'orders', checkpoint)
+
+        checkpoint = load_window_checkpoint(state, 'orders', 'updated_at')
+        self.assertEqual(day(10), checkpoint.get_resume_date(day(0), day(30)))
+        # relative period start moved since the last run
+        self.assertEqual(day(10), checkpoint.get_resume_date(day(1), day(31)))
+        # longer backfill or checkpoint out of the period
+        self.assertIsNone(checkpoint.get_resume_date(day(-1), day(30)))
+        self.assertIsNone(checkpoint.get_resume_date(day(0), day(5)))
+        self.assertIsNone(load_window_checkpoint(state, 'orders', 'created_at').get_resume_date(day(0), day(30)))
+
+        # interrupted again, the checkpoint keeps the start of the original period
+        checkpoint.start(day(10))
+        checkpoint.complete((day(10), day(20)))
+        checkpoint.interrupt(ValueError('Failed window'))
+        store_window_checkpoint(state, 'orders', checkpoint)
+        self.assertEqual(day(20), load_window_checkpoint(state, 'orders', 'updated_at').get_resume_date(day(0),
+                                                                                                        day(30)))
+
+        # completed download removes the checkpoint
+        checkpoint = load_window_checkpoint(state, 'orders', 'updated_at')
+        checkpoint.start(day(20))
+        checkpoint.complete((day(20), day(30)))
+        store_window_checkpoint(state, 'orders', checkpoint)
+        self.assertEqual({}, state)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import datetime
+import unittest
+
+import mock
+
+from inventory import InventoryCache, InventoryCollector, load_inventory_cache, store_inventory_cache
+from shopify_cli import TaskPool
+
+
+def variants(ids, quantity=1):
+    return [{'id': int(i) * 10, 'inventory_item_id': int(i), 'inventory_quantity': quantity} for i in ids]
+
+
+def fake_client():
+    client = mock.Mock()
+    client.get_inventory_items.side_effect = lambda ids: [{'id': i} for i in ids]
+    client.get_inventory_item_levels.side_effect = lambda ids: [{'inventory_item_id': i, 'location_id': 1}
+                                                               for i in ids]
+    return client
+
+
+class TestInventoryCollector(unittest.TestCase):
+
+    def test_ids_batched_across_chunks(self):
+        client = fake_client()
+        items_writer, levels_writer = mock.Mock(), mock.Mock()
+
+        collector = InventoryCollector(client, TaskPool(client, max_workers=1), items_writer, levels_writer)
+        ids = [str(i) for i in range(130)]
+        for chunk in (ids[:30], ids[30:90], ids[90:]):
+            collector.add(variants(chunk))
+        collector.finish()
+
+        self.assertEqual([ids[:100], ids[100:]], [c.args[0] for c in client.get_inventory_items.call_args_list])
+        self.assertEqual([ids[:50], ids[50:100], ids[100:]],
+                         [c.args[0] for c in client.get_inventory_item_levels.call_args_list])
+        self.assertEqual((2, 3), (collector.items.requests, collector.levels.requests))
+        self.assertEqual(ids, [r['id'] for c in items_writer.write_all.call_args_list for r in c.args[0]])
+        self.assertEqual(ids, [r['inventory_item_id'] for c in levels_writer.write_all.call_args_list
+                               for r in c.args[0]])
+
+    def test_unchanged_variants_skipped(self):
+        state = {}
+        store_inventory_cache(state, InventoryCache(variants={}))
+        cache = load_inventory_cache(state)
+        self.assertEqual({}, cache.variants)
+        for i in range(3):
+            cache.is_changed(variants([i])[0])
+        store_inventory_cache(state, cache)
+
+        cache = load_inventory_cache(state)
+        self.assertEqual(['0', '1', '2'], list(cache.variants))
+        client = fake_client()
+        collector = InventoryCollector(client, TaskPool(client, max_workers=1), mock.Mock(), mock.Mock(),
+                                       cache=cache)
+        collector.add(variants([0, 1], quantity=1) + variants([2, 3], quantity=5))
+        collector.finish()
+
+        self.assertEqual([['2', '3']], [c.args[0] for c in client.get_inventory_items.call_args_list])
+        self.assertEqual(2, cache.skipped)
+
+    def test_least_recently_seen_variants_dropped(self):
+        cache = InventoryCache(max_variants=2)
+        for i in range(3):
+            cache.is_changed(variants([i])[0])
+        self.assertEqual(['1', '2'], list(cache.variants))
+
+        self.assertFalse(cache.is_changed(variants([1])[0]))
+        self.assertTrue(cache.is_changed(variants([3])[0]))
+        self.assertEqual(['1', '3'], list(cache.variants))
+        # the inventory of a dropped variant is downloaded again
+        self.assertTrue(cache.is_changed(variants([0])[0]))
+
+        # a stored cache over the limit keeps the most recently seen variants
+        self.assertEqual({'1': 'b', '2': 'c'},
+                         InventoryCache(variants={'0': 'a', '1': 'b', '2': 'c'}, max_variants=2).variants)
+
+    def test_cache_dropped_after_refresh_interval(self):
+        refreshed_at = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=8)).isoformat()
+        state = {'inventory_cache': {'refreshed_at': refreshed_at, 'variants': {'1': 'abc'}}}
+
+        self.assertEqual({}, load_inventory_cache(state, datetime.timedelta(days=7)).variants)
+        self.assertEqual({'1': 'abc'}, load_inventory_cache(state, datetime.timedelta(days=10)).variants)
+
+
+if __name__ == "__main__":
+    unittest.main()
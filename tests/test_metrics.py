@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from metrics import RunMetrics, get_endpoint, percentile
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def test_endpoint_from_url(self):
+        self.assertEqual('orders', get_endpoint('https://shop.myshopify.com/admin/api/2022-10/orders.json?limit=250'))
+        self.assertEqual('orders/{id}/transactions',
+                         get_endpoint('https://shop.myshopify.com/admin/api/2022-10/orders/4507/transactions.json'))
+        self.assertEqual('shopify_payments/balance/transactions',
+                         get_endpoint('http://127.0.0.1:8080/admin/api/2022-10/shopify_payments/balance/'
+                                      'transactions.json?since_id=5'))
+
+    def test_percentile(self):
+        values = [i / 100 for i in range(1, 101)]
+        self.assertEqual(0.5, percentile(values, 50))
+        self.assertEqual(0.99, percentile(values, 99))
+        self.assertEqual(0.0, percentile([], 50))
+
+    def test_waits_attributed_to_thread_requests(self):
+        metrics = RunMetrics()
+        url = 'https://shop.myshopify.com/admin/api/2022-10/'
+
+        def fetch_orders():
+            metrics.record_limit_wait(1.5)
+            metrics.record_request(url + 'orders.json', 429, 0.1, 100)
+            metrics.record_backoff(1.0)
+            metrics.record_request(url + 'orders.json', 200, 0.3, 5000)
+
+        thread = threading.Thread(target=fetch_orders)
+        thread.start()
+        thread.join()
+        metrics.record_request(url + 'products.json', 500, 0.2, 0)
+        metrics.record_backoff(2.0)
+        metrics.record_table('order', 10, 2.0)
+
+        result = metrics.to_dict()
+        orders = result['endpoints']['orders']
+        self.assertEqual(2, orders['requests'])
+        self.assertEqual(5100, orders['bytes_received'])
+        self.assertEqual({'200': 1, '429': 1}, orders['status_codes'])
+        self.assertEqual(1, orders['throttled'])
+        self.assertEqual(1.0, orders['backoff_s'])
+        self.assertEqual(1.5, orders['limit_wait_s'])
+        self.assertEqual(300.0, orders['latency_ms']['max'])
+        self.assertEqual({'requests': 1, 'server_errors': 1, 'backoff_s': 2.0, 'limit_wait_s': 0.0},
+                         {k: result['endpoints']['products'][k]
+                          for k in ('requests', 'server_errors', 'backoff_s', 'limit_wait_s')})
+        self.assertEqual({'rows': 10, 'write_s': 2.0, 'rows_per_s': 5.0}, result['tables']['order'])
+        self.assertEqual(3, result['requests'])
+
+    def test_written_with_manifest(self):
+        metrics = RunMetrics()
+        metrics.record_request('https://shop.myshopify.com/admin/api/2022-10/orders.json', 200, 0.1, 10)
+        with tempfile.TemporaryDirectory() as files_dir:
+            path = os.path.join(files_dir, 'shopify_metrics.json')
+            metrics.write(path)
+            with open(path) as f:
+                self.assertEqual(1, json.load(f)['endpoints']['orders']['requests'])
+            with open(f'{path}.manifest') as f:
+                self.assertEqual(['shopify', 'metrics'], json.load(f)['tags'])
+
+
+if __name__ == "__main__":
+    unittest.main()
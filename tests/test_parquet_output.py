@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+import pyarrow
+import pyarrow.parquet
+
+from parquet_output import resolve_type, write_parquet
+
+
+class TestParquetOutput(unittest.TestCase):
+
+    def test_resolve_type(self):
+        self.assertEqual(pyarrow.int64(), resolve_type({int, type(None)}))
+        self.assertEqual(pyarrow.float64(), resolve_type({int, float}))
+        self.assertEqual(pyarrow.bool_(), resolve_type({bool}))
+        self.assertEqual(pyarrow.string(), resolve_type({bool, int}))
+        self.assertEqual(pyarrow.string(), resolve_type({list}))
+        self.assertEqual(pyarrow.string(), resolve_type(set()))
+
+    def test_rows_written_in_batches(self):
+        columns = ['id', 'price', 'taxable', 'tags', 'note']
+        column_types = {'id': {int}, 'price': {float, int}, 'taxable': {bool}, 'tags': {list, str}}
+        rows = [[i, i if i % 2 else 1.5, i % 3 == 0, ['a', 'b'] if i % 2 else 'c', None] for i in range(25)]
+
+        with tempfile.TemporaryDirectory() as files_dir:
+            path = os.path.join(files_dir, 'line_item.parquet')
+            self.assertEqual(25, write_parquet(path, columns, column_types, iter(rows), batch_size=10))
+
+            parquet_file = pyarrow.parquet.ParquetFile(path)
+            self.assertEqual(3, parquet_file.num_row_groups)
+            table = parquet_file.read()
+
+        self.assertEqual(['int64', 'double', 'bool', 'string', 'string'], [str(t) for t in table.schema.types])
+        self.assertEqual({'id': 1, 'price': 1.0, 'taxable': False, 'tags': '["a", "b"]', 'note': None},
+                         table.slice(1, 1).to_pylist()[0])
+        self.assertEqual('c', table.column('tags')[0].as_py())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import threading
+import unittest
+
+from pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_items_pass_all_stages_in_order(self):
+        written = []
+        pipeline = Pipeline('test', transformations=[('double', lambda x: x * 2),
+                                                     ('odd', lambda x: x if x % 4 else None)],
+                            queue_size=2)
+        pipeline.run(range(10), written.append)
+
+        self.assertEqual([2, 6, 10, 14, 18], written)
+        self.assertEqual([('fetch', 10), ('double', 10), ('odd', 10), ('write', 5)],
+                         [(s.name, s.items) for s in pipeline.stats])
+
+    def test_items_passed_in_batches(self):
+        written = []
+        pipeline = Pipeline('test', transformations=[('odd', lambda batch: [x for x in batch if x % 2] or None)],
+                            batch_size=4)
+        pipeline.run(range(10), written.append)
+
+        self.assertEqual([[1, 3], [5, 7], [9]], written)
+        self.assertEqual([('fetch', 10), ('odd', 10), ('write', 5)], [(s.name, s.items) for s in pipeline.stats])
+
+    def test_stage_threads_initialized(self):
+        initialized = set()
+        source_threads = []
+
+        def source():
+            source_threads.append(threading.current_thread().name)
+            yield 1
+
+        Pipeline('test', transformations=[('noop', lambda x: x)], thread_initializer=lambda: initialized.add(
+            threading.current_thread().name)).run(source(), lambda x: None)
+
+        self.assertEqual({'test-fetch', 'test-noop'}, initialized)
+        self.assertEqual(['test-fetch'], source_threads)
+
+    def test_source_error_raised(self):
+        def source():
+            yield 1
+            raise ValueError('fetch failed')
+
+        with self.assertRaisesRegex(ValueError, 'fetch failed'):
+            Pipeline('test').run(source(), lambda x: None)
+
+    def test_sink_error_stops_source(self):
+        closed = threading.Event()
+
+        def source():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.set()
+
+        def sink(item):
+            raise ValueError('write failed')
+
+        with self.assertRaisesRegex(ValueError, 'write failed'):
+            Pipeline('test', queue_size=1).run(source(), sink)
+        self.assertTrue(closed.is_set())
+
+
+if __name__ == "__main__":
+    unittest.main()
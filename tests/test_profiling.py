@@ -0,0 +1,61 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+from profiling import PhaseProfiler
+
+
+def build_rows(count: int) -> list:
+    return [{'id': i, 'name': f'row {i}'} for i in range(count)]
+
+
+class TestPhaseProfiler(unittest.TestCase):
+
+    def test_phase_reports_written(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            profiler = PhaseProfiler(output_dir)
+            with profiler.profile('orders'):
+                rows = build_rows(10000)
+
+            self.assertEqual(10000, len(rows))
+            self.assertEqual(['profile_orders.prof', 'profile_orders.prof.manifest',
+                              'profile_orders_cpu.txt', 'profile_orders_cpu.txt.manifest',
+                              'profile_orders_memory.txt', 'profile_orders_memory.txt.manifest'],
+                             sorted(os.listdir(output_dir)))
+
+            stats = pstats.Stats(os.path.join(output_dir, 'profile_orders.prof'))
+            self.assertIn('build_rows', [function for _, _, function in stats.stats])
+            with open(os.path.join(output_dir, 'profile_orders_memory.txt')) as memory_report:
+                report = memory_report.read()
+            self.assertIn('Phase orders: peak traced memory', report)
+            self.assertIn('test_profiling.py', report)
+            with open(os.path.join(output_dir, 'profile_orders_cpu.txt.manifest')) as manifest:
+                self.assertEqual(['shopify', 'profiling'], json.load(manifest)['tags'])
+
+    def test_threads_started_in_phase_profiled(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            profiler = PhaseProfiler(output_dir)
+            with profiler.profile('products'):
+                thread = threading.Thread(target=build_rows, args=(100,))
+                thread.start()
+                thread.join()
+
+            stats = pstats.Stats(os.path.join(output_dir, 'profile_products.prof'))
+            self.assertIn('build_rows', [function for _, _, function in stats.stats])
+
+    def test_reports_written_when_phase_fails(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            profiler = PhaseProfiler(output_dir)
+            with self.assertRaises(ValueError):
+                with profiler.profile('customers'):
+                    raise ValueError('Failed download')
+
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'profile_customers_cpu.txt')))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'profile_customers_memory.txt')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+import copy
+import csv
+import gzip
+import os
+import tempfile
+import threading
+import unittest
+
+import pyarrow
+import pyarrow.parquet
+from kbc.result import KBCTableDef, ResultWriter
+
+from result import PARQUET_TABLES, CustomersWriter, FlattenPlan, LatestVersionStore, OrderWriter, OutputOptions, \
+    ProductsWriter, RowSpool, SynchronizedResultWriter, TableWriter, get_schema_samples
+
+
+class TestLatestVersionStore(unittest.TestCase):
+
+    def _put_versions(self, store):
+        store.put({'id': 1, 'updated_at': '2020-01-02T10:00:00-05:00', 'email': 'new@example.com'})
+        store.put({'id': 1, 'updated_at': '2020-01-01T10:00:00-05:00', 'email': 'old@example.com'})
+        store.put({'id': 2, 'updated_at': '2020-01-01T10:00:00-05:00', 'email': 'b@example.com'})
+        # same version embedded in an order, merged with the full object
+        store.put({'id': 2, 'updated_at': '2020-01-01T10:00:00-05:00', 'orders_count': 3})
+        # later instant despite the earlier wall clock time
+        store.put({'id': 3, 'updated_at': '2020-11-01T01:30:00-04:00', 'email': 'first@example.com'})
+        store.put({'id': 3, 'updated_at': '2020-11-01T01:10:00-05:00', 'email': 'second@example.com'})
+
+    def assertLatestVersions(self, store):
+        customers = sorted(store, key=lambda c: c['id'])
+        self.assertEqual(3, len(store))
+        self.assertEqual('new@example.com', customers[0]['email'])
+        self.assertEqual({'id': 2, 'updated_at': '2020-01-01T10:00:00-05:00', 'email': 'b@example.com',
+                          'orders_count': 3}, customers[1])
+        self.assertEqual('second@example.com', customers[2]['email'])
+
+    def test_keeps_latest_version_with_index_in_memory(self):
+        store = LatestVersionStore()
+        self._put_versions(store)
+        self.assertEqual(3, len(store._index))
+        self.assertLatestVersions(store)
+        store.close()
+
+    def test_keeps_latest_version_with_index_on_disk(self):
+        store = LatestVersionStore(index_limit=1)
+        self._put_versions(store)
+        self.assertIsNone(store._index)
+        self.assertLatestVersions(store)
+        store.close()
+
+    def test_keeps_fields_missing_in_newer_version(self):
+        for index_limit in (10, 0):
+            store = LatestVersionStore(index_limit=index_limit)
+            full = {'id': 1, 'updated_at': '2020-01-01T10:00:00-05:00', 'email': 'old@example.com', 'note': 'vip',
+                    'addresses': [{'id': 5, 'customer_id': 1, 'city': 'Prague'}]}
+            # embedded in a later order, without the addresses
+            embedded = {'id': 1, 'updated_at': '2020-01-02T10:00:00-05:00', 'email': 'new@example.com'}
+            store.put(full)
+            store.put(embedded)
+            # an older version doesn't replace the fields of the newer one
+            store.put({'id': 1, 'updated_at': '2019-12-01T10:00:00-05:00', 'email': 'oldest@example.com',
+                       'tags': 'first'})
+
+            self.assertEqual([{'id': 1, 'updated_at': '2020-01-02T10:00:00-05:00', 'email': 'new@example.com',
+                               'note': 'vip', 'addresses': [{'id': 5, 'customer_id': 1, 'city': 'Prague'}],
+                               'tags': 'first'}], list(store))
+            store.close()
+
+    def test_compares_utc_and_offset_versions(self):
+        store = LatestVersionStore()
+        # bulk operation version in UTC is the later instant
+        store.put({'id': 1, 'updated_at': '2020-01-01T12:00:00-05:00', 'email': 'rest@example.com'})
+        store.put({'id': 1, 'updated_at': '2020-01-01T17:30:00Z', 'email': 'bulk@example.com'})
+        # REST version with the offset is the later instant
+        store.put({'id': 2, 'updated_at': '2020-01-01T17:30:00Z', 'email': 'bulk@example.com'})
+        store.put({'id': 2, 'updated_at': '2020-01-01T13:00:00-05:00', 'email': 'rest@example.com'})
+        # the same instant is merged
+        store.put({'id': 3, 'updated_at': '2020-01-01T17:00:00Z', 'email': 'bulk@example.com'})
+        store.put({'id': 3, 'updated_at': '2020-01-01T12:00:00-05:00', 'orders_count': 3})
+
+        customers = sorted(store, key=lambda c: c['id'])
+        self.assertEqual('bulk@example.com', customers[0]['email'])
+        self.assertEqual('rest@example.com', customers[1]['email'])
+        self.assertEqual(3, customers[2]['orders_count'])
+        self.assertEqual('bulk@example.com', customers[2]['email'])
+        store.close()
+
+
+class TestFlattenPlan(unittest.TestCase):
+
+    @staticmethod
+    def _write_orders(result_dir, orders, flatten_objects):
+        with ResultWriter(result_dir, KBCTableDef(name='order', pk=['id'], columns=[], destination=''),
+                          fix_headers=True, flatten_objects=flatten_objects, child_separator='__') as writer:
+            writer.write_all(orders)
+        with open(os.path.join(result_dir, 'order.csv')) as f:
+            return list(csv.DictReader(f))
+
+    def test_same_rows_as_generic_flattening(self):
+        orders = get_schema_samples('order')
+        self.assertTrue(orders)
+        plan = FlattenPlan()
+        with tempfile.TemporaryDirectory() as generic_dir, tempfile.TemporaryDirectory() as plan_dir:
+            generic_rows = self._write_orders(generic_dir, copy.deepcopy(orders), flatten_objects=True)
+            plan_rows = self._write_orders(plan_dir, [plan.flatten(order) for order in orders], flatten_objects=False)
+
+        self.assertEqual(generic_rows, plan_rows)
+
+    def test_plan_extended_with_new_keys(self):
+        plan = FlattenPlan(samples=get_schema_samples('customer'))
+        customer = {'id': 1, 'default_address': None, 'new': {'nested': {'key': 1}, 'other': [1]}}
+        self.assertEqual({'id': 1, 'default_address': None, 'new__nested__key': 1, 'new__other': [1]},
+                         plan.flatten(customer))
+        self.assertEqual({'id': 2, 'default_address__id': 5}, plan.flatten({'id': 2, 'default_address': {'id': 5}}))
+
+    def test_nested_samples(self):
+        line_items = get_schema_samples('line_item')
+        self.assertTrue(all('variant_id' in li for li in line_items))
+        self.assertEqual([], get_schema_samples('unknown_table'))
+
+
+class TestFlattenPage(unittest.TestCase):
+
+    @staticmethod
+    def _products():
+        return [{'id': i, 'title': f'product {i}', 'options': [{'id': i, 'product_id': i, 'name': 'Size'}],
+                 'variants': [{'id': i * 10 + v, 'price': '1.00', 'presentment_prices': [{'price': {'amount': '1'}}]}
+                              for v in range(2)]}
+                for i in range(3)]
+
+    @staticmethod
+    def _read_tables(result_dir):
+        tables = {}
+        for file_name in sorted(os.listdir(result_dir)):
+            with open(os.path.join(result_dir, file_name)) as f:
+                tables[file_name] = list(csv.DictReader(f))
+        return tables
+
+    def test_page_flattened_in_other_thread_written_as_records(self):
+        with tempfile.TemporaryDirectory() as expected_dir, tempfile.TemporaryDirectory() as result_dir:
+            with ProductsWriter(expected_dir, 'product', '2020-01-01', {}) as writer:
+                writer.write_all(self._products())
+
+            records = self._products()
+            pages = []
+            with ProductsWriter(result_dir, 'product', '2020-01-01', {}) as writer:
+                thread = threading.Thread(target=lambda: pages.append(writer.flatten_page(records)))
+                thread.start()
+                thread.join()
+                self.assertEqual([], os.listdir(result_dir))
+                pages[0].write()
+
+            self.assertEqual(3, len(pages[0]))
+            # the nested objects are kept for the writer stage
+            self.assertEqual([2, 2, 2], [len(r['variants']) for r in records])
+            self.assertEqual(self._read_tables(expected_dir), self._read_tables(result_dir))
+            self.assertEqual(['product.csv', 'product_options.csv', 'product_variant.csv',
+                              'product_variant_presentment_prices.csv'], sorted(self._read_tables(result_dir)))
+
+
+class TestSynchronizedResultWriter(unittest.TestCase):
+
+    def test_concurrent_writes(self):
+        with tempfile.TemporaryDirectory() as result_dir:
+            writer = SynchronizedResultWriter(result_dir, KBCTableDef(name='metafields', pk=['id'], columns=[],
+                                                                      destination=''),
+                                              child_separator='__', fix_headers=True)
+
+            def write_rows(owner_id):
+                for i in range(500):
+                    writer.write_all([{'id': f'{owner_id}-{i}', 'owner_id': owner_id, 'value': 'x' * 100}])
+
+            threads = [threading.Thread(target=write_rows, args=(owner_id,)) for owner_id in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            writer.close()
+
+            with open(os.path.join(result_dir, 'metafields.csv')) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(2000, len({r['id'] for r in rows}))
+            self.assertTrue(all(r['value'] == 'x' * 100 for r in rows))
+
+
+class TestOnePassHeaders(unittest.TestCase):
+
+    def test_spool_keeps_rows(self):
+        spool = RowSpool(['id'])
+        spool.append({'id': 1, 'name': 'a'})
+        spool.append({'tags': ['x'], 'id': 2, 'price': None})
+        self.assertEqual(['id', 'name', 'tags', 'price'], spool.columns)
+        self.assertEqual([{'id': 1, 'name': 'a'}, {'id': 2, 'tags': ['x'], 'price': None}], list(spool))
+        spool.close()
+
+    def test_table_written_with_gained_columns(self):
+        with tempfile.TemporaryDirectory() as result_dir:
+            columns = ['id', 'note']
+            writer = TableWriter(result_dir, KBCTableDef(name='events', pk=['id'], columns=columns, destination=''),
+                                 fix_headers=True, output_options=OutputOptions(one_pass_headers=True))
+            writer.write({'id': 1, 'note': 'first'})
+            writer.write({'id': 2, 'subject': {'type': 'Order'}}, user_values={'extraction_time': 'now'})
+            self.assertFalse(os.path.exists(os.path.join(result_dir, 'events.csv')))
+            writer.close()
+
+            self.assertEqual(['subject__type', 'extraction_time'], writer.gained_columns)
+            self.assertEqual(['id', 'note', 'subject__type', 'extraction_time'], columns)
+            with open(os.path.join(result_dir, 'events.csv')) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([{'id': '1', 'note': 'first', 'subject__type': '', 'extraction_time': ''},
+                              {'id': '2', 'note': '', 'subject__type': 'Order', 'extraction_time': 'now'}], rows)
+            self.assertEqual(['events.csv'], [os.path.basename(r.full_path) for r in writer.collect_results()])
+
+    def _write_sliced_table(self, result_dir, compress):
+        writer = TableWriter(result_dir, KBCTableDef(name='order', pk=['id'], columns=[], destination=''),
+                             fix_headers=True, output_options=OutputOptions(slice_size=20000, compress_slices=compress))
+        for i in range(5000):
+            writer.write({'id': i, 'note': f'order {i}'} if i % 2 else {'id': i, 'total': {'amount': i}})
+        writer.close()
+
+        path = os.path.join(result_dir, 'order.csv')
+        self.assertEqual([path], [r.full_path for r in writer.collect_results()])
+        self.assertEqual(['id', 'total__amount', 'note'], writer.table_def.columns)
+        return path, sorted(os.listdir(path))
+
+    def test_table_written_in_slices(self):
+        with tempfile.TemporaryDirectory() as result_dir:
+            path, slices = self._write_sliced_table(result_dir, compress=False)
+
+            self.assertEqual(['part_0001.csv', 'part_0002.csv'], slices[:2])
+            rows = []
+            for slice_name in slices:
+                # the text buffer is flushed to the file in 8 kB chunks
+                self.assertLess(os.path.getsize(os.path.join(path, slice_name)), 20000 + 8192)
+                with open(os.path.join(path, slice_name), newline='') as f:
+                    rows.extend(csv.reader(f))
+            self.assertEqual(5000, len(rows))
+            self.assertEqual([['0', '0', ''], ['1', '', 'order 1']], rows[:2])
+
+    def test_compressed_slices(self):
+        with tempfile.TemporaryDirectory() as result_dir:
+            path, slices = self._write_sliced_table(result_dir, compress=True)
+
+            self.assertEqual('part_0001.csv.gz', slices[0])
+            rows = []
+            for slice_name in slices:
+                with gzip.open(os.path.join(path, slice_name), 'rt', newline='') as f:
+                    rows.extend(csv.reader(f))
+            self.assertEqual(5000, len(rows))
+            self.assertEqual(['4999', '', 'order 4999'], rows[-1])
+
+    def test_table_written_to_parquet(self):
+        with tempfile.TemporaryDirectory() as result_dir, tempfile.TemporaryDirectory() as files_dir:
+            options = OutputOptions(output_format='parquet', files_path=files_dir)
+            writer = TableWriter(result_dir, KBCTableDef(name='product_variant', pk=['id'], columns=['weight'],
+                                                         destination=''), fix_headers=True, output_options=options)
+            writer.write({'id': 1, 'price': '10.00', 'grams': 100})
+            writer.write({'id': 2, 'price': '12.00', 'grams': None, 'tags': ['new']})
+            writer.close()
+
+            self.assertEqual([], writer.collect_results())
+            self.assertEqual(['product_variant.parquet', 'product_variant.parquet.manifest'],
+                             sorted(os.listdir(files_dir)))
+            table = pyarrow.parquet.read_table(os.path.join(files_dir, 'product_variant.parquet'))
+
+        self.assertEqual(['weight', 'id', 'price', 'grams', 'tags'], table.column_names)
+        self.assertEqual(pyarrow.int64(), table.schema.field('grams').type)
+        # column from the state file, empty in this run and typed by the example response
+        self.assertEqual(pyarrow.float64(), table.schema.field('weight').type)
+        self.assertEqual([{'weight': None, 'id': 1, 'price': '10.00', 'grams': 100, 'tags': None},
+                          {'weight': None, 'id': 2, 'price': '12.00', 'grams': None, 'tags': '["new"]'}],
+                         table.to_pylist())
+
+    def test_only_order_and_product_tables_written_to_parquet(self):
+        def table_writers(writer):
+            yield writer
+            for child in vars(writer).values():
+                if isinstance(child, TableWriter) and not isinstance(child, CustomersWriter):
+                    yield from table_writers(child)
+
+        with tempfile.TemporaryDirectory() as result_dir, tempfile.TemporaryDirectory() as files_dir:
+            options = OutputOptions(output_format='parquet', files_path=files_dir)
+            customers_writer = CustomersWriter(result_dir, 'customer', '2020-01-01', {}, output_options=options)
+            families = [OrderWriter(result_dir, 'order', '2020-01-01', customers_writer, {}, output_options=options),
+                        ProductsWriter(result_dir, 'product', '2020-01-01', {}, output_options=options)]
+            parquet_tables = {w.table_def.name for family in families for w in table_writers(family) if w.parquet}
+            self.assertEqual(PARQUET_TABLES, parquet_tables)
+
+            customers_writer.write({'id': 1, 'updated_at': '2020-01-01T10:00:00-05:00'})
+            customers_writer.close()
+            self.assertFalse(customers_writer.parquet)
+            self.assertEqual(['customer.csv'], [r.file_name for r in customers_writer.collect_results()])
+            self.assertEqual([], os.listdir(files_dir))
+
+            for family in families:
+                family.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import datetime
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from shopify_bulk import BulkOperationsClient, BulkOperationError
+
+ORDERS_JSONL = [
+    {'id': 'gid://shopify/Order/1', 'name': '#1001', 'tags': ['vip', 'wholesale'],
+     'total_price': {'shopMoney': {'amount': '10.50'}},
+     'customer': {'id': 'gid://shopify/Customer/7', 'email': 'bob@example.com'}},
+    {'id': 'gid://shopify/LineItem/11', 'quantity': 1, 'variant': {'id': 'gid://shopify/ProductVariant/5'},
+     '__parentId': 'gid://shopify/Order/1'},
+    {'id': 'gid://shopify/LineItem/12', 'quantity': 2, 'variant': None, '__parentId': 'gid://shopify/Order/1'},
+    {'id': 'gid://shopify/Order/2', 'name': '#1002', 'tags': [], 'customer': None},
+]
+
+PRODUCTS_JSONL = [
+    {'id': 'gid://shopify/Product/3', 'title': 'Shirt',
+     'options': [{'id': 'gid://shopify/ProductOption/30', 'name': 'Size', 'values': ['S', 'M']}]},
+    {'id': 'gid://shopify/ProductVariant/31', 'inventory_item': {'id': 'gid://shopify/InventoryItem/99'},
+     '__parentId': 'gid://shopify/Product/3'},
+    {'id': 'gid://shopify/ProductImage/32', 'src': 'https://cdn.shopify.com/shirt.png',
+     '__parentId': 'gid://shopify/Product/3'},
+]
+
+
+class BulkOperationStub(BaseHTTPRequestHandler):
+    """
+    Serves the bulkOperationRunQuery mutation, the operation status and the JSONL result.
+    """
+    result_lines = []
+    user_errors = []
+    polls = 0
+    # requests dropped by the server once: 'poll' before the response, 'result' in the middle of the file
+    drops = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        assert self.headers['X-Shopify-Access-Token'] == 'token'
+        stub = type(self)
+        if 'bulkOperationRunQuery' in request['query']:
+            stub.polls = 0
+            stub.query = request['variables']['query']
+            data = {'bulkOperationRunQuery': {
+                'bulkOperation': {'id': 'gid://shopify/BulkOperation/1', 'status': 'CREATED'},
+                'userErrors': stub.user_errors}}
+        elif 'poll' in stub.drops:
+            stub.drops.remove('poll')
+            self.close_connection = True
+            return
+        else:
+            stub.polls += 1
+            completed = stub.polls > 1
+            data = {'node': {'id': request['variables']['id'],
+                             'status': 'COMPLETED' if completed else 'RUNNING',
+                             'errorCode': None,
+                             'objectCount': str(len(stub.result_lines)),
+                             'url': f'http://{self.headers["Host"]}/result.jsonl' if completed else None,
+                             'partialDataUrl': None}}
+        self._send(json.dumps({'data': data}).encode('utf-8'))
+
+    def do_GET(self):
+        lines = '\n'.join(json.dumps(line) for line in type(self).result_lines).encode('utf-8')
+        if 'result' not in type(self).drops:
+            self._send(lines, 'application/jsonl')
+            return
+
+        type(self).drops.remove('result')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(lines)))
+        self.end_headers()
+        self.wfile.write(lines[:len(lines) // 2])
+        self.close_connection = True
+
+
+class TestBulkOperationsClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BulkOperationStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        BulkOperationStub.user_errors = []
+        BulkOperationStub.drops = set()
+
+        url = f'http://127.0.0.1:{self.server.server_port}/admin/api/2022-10/graphql.json'
+        self.client = BulkOperationsClient('test.myshopify.com', 'token', '2022-10', graphql_url=url,
+                                           poll_interval=0.01)
+        self.since = datetime.datetime(2020, 1, 1)
+        self.until = datetime.datetime(2021, 1, 1)
+
+    def test_orders_reassembled_to_rest_shape(self):
+        BulkOperationStub.result_lines = ORDERS_JSONL
+        orders = list(self.client.get_orders('updated_at', self.since, self.until))
+
+        self.assertIn("updated_at:>='2020-01-01T00:00:00' AND updated_at:<'2021-01-01T00:00:00'",
+                      BulkOperationStub.query)
+        self.assertEqual(2, len(orders))
+        first, second = orders
+        self.assertEqual(1, first['id'])
+        self.assertEqual('10.50', first['total_price'])
+        self.assertEqual('vip, wholesale', first['tags'])
+        self.assertEqual({'id': 7, 'email': 'bob@example.com'}, first['customer'])
+        self.assertEqual([{'id': 11, 'quantity': 1, 'variant_id': 5},
+                          {'id': 12, 'quantity': 2, 'variant': None}], first['line_items'])
+        self.assertEqual([], second['line_items'])
+
+    def test_products_children_linked(self):
+        BulkOperationStub.result_lines = PRODUCTS_JSONL
+        products = list(self.client.get_products('updated_at', self.since, self.until, 'active,draft'))
+
+        self.assertIn('(status:active OR status:draft)', BulkOperationStub.query)
+        product = products[0]
+        self.assertEqual([{'id': 31, 'inventory_item_id': 99, 'product_id': 3}], product['variants'])
+        self.assertEqual(3, product['images'][0]['product_id'])
+        self.assertEqual(30, product['options'][0]['id'])
+
+    def test_dropped_connections_retried(self):
+        BulkOperationStub.result_lines = ORDERS_JSONL
+        BulkOperationStub.drops = {'poll', 'result'}
+        orders = list(self.client.get_orders('updated_at', self.since, self.until))
+
+        self.assertEqual(set(), BulkOperationStub.drops)
+        self.assertEqual([1, 2], [order['id'] for order in orders])
+        self.assertEqual([11, 12], [line_item['id'] for line_item in orders[0]['line_items']])
+
+    def test_user_errors_fail(self):
+        BulkOperationStub.user_errors = [{'field': None, 'message': 'A bulk query operation is already in progress'}]
+        with self.assertRaises(BulkOperationError):
+            list(self.client.get_orders('updated_at', self.since, self.until))
+
+
+if __name__ == "__main__":
+    unittest.main()
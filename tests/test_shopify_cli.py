@@ -0,0 +1,340 @@
+import datetime
+import threading
+import time
+import unittest
+import urllib.error
+
+import mock
+import pyactiveresource.connection
+from pyactiveresource.connection import Response, ServerError
+
+from incremental import WindowCheckpoint
+from shopify_cli import ShopifyClient, DateWindowPlanner, LeakyBucketRateLimiter, DEFAULT_BUCKET_SIZE, \
+    BUCKET_SAFETY_MARGIN, MAX_RETRIES, ShopifyClientError, TaskPool, error_handling
+
+
+class FakeRecord:
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakePage(list):
+
+    def has_next_page(self):
+        return False
+
+
+class FakeApi:
+
+    def __init__(self, rate_limiter, failures: int):
+        self.rate_limiter = rate_limiter
+        self.failures = failures
+
+    @error_handling
+    def get_page(self):
+        if self.failures:
+            self.failures -= 1
+            raise ServerError()
+        return 'page'
+
+
+def acquire_in_threads(limiter, count: int):
+    # the threads are alive until all of them acquired their slot, so their ids aren't reused
+    acquired = threading.Barrier(count)
+
+    def acquire():
+        limiter.acquire()
+        acquired.wait()
+
+    workers = [threading.Thread(target=acquire) for _ in range(count)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def fake_pages(query_params):
+    # single page with one record per window, identified by the window
+    return [FakePage([FakeRecord({'id': (query_params['updated_at_min'], query_params['updated_at_max'])})])]
+
+
+class TestShopifyClient(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(ShopifyClient, '_try_get_credits', return_value=(1, 40))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_windows(self, client):
+        records = client.get_objects_paginated(mock.Mock(), datetime_min=datetime.datetime(2020, 1, 1),
+                                               datetime_max=datetime.datetime(2021, 1, 1), date_window_size=1)
+        return [r['id'] for r in records]
+
+    def assertContiguousWindows(self, windows):
+        self.assertEqual('2020-01-01T00:00:00', windows[0][0])
+        self.assertEqual('2021-01-01T00:00:00', windows[-1][1])
+        for previous, current in zip(windows, windows[1:]):
+            self.assertEqual(previous[1], current[0])
+
+    def test_parallel_windows_keep_window_order(self):
+        threads = set()
+
+        def call_api(shopify_object, query_params):
+            threads.add(threading.current_thread().name)
+            # earlier windows finish later
+            time.sleep(0.01 if query_params['updated_at_min'] < '2020-02' else 0)
+            return fake_pages(query_params)
+
+        client = ShopifyClient('test', 'token', max_workers=4)
+        with mock.patch.object(ShopifyClient, 'call_api_all_pages', side_effect=call_api):
+            windows = self._get_windows(client)
+
+        self.assertContiguousWindows(windows)
+        self.assertGreater(len(threads), 1)
+
+    def test_sparse_windows_grow(self):
+        client = ShopifyClient('test', 'token')
+        with mock.patch.object(ShopifyClient, 'call_api_all_pages', side_effect=lambda o, q: fake_pages(q)):
+            windows = self._get_windows(client)
+
+        self.assertContiguousWindows(windows)
+        # 1, 2, 4, ... 256 days instead of 366 one day windows
+        self.assertEqual(9, len(windows))
+
+    def test_server_error_window_is_split(self):
+        failed = []
+
+        def call_api(shopify_object, query_params):
+            window = (query_params['updated_at_min'], query_params['updated_at_max'])
+            if not failed:
+                failed.append(window)
+                raise ServerError()
+            return fake_pages(query_params)
+
+        client = ShopifyClient('test', 'token')
+        with mock.patch.object(ShopifyClient, 'call_api_all_pages', side_effect=call_api):
+            windows = self._get_windows(client)
+
+        self.assertContiguousWindows(windows)
+        self.assertEqual(failed[0][0], windows[0][0])
+        self.assertEqual('2020-01-01T12:00:00', windows[0][1])
+
+    def _get_checkpointed_windows(self, max_workers: int, checkpoint: WindowCheckpoint, error: Exception):
+        def call_api(shopify_object, query_params):
+            if query_params['updated_at_max'] > '2020-02-01T00:00:00':
+                raise error
+            return fake_pages(query_params)
+
+        client = ShopifyClient('test', 'token', max_workers=max_workers)
+        with mock.patch.object(ShopifyClient, 'call_api_all_pages', side_effect=call_api):
+            records = client.get_objects_paginated(mock.Mock(), datetime_min=datetime.datetime(2020, 1, 1),
+                                                   datetime_max=datetime.datetime(2021, 1, 1),
+                                                   date_window_size=1, checkpoint=checkpoint)
+            return [r['id'] for r in records]
+
+    def test_failed_window_interrupts_checkpointed_download(self):
+        # the library wraps the connection failures
+        connection_error = pyactiveresource.connection.Error(urllib.error.URLError('Connection reset'))
+        for max_workers in (1, 4):
+            checkpoint = WindowCheckpoint('updated_at')
+            windows = self._get_checkpointed_windows(max_workers, checkpoint, connection_error)
+
+            self.assertTrue(checkpoint.interrupted)
+            self.assertEqual('2020-01-01T00:00:00', windows[0][0])
+            self.assertEqual(windows[-1][1], checkpoint.completed_until.isoformat())
+            self.assertLessEqual(checkpoint.completed_until, datetime.datetime(2020, 2, 1))
+
+    def test_client_error_fails_checkpointed_download(self):
+        for error in (ShopifyClientError('Request failed; Error: Bad Request'), ValueError('Failed window')):
+            for max_workers in (1, 4):
+                checkpoint = WindowCheckpoint('updated_at')
+                with self.assertRaises(type(error)):
+                    self._get_checkpointed_windows(max_workers, checkpoint, error)
+                self.assertFalse(checkpoint.interrupted)
+
+    def test_failed_first_window_fails_checkpointed_download(self):
+        client = ShopifyClient('test', 'token')
+        checkpoint = WindowCheckpoint('updated_at')
+        with mock.patch.object(ShopifyClient, 'call_api_all_pages', side_effect=ValueError('Failed window')):
+            with self.assertRaises(ValueError):
+                list(client.get_objects_paginated(mock.Mock(), datetime_min=datetime.datetime(2020, 1, 1),
+                                                  datetime_max=datetime.datetime(2021, 1, 1), checkpoint=checkpoint))
+        self.assertFalse(checkpoint.interrupted)
+
+    def test_planner_shrinks_dense_windows(self):
+        planner = DateWindowPlanner(datetime.datetime(2020, 1, 1), datetime.datetime(2021, 1, 1),
+                                    datetime.timedelta(days=30), target_records=1000)
+        window = next(iter(planner))
+        planner.record(window, 30000)
+        self.assertEqual(datetime.timedelta(days=1), planner.window_size)
+        planner.record(window, 0)
+        self.assertEqual(datetime.timedelta(days=2), planner.window_size)
+
+    def test_raw_json_pages_follow_link_header(self):
+        first_url = 'https://test.myshopify.com/admin/api/2022-10/orders.json?limit=250'
+        next_url = 'https://test.myshopify.com/admin/api/2022-10/orders.json?limit=250&page_info=abc'
+        responses = {
+            first_url: Response(200, b'{"orders": [{"id": 1, "line_items": [{"id": 10}]}]}',
+                                {'Link': f'<{next_url}>; rel="next"'}),
+            next_url: Response(200, b'{"orders": [{"id": 2, "line_items": []}]}', {})}
+        shopify_object = mock.Mock()
+        shopify_object._split_options.return_value = ({}, {'limit': 250})
+        shopify_object._collection_path.return_value = first_url
+        shopify_object.connection.get.side_effect = lambda url, headers: responses[url]
+
+        client = ShopifyClient('test', 'token', raw_json=True)
+        records = list(client.get_objects_paginated_simple(shopify_object))
+
+        self.assertEqual([{'id': 1, 'line_items': [{'id': 10}]}, {'id': 2, 'line_items': []}], records)
+        self.assertEqual([first_url, next_url], [c.args[0] for c in shopify_object.connection.get.call_args_list])
+
+    def test_split_to_chunks(self):
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], list(ShopifyClient._split_to_chunks(range(7), 3)))
+        self.assertEqual([[0, 1, 2]], list(ShopifyClient._split_to_chunks(range(3), 3)))
+        self.assertEqual([], list(ShopifyClient._split_to_chunks([], 3)))
+
+    @mock.patch('shopify_cli.time.sleep')
+    def test_rate_limiter_paces_requests(self, sleep):
+        limiter = LeakyBucketRateLimiter()
+        acquire_in_threads(limiter, DEFAULT_BUCKET_SIZE - BUCKET_SAFETY_MARGIN - 1)
+        limiter.acquire()
+        sleep.assert_not_called()
+
+        # 36 requests of the other threads still in flight
+        limiter.update(4, 40)
+        limiter.acquire()
+        # 4 requests over the limit, standard bucket leaks 2 requests per second
+        self.assertAlmostEqual(2, sleep.call_args[0][0], places=1)
+        self.assertEqual(1, limiter.wait_count)
+
+    @mock.patch('shopify_cli.time.sleep')
+    def test_rate_limiter_follows_reported_level(self, sleep):
+        limiter = LeakyBucketRateLimiter()
+        limiter.acquire()
+        limiter.update(39, 40)
+        limiter.acquire()
+        limiter.update(5, 40)
+        limiter.acquire()
+
+        self.assertEqual(1, sleep.call_count)
+        self.assertAlmostEqual(1, sleep.call_args[0][0], places=1)
+
+    @mock.patch('shopify_cli.time.sleep')
+    def test_rate_limiter_plus_bucket_shared_by_threads(self, sleep):
+        limiter = LeakyBucketRateLimiter()
+        limiter.update(78, 80)
+        acquire_in_threads(limiter, 2)
+
+        self.assertEqual(4, limiter.restore_rate)
+        waits = sorted(c[0][0] for c in sleep.call_args_list)
+        self.assertAlmostEqual(0.25, waits[0], places=1)
+        self.assertAlmostEqual(0.5, waits[1], places=1)
+        self.assertAlmostEqual(0.75, limiter.total_wait_time, places=1)
+
+    @mock.patch('shopify_cli.time.sleep')
+    def test_rate_limiter_keeps_slots_of_other_threads(self, sleep):
+        limiter = LeakyBucketRateLimiter()
+        acquire_in_threads(limiter, 1)
+        # response of a retried request, its thread has no slot reserved
+        limiter.update(37, 40)
+        limiter.acquire()
+
+        # the slot of the other thread is still counted
+        self.assertAlmostEqual(0.5, sleep.call_args[0][0], places=1)
+
+    @mock.patch('shopify_cli.time.sleep')
+    def test_missing_call_limit_header_keeps_level(self, sleep):
+        client = ShopifyClient('test', 'token')
+        client.rate_limiter.update(37, 40)
+        client.rate_limiter.acquire()
+        with mock.patch.object(ShopifyClient, '_try_get_credits', return_value=None):
+            client.check_api_limit_use(next_page=True)
+
+        self.assertAlmostEqual(0.5, sleep.call_args[0][0], places=1)
+
+    @mock.patch('backoff._sync.time.sleep')
+    def test_failed_request_releases_slot(self, sleep):
+        limiter = mock.Mock(wraps=LeakyBucketRateLimiter())
+        self.assertEqual('page', FakeApi(limiter, failures=1).get_page())
+        # the failed request released its slot and the retry acquired a new one
+        self.assertEqual(1, limiter.release.call_count)
+        self.assertEqual(1, limiter.acquire.call_count)
+
+        limiter.reset_mock()
+        with self.assertRaises(ServerError):
+            FakeApi(limiter, failures=MAX_RETRIES).get_page()
+        self.assertEqual(MAX_RETRIES, limiter.release.call_count)
+        self.assertEqual(MAX_RETRIES - 1, limiter.acquire.call_count)
+
+
+class TestTaskPool(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+
+    def test_results_in_submission_order(self):
+        def fetch(i):
+            # earlier tasks finish later
+            time.sleep((10 - i) * 0.005)
+            return i
+
+        results = []
+        with TaskPool(self.client, max_workers=4) as pool:
+            for i in range(10):
+                pool.submit(fetch, i)
+                results.extend(pool.completed())
+            results.extend(pool.drain())
+
+        self.assertEqual(list(range(10)), results)
+        self.assertEqual(4, self.client.activate_session.call_count)
+
+    def test_pending_tasks_bounded(self):
+        lock = threading.Lock()
+        started = 0
+        ahead = []
+
+        def fetch(i):
+            nonlocal started
+            with lock:
+                started += 1
+            time.sleep(0.005)
+            return i
+
+        consumed = 0
+        with TaskPool(self.client, max_workers=2, max_pending=3) as pool:
+            for i in range(20):
+                pool.submit(fetch, i)
+                for _ in pool.completed():
+                    consumed += 1
+                    ahead.append(started - consumed)
+            for _ in pool.drain():
+                consumed += 1
+
+        self.assertEqual(20, consumed)
+        # the submitting thread never runs more than max_pending tasks ahead of the consumed results
+        self.assertLessEqual(max(ahead), 3)
+
+    def test_worker_error_raised_in_order(self):
+        def fetch(i):
+            if i == 3:
+                raise ValueError('Failed task')
+            return i
+
+        for max_workers in (1, 4):
+            results = []
+            with self.assertRaises(ValueError):
+                with TaskPool(self.client, max_workers=max_workers) as pool:
+                    for i in range(10):
+                        pool.submit(fetch, i)
+                        results.extend(pool.completed())
+                    results.extend(pool.drain())
+            # results before the failed task are returned
+            self.assertEqual([0, 1, 2], results)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyactiveresource.connection import ClientError
+
+from metrics import RunMetrics
+from transport import MAX_REDIRECTS, ConnectionPool, PooledShopifyConnection
+
+# path -> (status, location)
+REDIRECTS = {'/moved.json': (301, '/orders.json'),
+             '/see-other.json': (303, '/orders.json'),
+             '/loop.json': (302, '/loop.json')}
+
+
+class KeepAliveStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.command, self.path, body))
+        if self.path in REDIRECTS:
+            status, location = REDIRECTS[self.path]
+            self.send_response(status)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        status = 429 if self.path.startswith('/throttled') else 200
+        body = json.dumps({'path': self.path, 'encoding': self.headers.get('Accept-Encoding')}).encode('utf-8')
+        self.send_response(status)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveStub)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def test_connection_reused_and_gzip_decoded(self):
+        for i in range(3):
+            response = self.pool.request('GET', f'{self.url}/orders.json?page={i}')
+            self.assertEqual({'path': f'/orders.json?page={i}', 'encoding': 'gzip'}, json.loads(response.read()))
+            self.assertIsNone(response.headers.get('Content-Encoding'))
+
+        self.assertEqual(3, self.pool.requests_sent)
+        self.assertEqual(1, self.pool.connections_opened)
+
+    def test_closed_connection_reopened(self):
+        self.pool.request('GET', f'{self.url}/orders.json')
+        # connection dropped by the server while idle in the pool
+        for connections in self.pool._idle.values():
+            connections[0].sock.close()
+
+        response = self.pool.request('GET', f'{self.url}/orders.json')
+        self.assertEqual(200, response.code)
+        self.assertEqual(2, self.pool.connections_opened)
+
+    def test_redirects_followed(self):
+        response = self.pool.request('GET', f'{self.url}/moved.json')
+        self.assertEqual(200, response.code)
+        self.assertEqual({'path': '/orders.json', 'encoding': 'gzip'}, json.loads(response.read()))
+
+        self.server.requests.clear()
+        response = self.pool.request('POST', f'{self.url}/see-other.json', {'Content-Type': 'application/json'},
+                                     b'{"order": {}}')
+        self.assertEqual(200, response.code)
+        self.assertEqual([('POST', '/see-other.json', b'{"order": {}}'), ('GET', '/orders.json', b'')],
+                         self.server.requests)
+
+    def test_redirect_hops_bounded(self):
+        response = self.pool.request('GET', f'{self.url}/loop.json')
+        self.assertEqual(302, response.code)
+        self.assertEqual(MAX_REDIRECTS + 1, len(self.server.requests))
+
+    def test_http_errors_raised_by_library(self):
+        connection = PooledShopifyConnection(self.pool, self.url)
+        self.assertEqual({'path': '/orders.json', 'encoding': 'gzip'},
+                         json.loads(connection.get('/orders.json').body))
+
+        with self.assertRaises(ClientError) as error:
+            connection.get('/throttled.json')
+        self.assertEqual(429, error.exception.code)
+        self.assertEqual('1', error.exception.response.headers.get('Retry-After'))
+
+    def test_requests_recorded_in_metrics(self):
+        metrics = RunMetrics()
+        connection = PooledShopifyConnection(self.pool, f'{self.url}/admin/api/2022-10/', metrics=metrics)
+        connection.get('/admin/api/2022-10/orders/1/transactions.json')
+        with self.assertRaises(ClientError):
+            connection.get('/throttled.json')
+
+        endpoints = metrics.to_dict()['endpoints']
+        self.assertEqual({'200': 1}, endpoints['orders/{id}/transactions']['status_codes'])
+        self.assertGreater(endpoints['orders/{id}/transactions']['bytes_received'], 0)
+        self.assertEqual(1, endpoints['throttled']['throttled'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,339 @@
+"""
+Micro-benchmarks of the nested OrderWriter and ProductsWriter on synthetic objects of small, typical and pathological
+shapes, run offline. Skipped unless the SHOPIFY_BENCHMARK environment variable is set:
+
+    SHOPIFY_BENCHMARK=1 python -m unittest tests.test_writer_benchmark
+
+Each case reports for each output table the rows written, rows/s (best of the repeats) and the peak memory allocated
+by a write or close of its writer. The time and allocations of a writer exclude its nested child writers, e.g. the
+line item tax lines are not counted in the line items. The throughput of each table is compared relative to a reference
+workload run before each repeat (flat rows written by the csv module), so the stored baseline doesn't depend on the
+speed of the machine. A case fails when the relative throughput of one of its tables with at least MIN_COMPARED_ROWS
+rows drops more than SHOPIFY_BENCHMARK_TOLERANCE (default 0.25) below the baseline of the table. Regenerate the
+baseline with SHOPIFY_BENCHMARK_UPDATE_BASELINE=1 after an intended change of the throughput.
+"""
+import copy
+import csv
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import unittest
+from pathlib import Path
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+from result import CustomersWriter, OrderWriter, ProductsWriter, TableWriter, get_schema_samples
+
+BENCHMARK_ENABLED = bool(os.environ.get('SHOPIFY_BENCHMARK'))
+UPDATE_BASELINE = bool(os.environ.get('SHOPIFY_BENCHMARK_UPDATE_BASELINE'))
+TOLERANCE = float(os.environ.get('SHOPIFY_BENCHMARK_TOLERANCE') or 0.25)
+
+BASELINE_PATH = Path(__file__).resolve().parent.joinpath('writer_benchmark_baseline.json')
+
+REPEATS = 5
+EXTRACTION_TIME = '2020-01-01T00:00:00'
+
+REFERENCE_ROWS = 20000
+REFERENCE_COLUMNS = 30
+# the tables with fewer rows are written too fast for a stable throughput, they are reported only
+MIN_COMPARED_ROWS = 1000
+
+
+def _money(amount: str) -> dict:
+    return {'shop_money': {'amount': amount, 'currency_code': 'USD'},
+            'presentment_money': {'amount': amount, 'currency_code': 'EUR'}}
+
+
+def build_orders(count: int, line_items: int, tax_lines: int = 1, discount_allocations: int = 1,
+                 properties: int = 2) -> List[dict]:
+    """
+    Copies of the example order with the given number of line items, each line item has the given number of tax lines
+    and discount allocations with their price sets.
+    """
+    sample = get_schema_samples('order')[0]
+    line_item_sample = sample['line_items'][0]
+    orders = []
+    for i in range(count):
+        order = copy.deepcopy(sample)
+        order['id'] = i
+        order['customer']['id'] = i % 100
+        order['line_items'] = []
+        for k in range(line_items):
+            line_item = copy.deepcopy(line_item_sample)
+            line_item['id'] = i * 1000 + k
+            line_item['properties'] = [{'name': f'property {p}', 'value': str(p)} for p in range(properties)]
+            line_item['tax_lines'] = [{'title': f'Tax {t}', 'price': '1.00', 'rate': 0.01, 'price_set': _money('1.00')}
+                                      for t in range(tax_lines)]
+            line_item['discount_allocations'] = [{'amount': '0.50', 'discount_application_index': d,
+                                                  'amount_set': _money('0.50')}
+                                                 for d in range(discount_allocations)]
+            order['line_items'].append(line_item)
+        orders.append(order)
+    return orders
+
+
+def build_products(count: int, variants: int, presentment_prices: int = 1, images: int = 2) -> List[dict]:
+    """
+    Copies of the example product with the given number of variants (each with its presentment prices) and images.
+    """
+    sample = get_schema_samples('product')[0]
+    variant_sample = sample['variants'][0]
+    image_sample = sample['images'][0]
+    products = []
+    for i in range(count):
+        product = copy.deepcopy(sample)
+        product['id'] = i
+        product['variants'] = []
+        for k in range(variants):
+            variant = copy.deepcopy(variant_sample)
+            variant.update(id=i * 1000 + k, product_id=i)
+            variant['presentment_prices'] = [{'price': {'currency_code': f'C{p:02}', 'amount': '199.00'},
+                                              'compare_at_price': None} for p in range(presentment_prices)]
+            product['variants'].append(variant)
+        product['images'] = [dict(copy.deepcopy(image_sample), id=i * 1000 + k, product_id=i) for k in range(images)]
+        products.append(product)
+    return products
+
+
+class TableTimer:
+    """
+    Times the writes and closes of the table writers of a family, each exclusive of the child writers it calls. With
+    tracemalloc running, it also records the peak memory allocated by each table: the memory the writer kept from its
+    previous writes plus the peak of the current write or close.
+    """
+
+    def __init__(self, *writers: TableWriter):
+        self.times: Dict[str, float] = defaultdict(float)
+        self.peaks: Dict[str, int] = defaultdict(int)
+        self._kept: Dict[str, int] = defaultdict(int)
+        # [table, start, time of the child writers, memory in use at the start]
+        self._stack = []
+        seen = set()
+        for writer in writers:
+            self._instrument(writer, seen)
+
+    def _instrument(self, writer: TableWriter, seen: set):
+        if id(writer) in seen:
+            return
+        seen.add(id(writer))
+        table = f'{writer.table_def.name}.csv'
+        writer.write = self._timed(table, writer.write)
+        writer.close = self._timed(table, writer.close)
+        for child in list(vars(writer).values()):
+            if isinstance(child, TableWriter):
+                self._instrument(child, seen)
+
+    def _record_peak(self):
+        if not self._stack or not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        table, _, _, start_memory = frame = self._stack[-1]
+        self.peaks[table] = max(self.peaks[table], self._kept[table] + peak - start_memory)
+        self._kept[table] += current - start_memory
+        tracemalloc.reset_peak()
+        frame[3] = current
+
+    def _timed(self, table: str, method: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            self._record_peak()
+            current = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            self._stack.append([table, time.perf_counter(), 0.0, current])
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._record_peak()
+                _, start, child_time, _ = self._stack.pop()
+                elapsed = time.perf_counter() - start
+                self.times[table] += elapsed - child_time
+                if self._stack:
+                    self._stack[-1][2] += elapsed
+                    if tracemalloc.is_tracing():
+                        self._stack[-1][3] = tracemalloc.get_traced_memory()[0]
+        return timed
+
+
+def write_orders(result_dir: str, orders: List[dict]) -> tuple:
+    """
+    Returns the results and the TableTimer of the writers.
+    """
+    customers_writer = CustomersWriter(result_dir, 'customer', EXTRACTION_TIME, file_headers={})
+    with OrderWriter(result_dir, 'order', EXTRACTION_TIME, customers_writer=customers_writer,
+                     file_headers={}) as writer:
+        timer = TableTimer(writer, customers_writer)
+        for order in orders:
+            writer.write(order)
+    customers_writer.close()
+    return writer.collect_results() + customers_writer.collect_results(), timer
+
+
+def write_products(result_dir: str, products: List[dict]) -> tuple:
+    """
+    Returns the results and the TableTimer of the writers.
+    """
+    with ProductsWriter(result_dir, 'product', EXTRACTION_TIME, file_headers={}) as writer:
+        timer = TableTimer(writer)
+        for product in products:
+            writer.write(product)
+    return writer.collect_results(), timer
+
+
+# case -> (builder of the objects, writer)
+CASES: Dict[str, tuple] = {
+    'orders_small': (lambda: build_orders(2000, line_items=1, tax_lines=0, discount_allocations=0, properties=0),
+                     write_orders),
+    'orders_typical': (lambda: build_orders(500, line_items=5), write_orders),
+    'orders_pathological': (lambda: build_orders(5, line_items=500, tax_lines=5, discount_allocations=5,
+                                                 properties=20), write_orders),
+    'products_small': (lambda: build_products(2000, variants=1, images=0), write_products),
+    'products_typical': (lambda: build_products(500, variants=4), write_products),
+    'products_pathological': (lambda: build_products(10, variants=100, presentment_prices=20, images=250),
+                              write_products),
+}
+
+
+def count_rows(results: list) -> Dict[str, int]:
+    rows = {}
+    for result in results:
+        with open(result.full_path, newline='') as f:
+            rows[os.path.basename(result.full_path)] = sum(1 for _ in csv.reader(f)) - 1
+    return rows
+
+
+def time_reference() -> float:
+    """
+    Returns rows/s of the reference workload, flat rows written by the csv module.
+    """
+    columns = [f'column_{c}' for c in range(REFERENCE_COLUMNS)]
+    rows = [{column: f'value {r} {c}' for c, column in enumerate(columns)} for r in range(REFERENCE_ROWS)]
+    with tempfile.TemporaryFile('w', newline='') as f:
+        start = time.perf_counter()
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        return REFERENCE_ROWS / (time.perf_counter() - start)
+
+
+def measure(build: Callable[[], List[dict]], write: Callable[[str, List[dict]], tuple]) -> Dict[str, dict]:
+    """
+    Writes the objects REPEATS times for the best throughput of each table and once more with tracemalloc for the
+    allocations. Each repeat is paired with a run of the reference workload, the relative throughput of a table is the
+    median of the pairs, so both sides of a pair run under the same load of the machine. Returns the results by table.
+    """
+    rows = {}
+    best_times = {}
+    relative = defaultdict(list)
+    for _ in range(REPEATS):
+        reference_rows_per_s = time_reference()
+        # the writers modify the objects
+        objects = build()
+        with tempfile.TemporaryDirectory() as result_dir:
+            results, timer = write(result_dir, objects)
+            rows = count_rows(results)
+        for table, table_rows in rows.items():
+            elapsed = timer.times[table]
+            best_times[table] = min(elapsed, best_times.get(table, elapsed))
+            relative[table].append(table_rows / elapsed / reference_rows_per_s)
+
+    objects = build()
+    with tempfile.TemporaryDirectory() as result_dir:
+        tracemalloc.start()
+        try:
+            _, timer = write(result_dir, objects)
+        finally:
+            tracemalloc.stop()
+
+    return {table: {'rows': table_rows,
+                    'rows_per_s': round(table_rows / best_times[table], 1),
+                    'relative_throughput': round(statistics.median(relative[table]), 3),
+                    'best_time_s': round(best_times[table], 4),
+                    'peak_alloc_kib': round(timer.peaks[table] / 1024, 1)}
+            for table, table_rows in sorted(rows.items())}
+
+
+def load_baseline() -> dict:
+    if not BASELINE_PATH.exists():
+        return {}
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+@unittest.skipUnless(BENCHMARK_ENABLED, 'Set SHOPIFY_BENCHMARK to run the benchmarks')
+class TestWriterBenchmark(unittest.TestCase):
+    report = {}
+    baseline = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.baseline = load_baseline()
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.report:
+            return
+        print('\n' + format_report(cls.report, cls.baseline))
+        if UPDATE_BASELINE:
+            baseline = dict(cls.baseline)
+            baseline.update({case: {table: {'relative_throughput': r['relative_throughput']}
+                                    for table, r in tables.items() if r['rows'] >= MIN_COMPARED_ROWS}
+                             for case, tables in cls.report.items()})
+            with open(BASELINE_PATH, 'w') as baseline_file:
+                json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+                baseline_file.write('\n')
+
+    def run_case(self, case: str, expected_rows: Dict[str, int]):
+        tables = measure(*CASES[case])
+        self.report[case] = tables
+
+        for file_name, expected in expected_rows.items():
+            self.assertEqual(expected, tables.get(file_name, {}).get('rows'), file_name)
+        if UPDATE_BASELINE:
+            return
+        for table, baseline in self.baseline.get(case, {}).items():
+            expected = baseline['relative_throughput']
+            with self.subTest(table=table):
+                self.assertGreaterEqual(tables[table]['relative_throughput'], expected * (1 - TOLERANCE),
+                                        f"{case} {table} throughput dropped below {expected} of the reference "
+                                        f"workload")
+
+    def test_orders_small(self):
+        self.run_case('orders_small', {'order.csv': 2000, 'line_item.csv': 2000, 'customer.csv': 100})
+
+    def test_orders_typical(self):
+        self.run_case('orders_typical', {'order.csv': 500, 'line_item.csv': 2500, 'line_item_tax_lines.csv': 2500})
+
+    def test_orders_pathological(self):
+        self.run_case('orders_pathological', {'order.csv': 5, 'line_item.csv': 2500,
+                                              'line_item_tax_lines.csv': 12500,
+                                              'line_item_discount_allocations.csv': 12500})
+
+    def test_products_small(self):
+        self.run_case('products_small', {'product.csv': 2000, 'product_variant.csv': 2000})
+
+    def test_products_typical(self):
+        self.run_case('products_typical', {'product.csv': 500, 'product_variant.csv': 2000,
+                                           'product_images.csv': 1000})
+
+    def test_products_pathological(self):
+        self.run_case('products_pathological', {'product.csv': 10, 'product_variant.csv': 1000,
+                                                'product_variant_presentment_prices.csv': 20000,
+                                                'product_images.csv': 2500})
+
+
+def format_report(report: dict, baseline: dict) -> str:
+    header = f"{'case':<24}{'table':<48}{'rows':>8}{'rows/s':>11}{'relative':>10}{'baseline':>10}" \
+             f"{'peak alloc [KiB]':>18}"
+    lines = [header, '-' * len(header)]
+    for case, tables in report.items():
+        for table, r in tables.items():
+            expected = baseline.get(case, {}).get(table, {}).get('relative_throughput')
+            lines.append(f"{case:<24}{table:<48}{r['rows']:>8}{r['rows_per_s']:>11.0f}"
+                         f"{r['relative_throughput']:>10.3f}{expected or '-':>10}{r['peak_alloc_kib']:>18.1f}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    unittest.main()